@@ -3,10 +3,13 @@
 """
 
 import itertools
+import heapq
+import math
 from collections import deque, defaultdict
-from symbol import make_symbol, is_nonterminal
-from rule import Rule
-from wcfg import WCFG
+from functools import partial
+from hypergraph import Hypergraph, HypergraphBuilder
+from array import array
+import numpy as np
 
 
 EMPTY_SET = frozenset()
@@ -39,6 +42,116 @@ class ActiveQueue(object):
         return False
 
 
+class PriorityQueue(object):
+    """
+    A queue of active items which pops the item of highest priority first (e.g. best-first or A*, see best_first.py).
+    Ties are broken in order of arrival and an item never queues more than once.
+    """
+
+    def __init__(self, priority):
+        """
+        :param priority: a function of an item computed when the item is queued (greater is more urgent)
+        """
+        self._priority = priority
+        self._heap = []  # (-priority, arrival, item)
+        self._seen = set()  # items that are queuing (or have already left the queue)
+        self._arrivals = itertools.count()
+
+    def __len__(self):
+        """Number of active items queuing to be processed"""
+        return len(self._heap)
+
+    def pop(self):
+        """Returns the active item of highest priority"""
+        return heapq.heappop(self._heap)[2]
+
+    def add(self, item):
+        """Add an active item if possible"""
+        if item not in self._seen:
+            heapq.heappush(self._heap, (-self._priority(item), next(self._arrivals), item))
+            self._seen.add(item)
+            return True
+        return False
+
+
+class SpanQueue(object):
+    """
+    A queue of active items which pops them by the width of their span (narrower first)
+    and, within a width, pops complete items by the unary rank of their LHS (see `GrammarIndex.unary_rank`).
+    Widths are differences of states, thus states must increase along the arcs of the automaton (e.g. a linear automaton).
+
+    Combining items only widens spans and a unary rule ranks its LHS above its RHS,
+    thus every complete item of a (symbol, start, end) triple is popped before any item which consumes the triple
+    (see `ItemForest`). Incomplete items only lead to wider items, thus they are popped first within a width.
+    Widths and ranks are small integers, thus items are kept in buckets rather than in a heap.
+    """
+
+    def __init__(self, index):
+        """
+        :param index: a GrammarIndex of the grammar being intersected
+        """
+        self._index = index
+        self._ranks = {}  # LHS -> unary rank
+        self._buckets = []  # width -> (incomplete items, complete items by rank) or None
+        self._seen = set()  # items that are queuing (or have already left the queue)
+        self._size = 0
+        self._width = 0  # the width being popped
+        self._rank = 0  # the rank being popped
+
+    def __len__(self):
+        """Number of active items queuing to be processed"""
+        return self._size
+
+    def pop(self):
+        """Returns an incomplete item of the narrowest width or else a complete item of the lowest rank"""
+        buckets = self._buckets
+        while True:
+            bucket = buckets[self._width]
+            if bucket is not None:
+                if bucket[0]:
+                    self._size -= 1
+                    return bucket[0].pop()
+                by_rank = bucket[1]
+                while self._rank < len(by_rank):
+                    if by_rank[self._rank]:
+                        self._size -= 1
+                        return by_rank[self._rank].pop()
+                    self._rank += 1
+            self._width += 1
+            self._rank = 0
+
+    def add(self, item):
+        """Add an active item if possible"""
+        seen = self._seen
+        if item in seen:
+            return False
+        seen.add(item)
+        width = item.dot_ - item.start_
+        try:
+            bucket = self._buckets[width]
+        except IndexError:
+            self._buckets.extend([None] * (width + 1 - len(self._buckets)))
+            bucket = None
+        if bucket is None:
+            bucket = self._buckets[width] = ([], [])
+        if item.next_ is not None:  # incomplete
+            bucket[0].append(item)
+            rank = -1
+        else:
+            lhs = item.rule_.lhs_
+            rank = self._ranks.get(lhs, None)
+            if rank is None:
+                rank = self._ranks[lhs] = self._index.unary_rank(lhs)
+            by_rank = bucket[1]
+            if rank >= len(by_rank):
+                by_rank.extend([] for _ in xrange(rank + 1 - len(by_rank)))
+            by_rank[rank].append(item)
+        if width <= self._width and (width < self._width or 0 <= rank < self._rank):
+            raise ValueError('Items are not queuing in span order: %s' % item)
+        self._size += 1
+        return True
+
+
 class Agenda(object):
     """
     This is a CKY agenda which implements the algorithm by Nederhof and Satta (2008).
@@ -132,36 +245,211 @@ class Agenda(object):
         return iter(self._generating.get(sym, {}).get(start, frozenset()))
 
 
-def get_intersected_rule(item):
-    lhs = make_symbol(item.rule.lhs, item.start, item.dot)
-    positions = item.inner + (item.dot,)
-    rhs = [make_symbol(sym, positions[i], positions[i + 1]) for i, sym in enumerate(item.rule.rhs)]
-    return Rule(lhs, rhs, item.rule.log_prob)
+class ItemForest(object):
+    """
+    Builds the forest as complete items are found (rather than by visiting them top-down afterwards, see `get_cfg`)
+    together with the inside weight (log semiring) and the topological level of every node.
+    Items must complete in an order in which a (symbol, start, end) triple is only consumed
+    once all of its complete items have been added (see SpanQueue), then the inside weight and the level of
+    the children of an edge are final when the edge is added.
+    Nodes are keyed as in `get_cfg`, items unreachable from the goal are pruned when the forest is built.
+
+    >>> from rule import Rule
+    >>> from wcfg import WCFG
+    >>> from wfsa import make_linear_fsa
+    >>> from item import ItemFactory
+    >>> from inference import inside
+    >>> G, fsa, factory = WCFG([]), make_linear_fsa('a a'), ItemFactory()
+    >>> forest = ItemForest(G)
+    >>> forest.add(factory.get_item(Rule('[X]', ['a'], -1.0), 1, (0,)))
+    >>> forest.add(factory.get_item(Rule('[X]', ['a'], -1.0), 2, (1,)))
+    >>> forest.add(factory.get_item(Rule('[T]', ['[X]'], -0.5), 2, (1,)))  # unreachable
+    >>> forest.add(factory.get_item(Rule('[S]', ['[X]', '[X]'], -2.0), 2, (0, 1)))
+    >>> forest.add(factory.get_item(Rule('[S]', ['a', '[X]'], -1.0), 2, (0, 1)))
+    >>> forest.add(factory.get_item(Rule('[T]', ['[S]'], -3.0), 2, (0,)))
+    >>> agenda = Agenda()
+    >>> agenda.add_generating('[T]', 0, 2)
+    True
+    >>> H, weights, inside_node = forest.build('[GOAL]', '[T]', fsa, agenda)
+    >>> len(H), H.fetch(('[T]', 1, 2)), inside_node[H.fetch('[GOAL]')].round(4), H.node_levels[H.fetch('[GOAL]')]
+    (6, None, -4.8731, 4)
+    >>> np.allclose(inside_node, inside(H, omega=weights))
+    True
+    """
 
+    def __init__(self, wcfg, weight=None):
+        """
+        :param wcfg: the intersected grammar (see `wcfg.decode` and `wcfg.is_nonterminal`)
+        :param weight: the log weight under which inside weights are computed, a function of (rule, start, end),
+            by default edges weigh their rules' log probabilities
+        """
+        self._wcfg = wcfg
+        self._weight = weight
+        self._nodes = []  # node -> key
+        self._node_ids = {}  # key -> node
+        self._inside = []  # node -> inside weight
+        self._levels = []  # node -> topological level
+        self._heads = array('i')
+        self._tail_offset = array('i', [0])
+        self._tail_nodes = array('i')
+        self._log_probs = array('d')  # edge -> log probability of its rule
+        self._weights = array('d')  # edge -> weight
+        self._rhs = {}  # rule -> RHS as (nonterminal, None) or (None, leaf node) pairs
+
+    def _node(self, key, inside, level):
+        """The id of a node, created with a given inside weight and level if it does not exist."""
+        nid = self._node_ids.get(key, None)
+        if nid is None:
+            nid = self._node_ids[key] = len(self._nodes)
+            self._nodes.append(key)
+            self._inside.append(inside)
+            self._levels.append(level)
+        return nid
+
+    def add(self, item):
+        """Adds the edge of a complete item and its inside weight to the inside weight of its head."""
+        rule = item.rule_
+        rhs = self._rhs.get(rule, None)
+        if rhs is None:
+            is_nonterminal, decode = self._wcfg.is_nonterminal, self._wcfg.decode
+            rhs = self._rhs[rule] = [(sym, None) if is_nonterminal(sym) else (None, self._node(decode(sym), 0.0, 0))
+                                     for sym in rule.rhs_]
+        start, end = item.start_, item.dot_
+        weight = rule.log_prob_ if self._weight is None else self._weight(rule, start, end)
+        # children are complete, thus their inside weights and levels are final
+        node_ids, inside, levels, tails = self._node_ids, self._inside, self._levels, self._tail_nodes
+        score, height, left = weight, 0, start
+        for right, (sym, child) in zip(item.inner_[1:] + (end,), rhs):
+            if child is None:
+                child = node_ids[(sym, left, right)]
+            tails.append(child)
+            score += inside[child]
+            if levels[child] > height:
+                height = levels[child]
+            left = right
+        self._add_edge(self._node((rule.lhs_, start, end), -np.inf, 1), rule.log_prob_, weight, score, height)
+
+    def _add_edge(self, head, log_prob, weight, score, height):
+        """Adds an edge whose tails have just been added, its inside weight is `score` and its highest child is in level `height`."""
+        self._heads.append(head)
+        self._tail_offset.append(len(self._tail_nodes))
+        self._log_probs.append(log_prob)
+        self._weights.append(weight)
+        total = self._inside[head]
+        if score > total:
+            total, score = score, total
+        if score != -np.inf and total != np.inf:  # otherwise the sum is the larger of the two
+            total += math.log1p(math.exp(score - total))
+        self._inside[head] = total
+        if height >= self._levels[head]:
+            self._levels[head] = height + 1
+
+    def build(self, goal, root, fsa, agenda, dtype=np.float64):
+        """
+        Connects the goal to the root over every initial and final state and builds the forest.
+        :param goal: the goal (a string)
+        :param root: the root in the grammar's own encoding (see `wcfg.encode`)
+        :returns: the forest, the vector of its edge weights and the inside weight of each node
+        """
+        tops = [self._node_ids[(root, start, end)] for start, ends in agenda.itergenerating(root)
+                if fsa.is_initial(start) for end in ends if fsa.is_final(end)]
+        if not tops:
+            return Hypergraph([], [], [0], [], [], self._wcfg.decode, dtype), np.zeros(0), np.zeros(0)
+        goal_node = self._node(goal, -np.inf, 1)
+        for top in tops:
+            self._tail_nodes.append(top)
+            self._add_edge(goal_node, 0.0, 0.0, self._inside[top], self._levels[top])
+        heads = np.frombuffer(self._heads, dtype=np.int32)
+        H = Hypergraph(self._nodes, heads, np.frombuffer(self._tail_offset, dtype=np.int32),
+                       np.frombuffer(self._tail_nodes, dtype=np.int32), np.frombuffer(self._log_probs, dtype=np.float64),
+                       self._wcfg.decode, dtype, self._levels)
+        reached = H.reachable(goal)
+        # the forest groups edges by head (stably), edge weights follow
+        weights = np.frombuffer(self._weights, dtype=np.float64)[np.argsort(heads, kind='mergesort')]
+        return H.subgraph(reached), weights[reached[H.heads]], np.array(self._inside)[reached]
+
+
+class ForestInside(object):
+    """
+    Bottom-up intersection (e.g. Nederhof) which builds the forest and its inside weights while items complete.
+    The engine provides `_wcfg`, `_wfsa`, `_index`, `axioms`, `inference` and calls `self._forest.add`
+    on every complete item it keeps (unless `_forest` is None).
+    """
+
+    _forest = None
 
-def get_cfg(goal, root, fsa, agenda):
+    def do_inside(self, root='[S]', goal='[GOAL]', weight=None):
+        """
+        Runs the program with items popped in span order (see SpanQueue) and adds every complete item to an ItemForest,
+        thus the forest comes with its inside weights without revisiting complete items (see `get_cfg`)
+        nor a separate inside pass.
+        States must increase along the arcs of the automaton (e.g. a linear automaton).
+        :param weight: the log weight of an edge as a function of (rule, start, end), by default its rule's log probability
+        :returns: the forest, the vector of its edge weights and the inside weight (log) of each node
+        """
+        if getattr(self, '_priority', None) is not None:
+            raise ValueError('The forest and its inside weights are built in span order, not in best-first order')
+        if any(sfrom >= sto for sfrom, sto, sym, w in self._wfsa.iterarcs()):
+            raise ValueError('I can only build inside weights in span order if states increase along arcs')
+        root = self._wcfg.encode(root)
+        self._agenda = Agenda(active_container_type=partial(SpanQueue, self._index))
+        self._forest = ItemForest(self._wcfg, weight)
+        self.axioms()
+        self.inference()
+        forest, self._forest = self._forest.build(goal, root, self._wfsa, self._agenda), None
+        return forest
+
+
+def get_cfg(goal, root, fsa, agenda, wcfg, dtype=np.float64):
     """
-    Constructs the CFG by visiting complete items in a top-down fashion.
+    Constructs the forest by visiting complete items in a top-down fashion.
     This is effectively a reachability test and it serves the purpose of filtering nonterminal symbols
     that could never be reached from the root.
     Note that bottom-up intersection typically does enumerate a lot of useless (unreachable) items.
     This is the recursive procedure described in the paper (Nederhof and Satta, 2008).
+
+    The root is given in the grammar's own encoding (see `wcfg.encode`), the goal is a string.
+    The result is a Hypergraph whose nonterminal nodes are keyed by (symbol, start, end) triples,
+    terminal nodes by their (decoded) strings and the goal node by the goal string.
+    Nodes are finished in post-order, thus their topological levels are recorded as we go (see `Hypergraph.levels`).
+    :param dtype: floating point type of the edge weights
     """
 
-    G = WCFG()
+    H = HypergraphBuilder()
     processed = set()
+    is_nonterminal = wcfg.is_nonterminal
+    decode = wcfg.decode
+    node = H.node
+    level = H.level
+
+    def leaf(sym):
+        nid = node(decode(sym))
+        H.set_level(nid, 0)
+        return nid
 
     def make_rules(lhs, start, end):
-        if (start, lhs, end) in processed:
+        """Adds the edges incoming to a node and, once its children are done, records its topological level."""
+        if (lhs, start, end) in processed:
             return
         processed.add((lhs, start, end))
+        head = node((lhs, start, end))
+        height = 0
         for item in agenda.itercomplete(lhs, start, end):
-            G.add(get_intersected_rule(item))
             fsa_states = item.inner + (item.dot,)
-            for i, sym in itertools.ifilter(lambda (_, s): is_nonterminal(s), enumerate(item.rule.rhs)):
+            rhs = item.rule.rhs
+            tails = [node((sym, fsa_states[i], fsa_states[i + 1])) if is_nonterminal(sym) else leaf(sym)
+                     for i, sym in enumerate(rhs)]
+            H.add_edge(head, tails, item.rule.log_prob)
+            for i, sym in itertools.ifilter(lambda (_, s): is_nonterminal(s), enumerate(rhs)):
                 if (sym, fsa_states[i], fsa_states[
                         i + 1]) not in processed:  # Nederhof does not perform this test, but in python it turned out crucial
                     make_rules(sym, fsa_states[i], fsa_states[i + 1])
+            # children are done (unless they are still being visited, i.e. there is a cycle and the level stays unknown)
+            if height >= 0:
+                levels = [level(child) for child in tails]
+                height = -1 if min(levels) < 0 else max(height, max(levels) + 1)
+        if height > 0:
+            H.set_level(head, height)
 
     # create goal items
     for start, ends in agenda.itergenerating(root):
@@ -169,7 +457,7 @@ def get_cfg(goal, root, fsa, agenda):
             continue
         for end in itertools.ifilter(lambda q: fsa.is_final(q), ends):
             make_rules(root, start, end)
-            G.add(Rule(make_symbol(goal, None, None),
-                       [make_symbol(root, start, end)], 0.0))
+            H.add_edge(node(goal), [node((root, start, end))], 0.0)
+            H.set_level(node(goal), max(H.level(node(goal)), H.level(node((root, start, end))) + 1))
 
-    return G
+    return H.build(decode, dtype)
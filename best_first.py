@@ -0,0 +1,189 @@
+"""
+Priorities for best-first and A* agendas (see `agenda.PriorityQueue`).
+
+The priority of an item is its Viterbi inside score, i.e. the log probability of the rule
+plus the best scores of the spans it has consumed, optionally plus an admissible estimate of the score
+of the rest of a complete derivation (A*).
+Weights must be log probabilities (never positive), then scores only decrease as items are combined
+and the first time a (symbol, start, end) triple is completed its best score is known (Knuth, 1977),
+thus a parser may stop as soon as the goal is proven.
+
+Outside estimates are computed once from a grammar, they do not depend on spans and they are admissible.
+Estimates from a coarse grammar (e.g. one whose nonterminals merge those of the grammar and whose rules bound theirs)
+are cheaper to compute, but they are only admissible if the coarse grammar bounds the fine one.
+
+:Authors: - Wilker Aziz
+"""
+
+import heapq
+from collections import defaultdict
+
+
+class ItemPriority(object):
+    """
+    Best scores of the proven (symbol, start, end) triples and the priority of items.
+
+    >>> from rule import Rule
+    >>> from item import ItemFactory
+    >>> factory, priority = ItemFactory(), ItemPriority()
+    >>> item = factory.get_item(Rule('[S]', ['[NP]', '[VP]'], -1.0), 2, (0,))
+    >>> priority.prove('[NP]', 0, 2, -3.0), priority.prove('[NP]', 0, 2, -2.0)
+    (True, False)
+    >>> priority(item)
+    -4.0
+    """
+
+    def __init__(self, heuristic=None):
+        """
+        :param heuristic: an estimate of the outside score of an item (e.g. OutsideEstimates) or None for best-first
+        """
+        self._best = {}  # (symbol, start, end) -> Viterbi inside score
+        self._inside = {}  # item -> inside score (computed when the item is queued)
+        self._heuristic = heuristic
+
+    def prove(self, sym, start, end, score):
+        """
+        Records the score of a symbol over a span the first time it is completed (in best-first order that is its best score).
+        Returns False if the triple had already been proven.
+        """
+        key = (sym, start, end)
+        if key in self._best:
+            return False
+        self._best[key] = score
+        return True
+
+    def best(self, sym, start, end):
+        return self._best.get((sym, start, end), None)
+
+    def inside(self, item):
+        """The score of the rule plus the best scores of the symbols consumed so far (terminals score 0)."""
+        score = self._inside.get(item, None)
+        if score is not None:
+            return score
+        rule, inner = item.rule, item.inner
+        score = rule.log_prob
+        n = len(inner)
+        if n:
+            best, rhs = self._best, rule.rhs
+            for k in xrange(n - 1):
+                score += best.get((rhs[k], inner[k], inner[k + 1]), 0.0)
+            score += best.get((rhs[n - 1], inner[n - 1], item.dot), 0.0)
+        self._inside[item] = score
+        return score
+
+    def __call__(self, item):
+        if self._heuristic is None:
+            return self.inside(item)
+        return self.inside(item) + self._heuristic(item)
+
+
+class OutsideEstimates(object):
+    """
+    Span-independent A* estimates: the best inside score of each symbol (to any string)
+    and the best outside score of each nonterminal (in any context below the root).
+
+    >>> from wcfg import WCFG
+    >>> from rule import Rule
+    >>> G = WCFG([Rule('[S]', ['[NP]', '[VP]'], -1.0), Rule('[NP]', ['dogs'], -0.5), Rule('[NP]', ['[NP]', '[PP]'], -2.0),
+    ...           Rule('[VP]', ['bark'], -0.25), Rule('[PP]', ['[NP]'], -3.0)])
+    >>> h = OutsideEstimates(G, '[S]')
+    >>> h.inside('[NP]'), h.inside('[PP]'), h.inside('[S]'), h.inside('dogs')
+    (-0.5, -3.5, -1.75, 0.0)
+    >>> h.outside('[S]'), h.outside('[NP]'), h.outside('[PP]')
+    (0.0, -1.25, -3.75)
+    """
+
+    def __init__(self, wcfg, root, coarse=None, project=None):
+        """
+        :param wcfg: the grammar (log probabilities)
+        :param root: the start symbol (as a string)
+        :param coarse: a grammar from which estimates are computed instead of `wcfg`
+        :param project: maps a symbol of `wcfg` to a symbol of `coarse` (as strings), defaults to the identity
+        """
+        self._wcfg = wcfg
+        self._grammar = wcfg if coarse is None else coarse
+        self._project = project
+        self._inside = self._inside_bounds(self._grammar)
+        self._outside = self._outside_bounds(self._grammar, self._grammar.encode(project(root) if project else root))
+        self._symbols = {}  # symbol of wcfg -> symbol of the grammar the estimates come from
+        self._suffix = {}  # (rule, position) -> best inside score of the RHS from that position
+
+    @staticmethod
+    def _inside_bounds(wcfg):
+        """Knuth's algorithm: a nonterminal is done once all nonterminals of some rule are done."""
+        is_nonterminal = wcfg.is_nonterminal
+        waiting = defaultdict(list)  # nonterminal -> rules (by id) which contain it
+        pending = []  # rule id -> number of nonterminal occurrences left
+        score = []  # rule id -> score so far
+        rules = list(wcfg)
+        heap = []
+        for rid, rule in enumerate(rules):
+            nonterminals = [sym for sym in rule.rhs if is_nonterminal(sym)]
+            pending.append(len(nonterminals))
+            score.append(rule.log_prob)
+            for sym in nonterminals:
+                waiting[sym].append(rid)
+            if not nonterminals:
+                heapq.heappush(heap, (-rule.log_prob, rule.lhs))
+        inside = {}
+        while heap:
+            negscore, sym = heapq.heappop(heap)
+            if sym in inside:
+                continue
+            inside[sym] = 0.0 - negscore
+            for rid in waiting.get(sym, []):
+                pending[rid] -= 1
+                score[rid] += inside[sym]
+                if not pending[rid]:
+                    heapq.heappush(heap, (-score[rid], rules[rid].lhs))
+        return inside
+
+    def _outside_bounds(self, wcfg, root):
+        """Dijkstra from the root: the context of a child is that of its parent, the rule and the best inside of its siblings."""
+        is_nonterminal = wcfg.is_nonterminal
+        inside = self._inside
+        outside = {}
+        heap = [(0.0, root)]
+        while heap:
+            negscore, lhs = heapq.heappop(heap)
+            if lhs in outside:
+                continue
+            outside[lhs] = 0.0 - negscore
+            for rule in wcfg.get(lhs, ()):
+                scores = [inside.get(sym, None) if is_nonterminal(sym) else 0.0 for sym in rule.rhs]
+                if None in scores:  # the rule takes part in no derivation
+                    continue
+                total = outside[lhs] + rule.log_prob + sum(scores)
+                for sym, score in zip(rule.rhs, scores):
+                    if is_nonterminal(sym) and sym not in outside:
+                        heapq.heappush(heap, (-(total - score), sym))
+        return outside
+
+    def _symbol(self, sym):
+        """The symbol of the grammar of the estimates which stands for a symbol of `wcfg`."""
+        if self._grammar is self._wcfg:
+            return sym
+        projected = self._symbols.get(sym, None)
+        if projected is None:
+            name = self._wcfg.decode(sym)
+            projected = self._symbols[sym] = self._grammar.encode(self._project(name) if self._project else name)
+        return projected
+
+    def inside(self, sym):
+        """Upper bound on the inside score of a symbol (as encoded in `wcfg`), terminals score 0."""
+        if self._wcfg.is_terminal(sym):
+            return 0.0
+        return self._inside.get(self._symbol(sym), float('-inf'))
+
+    def outside(self, sym):
+        """Upper bound on the outside score of a nonterminal (as encoded in `wcfg`)."""
+        return self._outside.get(self._symbol(sym), float('-inf'))
+
+    def __call__(self, item):
+        """Estimate of the score of the rest of a derivation: the outside of the LHS and the best inside of the symbols ahead of the dot."""
+        rule, n = item.rule, len(item.inner)
+        key = (rule, n)
+        estimate = self._suffix.get(key, None)
+        if estimate is None:
+            estimate = self._suffix[key] = sum((self.inside(sym) for sym in rule.rhs[n:]), self.outside(rule.lhs))
+        return estimate
@@ -0,0 +1,138 @@
+"""
+Reversible binarisation of a WCFG.
+
+Rules whose RHS has more than two symbols are split into a chain of binary rules through intermediate nonterminals,
+thus the cost of each item of the intersection (e.g. `Item.inner`) is bounded:
+
+    - left: A -> B C D E becomes A -> [<B+C+D>] E, [<B+C+D>] -> [<B+C>] D and [<B+C>] -> B C
+    - right: A -> B C D E becomes A -> B [<C+D+E>], [<C+D+E>] -> C [<D+E>] and [<D+E>] -> D E
+
+The rule at the top of a chain keeps the log probability of the original rule and intermediate rules have log probability 0,
+thus a derivation has the same score before and after binarisation.
+Intermediate symbols are named after the symbols they cover and, by default, they are shared by every rule
+with the same prefix (left) or suffix (right), alternatively they are specific to the LHS of the rule (e.g. [A|<B+C>]).
+
+The Binarisation returned along with the grammar undoes the transform in derivations (see `Binarisation.restore`).
+
+:Authors: - Wilker Aziz
+"""
+
+from rule import Rule
+from symbol import is_nonterminal, make_nonterminal
+from wcfg import WCFG
+from compiled_wcfg import CompiledWCFG
+
+
+class Binarisation(object):
+    """
+    Records the intermediate symbols of a binarised grammar (in the grammar's encoding, see `wcfg.encode`).
+    """
+
+    def __init__(self, intermediates=()):
+        self._intermediates = frozenset(intermediates)
+
+    def __len__(self):
+        """Number of intermediate symbols."""
+        return len(self._intermediates)
+
+    def is_intermediate(self, node):
+        """Whether a symbol, or a (symbol, start, end) node of a forest, was introduced by the binarisation."""
+        return (node[0] if type(node) is tuple else node) in self._intermediates
+
+    def restore(self, derivation):
+        """
+        Splices the intermediate nodes of a derivation into their parents.
+        :param derivation: a sequence of rules, over symbols or over forest nodes, each node rewritten once
+            (e.g. the rules of the edges of a derivation, see `Hypergraph.rule`)
+        :returns: the list of rules in the original vocabulary (in the same order, the root's rule stays first)
+        """
+        if not self._intermediates:
+            return list(derivation)
+        by_lhs = dict((r.lhs, r) for r in derivation)
+        restored = []
+        for r in derivation:
+            if self.is_intermediate(r.lhs):
+                continue
+            rhs, log_prob = [], r.log_prob
+            pending = list(reversed(r.rhs))
+            while pending:
+                child = pending.pop()
+                if self.is_intermediate(child):
+                    chain = by_lhs[child]
+                    log_prob += chain.log_prob
+                    pending.extend(reversed(chain.rhs))
+                else:
+                    rhs.append(child)
+            restored.append(Rule(r.lhs, rhs, log_prob))
+        return restored
+
+
+def binarise(wcfg, direction='left', share=True):
+    """
+    Binarises a grammar.
+
+    >>> G = WCFG([Rule('[S]', ['[A]', '[B]', '[C]', '[D]'], -1.0), Rule('[T]', ['[A]', '[B]', 'c'], -2.0), Rule('[A]', ['a'], 0.0)])
+    >>> B, binarisation = binarise(G)
+    >>> for r in sorted(B, key=str): print r
+    [<A+B+C>] -> [<A+B>] [C] (0.0)
+    [<A+B>] -> [A] [B] (0.0)
+    [A] -> a (0.0)
+    [S] -> [<A+B+C>] [D] (-1.0)
+    [T] -> [<A+B>] c (-2.0)
+    >>> derivation = [Rule('[S]', ['[<A+B+C>]', '[D]'], -1.0), Rule('[<A+B+C>]', ['[<A+B>]', '[C]'], 0.0), Rule('[<A+B>]', ['[A]', '[B]'], 0.0)]
+    >>> binarisation.restore(derivation)
+    [[S] -> [A] [B] [C] [D] (-1.0)]
+    >>> B, _ = binarise(G, 'right', share=False)
+    >>> for r in sorted(B, key=str): print r
+    [A] -> a (0.0)
+    [S] -> [A] [S|<B+C+D>] (-1.0)
+    [S|<B+C+D>] -> [B] [S|<C+D>] (0.0)
+    [S|<C+D>] -> [C] [D] (0.0)
+    [T] -> [A] [T|<B+c>] (-2.0)
+    [T|<B+c>] -> [B] c (0.0)
+
+    :param wcfg: a grammar (a WCFG or a CompiledWCFG, in which case the result is compiled too)
+    :param direction: 'left' or 'right'
+    :param share: whether intermediate symbols are shared across rules with different LHS
+    :returns: the binarised grammar (or `wcfg` itself if it is already binary) and its Binarisation
+    """
+    if direction not in ('left', 'right'):
+        raise ValueError('I do not know how to binarise to the %s' % direction)
+    rules = [wcfg.decode_rule(r) for r in wcfg]
+    if all(len(r.rhs) <= 2 for r in rules):
+        return wcfg, Binarisation()
+    nonterminals = set(r.lhs for r in rules)
+    nonterminals.update(sym for r in rules for sym in r.rhs if is_nonterminal(sym))
+    names = {}  # (LHS or None, covered symbols) -> intermediate symbol
+    binary = []
+
+    def intermediate(lhs, symbols):
+        """Returns the intermediate symbol which rewrites into a sequence of symbols (creating its rules if necessary)."""
+        key = (None if share else lhs, symbols)
+        sym = names.get(key, None)
+        if sym is not None:
+            return sym
+        base = '<%s>' % '+'.join(s[1:-1] if is_nonterminal(s) else s for s in symbols)
+        if not share:
+            base = '%s|%s' % (lhs[1:-1], base)
+        sym = make_nonterminal(base)
+        while sym in nonterminals:  # never clash with a symbol of the grammar
+            base += "'"
+            sym = make_nonterminal(base)
+        nonterminals.add(sym)
+        names[key] = sym
+        binary.append(Rule(sym, split(lhs, symbols), 0.0))
+        return sym
+
+    def split(lhs, symbols):
+        """The binary RHS of a sequence of symbols."""
+        if len(symbols) <= 2:
+            return symbols
+        if direction == 'left':
+            return intermediate(lhs, symbols[:-1]), symbols[-1]
+        return symbols[0], intermediate(lhs, symbols[1:])
+
+    for r in rules:
+        binary.append(Rule(r.lhs, split(r.lhs, r.rhs), r.log_prob))
+    grammar = CompiledWCFG(binary) if isinstance(wcfg, CompiledWCFG) else WCFG(binary)
+    return grammar, Binarisation(grammar.encode(sym) for sym in names.itervalues())
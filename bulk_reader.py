@@ -0,0 +1,187 @@
+"""
+Parallel bulk loading of large grammars.
+
+Each grammar file is decompressed once and split into chunks of whole lines.
+A process pool parses the chunks into array columns (LHS ids, RHS ids and weights) over chunk-local symbol tables,
+the local tables are then merged into a single `SymbolTable` (remapping ids with numpy),
+and the transform (e.g. log) is applied to the weight column at once.
+
+The result is a `CompiledWCFG` with the same rules (in the same order) and the same symbol ids as
+`CompiledWCFG(reader.read_grammar(...))`.
+
+:Authors: - Wilker Aziz
+"""
+
+import math
+import numpy as np
+from array import array
+from multiprocessing import Pool
+from compiled_wcfg import CompiledWCFG, SymbolTable
+from symbol import make_nonterminal, make_terminal
+from utils import smart_open
+
+
+# transforms we know how to apply to a whole column at once
+VECTORISED = {math.log: np.log, float: None}
+
+
+def split_chunks(text, n_chunks):
+    """
+    Splits a text into (at most) n_chunks pieces, only breaking at the end of lines.
+
+    >>> split_chunks('a\\nb\\nc\\nd\\n', 2)
+    ['a\\nb\\n', 'c\\nd\\n']
+    >>> split_chunks('a\\nb', 4)
+    ['a\\n', 'b']
+    """
+    chunks = []
+    size = max(1, len(text) // max(1, n_chunks))
+    begin = 0
+    while begin < len(text):
+        end = text.find('\n', min(begin + size, len(text)) - 1)
+        end = len(text) if end < 0 else end + 1
+        chunks.append(text[begin:end])
+        begin = end
+    return chunks
+
+
+class _Columns(object):
+    """Rule columns over a chunk-local symbol table."""
+
+    def __init__(self):
+        self.symbols = SymbolTable()
+        self.lhs = array('i')
+        self.rhs_length = array('i')
+        self.rhs = array('i')
+        self.weight = array('d')
+
+    def append(self, lhs, rhs, weight):
+        encode = self.symbols.encode
+        self.lhs.append(encode(lhs))
+        self.rhs.extend(encode(sym) for sym in rhs)
+        self.rhs_length.append(len(rhs))
+        self.weight.append(weight)
+
+    def result(self):
+        return list(self.symbols), self.lhs, self.rhs_length, self.rhs, self.weight
+
+
+def _parse_bar(args):
+    """Parses a chunk of rules in cdec format (see `wcfg.read_grammar_rules`)."""
+    text, strip_quotes = args
+    columns = _Columns()
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        lhs, rhs, prob = line.split(' ||| ')
+        if not strip_quotes:
+            rhs = rhs.split()
+        else:
+            rhs = [s[1:-1] if s.startswith("'") and s.endswith("'") else s for s in rhs.split()]
+        columns.append(lhs, rhs, float(prob))
+    return columns.result()
+
+
+def _parse_discodop_rules(args):
+    """Parses a chunk of rules in discodop's format (see `discodopfmt.iterrules`)."""
+    text, _ = args
+    columns = _Columns()
+    for line in text.splitlines():
+        fields = line.split()
+        if not fields:
+            continue
+        num, den = fields[-1].split('/')
+        # fields[-2] is the yield function, which we are ignoring
+        columns.append(make_nonterminal(fields[0]), [make_nonterminal(s) for s in fields[1:-2]], float(num) / float(den))
+    return columns.result()
+
+
+def _parse_discodop_lexicon(args):
+    """Parses a chunk of a lexicon in discodop's format (see `discodopfmt.iterlexicon`)."""
+    text, _ = args
+    columns = _Columns()
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        fields = line.split('\t')
+        word = make_terminal(fields[0])
+        for pair in fields[1:]:
+            tag, fraction = pair.split(' ')
+            num, den = fraction.split('/')
+            columns.append(make_nonterminal(tag), [word], float(num) / float(den))
+    return columns.result()
+
+
+def merge(results):
+    """
+    Merges chunk results into global tables.
+    :returns: SymbolTable, lhs, rhs_offset, rhs, weight (numpy arrays)
+    """
+    symbols = SymbolTable()
+    lhs, rhs_length, rhs, weight = [], [], [], []
+    for local_symbols, c_lhs, c_rhs_length, c_rhs, c_weight in results:
+        # local id -> global id
+        remap = np.array([symbols.encode(sym) for sym in local_symbols], dtype=np.int32)
+        lhs.append(remap[np.asarray(c_lhs, dtype=np.int32)])
+        rhs.append(remap[np.asarray(c_rhs, dtype=np.int32)])
+        rhs_length.append(np.asarray(c_rhs_length, dtype=np.int32))
+        weight.append(np.asarray(c_weight, dtype=np.float64))
+    rhs_offset = np.zeros(sum(len(a) for a in rhs_length) + 1, dtype=np.int32)
+    if len(rhs_offset) > 1:
+        np.cumsum(np.concatenate(rhs_length), out=rhs_offset[1:])
+    return (symbols,
+            np.concatenate(lhs) if lhs else np.zeros(0, dtype=np.int32),
+            rhs_offset,
+            np.concatenate(rhs) if rhs else np.zeros(0, dtype=np.int32),
+            np.concatenate(weight) if weight else np.zeros(0))
+
+
+def apply_transform(weight, transform):
+    """Applies a transform to a column of weights (vectorised if possible)."""
+    if transform in VECTORISED:
+        vectorised = VECTORISED[transform]
+        if vectorised is None:
+            return weight
+        with np.errstate(divide='raise', invalid='raise'):
+            try:
+                return vectorised(weight)
+            except FloatingPointError:
+                raise ValueError('math domain error')
+    return np.array([transform(w) for w in weight.tolist()], dtype=np.float64)
+
+
+def bulk_load(path, grammarfmt, transform=math.log, jobs=2, chunks_per_job=4):
+    """
+    Loads a grammar parsing chunks of it in parallel.
+
+    :param path: path to the grammar (or prefix path to rules and lexicon)
+    :param grammarfmt: 'bar', 'discodop' or 'milos'
+    :param transform: applied to the weights (math.log and float are vectorised)
+    :param jobs: number of processes
+    :param chunks_per_job: more chunks than processes help balance the load
+    :returns: CompiledWCFG
+    """
+    if grammarfmt in ('bar', 'milos'):
+        tasks = [(_parse_bar, path)]
+    elif grammarfmt == 'discodop':
+        tasks = [(_parse_discodop_rules, '{0}.rules.gz'.format(path)),
+                 (_parse_discodop_lexicon, '{0}.lex.gz'.format(path))]
+    else:
+        raise NotImplementedError("I don't know this grammar format: %s" % grammarfmt)
+    strip_quotes = grammarfmt == 'milos'
+    pool = Pool(jobs) if jobs > 1 else None
+    try:
+        results = []
+        for parse, fname in tasks:
+            with smart_open(fname) as fi:
+                text = fi.read()  # decompress once
+            args = [(chunk, strip_quotes) for chunk in split_chunks(text, jobs * chunks_per_job)]
+            results.extend(pool.map(parse, args) if pool is not None else map(parse, args))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    symbols, lhs, rhs_offset, rhs, weight = merge(results)
+    return CompiledWCFG.from_tables(symbols, lhs, rhs_offset, rhs, apply_transform(weight, transform))
@@ -0,0 +1,447 @@
+"""
+CKY intersection of a grammar and a linear automaton, e.g. the automaton of a sentence (see `sentence.make_sentence`).
+
+The agenda-based engines (Nederhof, Earley) accept general automata and handle one item at a time.
+Here states are positions 0..n, every arc goes from i to i + 1, and the chart is a pair of dense boolean tables
+indexed by span and symbol which are filled one span at a time with vectorised (numpy) rule application:
+
+    - nonterminals: T[i, j, A] is True if the nonterminal A derives the span (i, j)
+    - prefixes: P[i, j, p] is True if the RHS prefix p derives the span (i, j)
+
+The grammar is binarised on the fly (see BinarisedGrammar): the RHS of every rule is a path in a trie of prefixes,
+a prefix of length m + 1 over (i, j) is a prefix of length m over (i, k) followed by a symbol over (k, j),
+and a complete prefix (the RHS of some rules) over (i, j) proves the LHS of those rules over (i, j).
+
+The forest is made of the original rules and it is built from the chart with array operations,
+it is the same forest as that of the agenda-based engines (see `agenda.get_cfg`):
+nonterminal nodes are keyed by (symbol, start, end) triples, terminal nodes by their (decoded) strings
+and the goal node by the goal string.
+
+:Authors: - Wilker Aziz
+"""
+
+import numpy as np
+from collections import defaultdict
+from hypergraph import Hypergraph
+
+
+def expand_segments(offset, ids):
+    """
+    Positions within the segments [offset[i], offset[i + 1]) of the given ids (concatenated) and the size of each segment.
+
+    >>> positions, sizes = expand_segments(np.array([0, 2, 2, 5]), np.array([2, 0]))
+    >>> positions.tolist(), sizes.tolist()
+    ([2, 3, 4, 0, 1], [3, 2])
+    """
+    first = offset[ids]
+    sizes = offset[ids + 1] - first
+    ends = np.cumsum(sizes)
+    total = ends[-1] if len(ends) else 0
+    return np.repeat(first - ends + sizes, sizes) + np.arange(total), sizes
+
+
+def span_levels(widths, heads, tail_offset, tails):
+    """
+    Topological levels of a forest whose nodes span automaton states (see `Hypergraph.node_levels`):
+    leaves are in level 0 and a node is one level above its highest child.
+    A child either spans fewer states than its parent or, through a unary rule, the same span,
+    thus nodes are leveled one width at a time and within a width the levels of unary chains are propagated
+    (there are as many passes as the longest unary chain, rather than a top-sort of the whole forest).
+
+    >>> # a (leaf), X over 1 state, Y -> X and S -> Y X over 2 states (edges: X -> a, Y -> X, S -> Y X)
+    >>> span_levels(np.array([-1, 1, 1, 2]), np.array([1, 2, 3]), np.array([0, 1, 2, 4]), np.array([0, 1, 2, 1])).tolist()
+    [0, 1, 2, 3]
+
+    :param widths: the number of states spanned by each node (leaves may have any width below their parents')
+    :param heads: the head of each edge
+    :param tail_offset: edge e has tail nodes tails[tail_offset[e]:tail_offset[e + 1]]
+    :param tails: tail nodes (flat)
+    """
+    levels = np.zeros(len(widths), dtype=np.int32)
+    if not len(heads):
+        return levels
+    # edges grouped by width and then by head, with their tails
+    order = np.lexsort((heads, widths[heads]))
+    heads = heads[order]
+    edge_widths = widths[heads]
+    positions, sizes = expand_segments(tail_offset, order)
+    children = tails[positions]
+    offset = np.concatenate(([0], np.cumsum(sizes)))
+    # edges with a child over the same span as their head (unary chains)
+    chained = np.logical_or.reduceat(widths[children] == np.repeat(edge_widths, sizes), offset[:-1])
+    first = 0
+    for last in np.searchsorted(edge_widths, np.unique(edge_widths), side='right').tolist():
+        # a pass over all edges of the width, then a pass per link of the longest unary chain
+        edges = np.arange(first, last)
+        nodes = children[offset[first]:offset[last]]
+        starts = offset[first:last] - offset[first]
+        for _ in xrange(last - first + 1):
+            edge_levels = np.maximum.reduceat(levels[nodes], starts) + 1
+            edge_heads = heads[edges]
+            head_starts = np.flatnonzero(np.concatenate(([True], edge_heads[1:] != edge_heads[:-1])))
+            edge_heads = edge_heads[head_starts]
+            updated = np.maximum(levels[edge_heads], np.maximum.reduceat(edge_levels, head_starts))
+            if (updated == levels[edge_heads]).all():
+                break
+            levels[edge_heads] = updated
+            # only edges over a unary chain may change
+            edges = edges[chained[edges]]
+            if not len(edges):
+                break
+            positions, sizes = expand_segments(offset, edges)
+            nodes, starts = children[positions], np.cumsum(sizes) - sizes
+        else:
+            raise ValueError('I cannot level a forest with unary cycles')
+        first = last
+    return levels
+
+
+class BinarisedGrammar(object):
+    """
+    Rules indexed by a trie of RHS prefixes (node 0 is the empty prefix) and stored in arrays.
+    Nonterminals and terminals are mapped to dense ids (each in its own range).
+
+    >>> from wcfg import WCFG
+    >>> from rule import Rule
+    >>> G = BinarisedGrammar(WCFG([Rule('[S]', ['[X]', '[X]', 'a'], 0.0), Rule('[S]', ['[X]', '[X]'], 0.0), Rule('[X]', ['a'], 0.0)]))
+    >>> G.n_nonterminals, G.n_terminals, G.n_nodes, G.depth.tolist()
+    (2, 1, 5, [0, 1, 2, 3, 1])
+    >>> [G.nonterminal(b) for b in G.rule_lhs[G.complete_rules[G.complete_offset[2]:G.complete_offset[3]]]]
+    ['[S]']
+    """
+
+    def __init__(self, wcfg):
+        self.wcfg = wcfg
+        self._nonterminals = []  # id -> nonterminal
+        self._nt_id = {}  # nonterminal -> id
+        self._terminals = []  # id -> terminal
+        self._t_id = {}  # terminal -> id
+        parent = [0]  # node -> the prefix it extends
+        label = [-1]  # node -> id of its last symbol
+        is_terminal = [False]  # node -> whether its last symbol is a terminal
+        child = {}  # (node, symbol) -> node
+        rule_node, rule_lhs, rule_log_prob = [], [], []
+        for rule in wcfg:
+            if not rule.rhs:
+                raise ValueError('I cannot intersect empty rules: %s' % rule)
+            node = 0
+            for sym in rule.rhs:
+                c = child.get((node, sym), None)
+                if c is None:
+                    c = len(parent)
+                    child[(node, sym)] = c
+                    parent.append(node)
+                    if wcfg.is_nonterminal(sym):
+                        label.append(self._intern(sym, self._nonterminals, self._nt_id))
+                        is_terminal.append(False)
+                    else:
+                        label.append(self._intern(sym, self._terminals, self._t_id))
+                        is_terminal.append(True)
+                node = c
+            rule_node.append(node)
+            rule_lhs.append(self._intern(rule.lhs, self._nonterminals, self._nt_id))
+            rule_log_prob.append(rule.log_prob)
+        N, M = len(self._nonterminals), len(parent)
+        self.n_nonterminals, self.n_terminals, self.n_nodes = N, len(self._terminals), M
+        self.parent = np.array(parent, dtype=np.int64)
+        self.label = np.array(label, dtype=np.int64)
+        self.is_terminal = np.array(is_terminal, dtype=bool)
+        self.depth = np.zeros(M, dtype=np.int64)  # length of the prefix
+        for node in xrange(1, M):  # parents are created before their children
+            self.depth[node] = self.depth[parent[node]] + 1
+        self.rule_node = np.array(rule_node, dtype=np.int64)
+        self.rule_lhs = np.array(rule_lhs, dtype=np.int64)
+        self.rule_log_prob = np.array(rule_log_prob, dtype=np.float64)
+        # rules by their RHS (a complete prefix)
+        self.complete_rules = np.argsort(self.rule_node, kind='mergesort')
+        self.complete_offset = np.concatenate(([0], np.cumsum(np.bincount(self.rule_node, minlength=M))))
+        # prefixes of length 1, i.e. the first symbol of a RHS (0 if no RHS starts with the symbol)
+        first = np.flatnonzero(self.depth == 1)
+        self.start_nt = np.zeros(N, dtype=np.int64)
+        self.start_nt[self.label[first[~self.is_terminal[first]]]] = first[~self.is_terminal[first]]
+        self.start_t = np.zeros(self.n_terminals, dtype=np.int64)
+        self.start_t[self.label[first[self.is_terminal[first]]]] = first[self.is_terminal[first]]
+        # longer prefixes grouped by their last symbol: (parent, node) pairs in CSR by nonterminal or terminal id
+        longer = np.flatnonzero(self.depth > 1)
+        self.extension_offset, self.extension_parent, self.extension_node = \
+            self._group(longer[~self.is_terminal[longer]], N)
+        self.extension_t_offset, self.extension_t_parent, self.extension_t_node = \
+            self._group(longer[self.is_terminal[longer]], self.n_terminals)
+
+    @staticmethod
+    def _intern(sym, symbols, ids):
+        i = ids.get(sym, None)
+        if i is None:
+            i = len(symbols)
+            symbols.append(sym)
+            ids[sym] = i
+        return i
+
+    def _group(self, nodes, n):
+        """Nodes grouped by the id of their last symbol: offset (by id), parents, nodes."""
+        nodes = nodes[np.argsort(self.label[nodes], kind='mergesort')]
+        offset = np.concatenate(([0], np.cumsum(np.bincount(self.label[nodes], minlength=n))))
+        return offset, self.parent[nodes], nodes
+
+    def nonterminal_id(self, sym, default=None):
+        """The id of a nonterminal (in the grammar's encoding)."""
+        return self._nt_id.get(sym, default)
+
+    def terminal_id(self, sym, default=None):
+        """The id of a terminal (in the grammar's encoding)."""
+        return self._t_id.get(sym, default)
+
+    def nonterminal(self, b):
+        return self._nonterminals[b]
+
+    def terminal(self, t):
+        return self._terminals[t]
+
+
+class CKY(object):
+    """
+    CKY intersection of a grammar and a linear automaton.
+
+    >>> from wcfg import WCFG
+    >>> from rule import Rule
+    >>> from wfsa import make_linear_fsa
+    >>> G = WCFG([Rule('[S]', ['[X]', '[X]'], 0.0), Rule('[X]', ['[X]', '[X]'], -1.0), Rule('[X]', ['a'], -1.0),
+    ...           Rule('[X]', ['[X]', 'b', '[X]'], -1.0)])
+    >>> forest = CKY(G, make_linear_fsa('a a a')).do('[S]', '[GOAL]')
+    >>> sorted(' '.join(forest.label(child) for child in forest.tail(e)) for e in forest.incoming(forest.fetch(('[S]', 0, 3))))
+    ['[X,0-1] [X,1-3]', '[X,0-2] [X,2-3]']
+    >>> from earley import Earley
+    >>> for sentence in ['a a a', 'a b a a']:
+    ...     print sorted(str(CKY(G, make_linear_fsa(sentence)).do('[S]', '[GOAL]')).split('\\n')) == \\
+    ...         sorted(str(Earley(G, make_linear_fsa(sentence)).do('[S]', '[GOAL]')).split('\\n'))
+    True
+    True
+    >>> len(CKY(G, make_linear_fsa('a')).do('[S]', '[GOAL]'))
+    0
+    """
+
+    def __init__(self, wcfg, wfsa, grammar=None):
+        """
+        :param wcfg: the grammar
+        :param wfsa: an automaton whose states are 0..n and whose arcs go from i to i + 1
+        :param grammar: a BinarisedGrammar for `wcfg` (built if not given, share it across parsers of the same grammar)
+        """
+        self._wcfg = wcfg
+        self._wfsa = wcfg.encode_fsa(wfsa)
+        self._grammar = G = BinarisedGrammar(wcfg) if grammar is None else grammar
+        self._n = n = max(self._wfsa.n_states() - 1, 0)
+        self._words = defaultdict(list)  # i -> ids of the terminals over (i, i + 1), unknown terminals are dropped
+        for sfrom, sto, sym, w in self._wfsa.iterarcs():
+            if sto != sfrom + 1:
+                raise ValueError('I can only intersect linear automata (arcs go from i to i + 1): arc %s -> %s' % (sfrom, sto))
+            t = G.terminal_id(sym)
+            if t is not None:
+                self._words[sfrom].append(t)
+        self._T = np.zeros((n + 1, n + 1, G.n_nonterminals), dtype=bool)
+        self._P = np.zeros((n + 1, n + 1, G.n_nodes), dtype=bool)
+        self._proved = {}  # (start, end) -> ids of the rules proved over the span
+
+    def admit(self, rules, start, end):
+        """
+        Decides which rules (ids) whose RHS derives a span may prove their LHS over the span.
+        :returns: a boolean mask (here every rule is admitted)
+        """
+        return np.ones(len(rules), dtype=bool)
+
+    def _span(self, i, j):
+        """Fills the tables of a span whose subspans are complete."""
+        G = self._grammar
+        T, P = self._T, self._P
+        p = P[i, j]
+        if j - i == 1:
+            nodes = G.start_t[self._words[i]]
+            p[nodes[nodes > 0]] = True
+        else:
+            # prefixes over (i, k) followed by nonterminals over (k, j), all splits at once
+            ks, nts = np.nonzero(T[i + 1:j, j])
+            if len(ks):
+                e, sizes = expand_segments(G.extension_offset, nts)
+                proved = P[i, np.repeat(ks + i + 1, sizes), G.extension_parent[e]]
+                p[G.extension_node[e[proved]]] = True
+            # prefixes over (i, j - 1) followed by a terminal
+            if self._words[j - 1]:
+                e, _ = expand_segments(G.extension_t_offset, np.array(self._words[j - 1]))
+                p[G.extension_t_node[e[P[i, j - 1, G.extension_t_parent[e]]]]] = True
+        # complete prefixes prove nonterminals which in turn may start prefixes over the same span (unary rules)
+        t = T[i, j]
+        proved = []
+        new = np.flatnonzero(p)
+        while len(new):
+            r, _ = expand_segments(G.complete_offset, new)
+            rules = G.complete_rules[r]
+            rules = rules[self.admit(rules, i, j)]
+            proved.append(rules)
+            lhs = G.rule_lhs[rules]
+            lhs = np.unique(lhs[~t[lhs]])
+            t[lhs] = True
+            new = G.start_nt[lhs]
+            new = new[new > 0]
+            new = new[~p[new]]
+            p[new] = True
+        if proved:
+            self._proved[(i, j)] = np.concatenate(proved)
+
+    def inference(self):
+        """Fills the chart bottom-up, spans ending in j are visited from the shortest to the longest."""
+        for j in xrange(1, self._n + 1):
+            for i in xrange(j - 1, -1, -1):
+                self._span(i, j)
+
+    def derives(self, sym, start, end):
+        """Whether a nonterminal (in the grammar's encoding) derives a span."""
+        b = self._grammar.nonterminal_id(sym)
+        return b is not None and bool(self._T[start, end, b])
+
+    def _split_points(self, start, end, parent, label, is_terminal, rows=1 << 16):
+        """
+        Where the last symbol of prefixes begins: for each prefix (its parent prefix and its last symbol) over a span,
+        the states k such that the parent derives (start, k) and the last symbol derives (k, end).
+        :param rows: prefixes are processed in chunks of this size (each takes a row of n + 1 states)
+        :returns: pairs (prefix, k) as two vectors
+        """
+        T, P = self._T, self._P
+        states = np.arange(self._n + 1)
+        found, splits = [], []
+        # nonterminals: any k in (start, end)
+        nt = np.flatnonzero(~is_terminal)
+        for first in xrange(0, len(nt), rows):
+            x = nt[first:first + rows]
+            i, e = start[x, None], end[x, None]
+            mask = (states > i) & (states < e) & P[i, states, parent[x, None]] & T[states, e, label[x, None]]
+            row, k = np.nonzero(mask)
+            found.append(x[row])
+            splits.append(k)
+        # terminals: k = end - 1
+        x = np.flatnonzero(is_terminal)
+        if len(x):
+            k = end[x] - 1
+            words = np.array([i * self._grammar.n_terminals + t for i, ts in self._words.iteritems() for t in ts], dtype=np.int64)
+            ok = (k > start[x]) & P[start[x], k, parent[x]] & np.in1d(k * self._grammar.n_terminals + label[x], words)
+            found.append(x[ok])
+            splits.append(k[ok])
+        return np.concatenate(found), np.concatenate(splits)
+
+    def _edges(self):
+        """
+        Every edge in the chart, including edges that cannot be reached from the root.
+        Nodes are integer codes: a nonterminal b over (i, j) is (i * (n + 1) + j) * N + b
+        and a terminal t is (n + 1)^2 * N + t.
+        :returns: list of triples (rule ids, head codes, tail codes), one per rule arity (tails are a matrix)
+        """
+        G = self._grammar
+        N, width = G.n_nonterminals, self._n + 1
+        terminal_base = width * width * N
+        spans = sorted(self._proved)
+        sizes = [len(self._proved[span]) for span in spans]
+        rules = np.concatenate([self._proved[span] for span in spans])
+        starts = np.repeat([i for i, j in spans], sizes)
+        ends = np.repeat([j for i, j in spans], sizes)
+        arity = G.depth[G.rule_node[rules]]
+        groups = []
+        for m in np.unique(arity).tolist():
+            x = np.flatnonzero(arity == m)
+            r, i, e = rules[x], starts[x], ends[x]
+            head = (i * width + e) * N + G.rule_lhs[r]
+            node = G.rule_node[r]
+            tails = np.zeros((len(r), m), dtype=np.int64)
+            # the RHS from right to left: the last symbol of a prefix over (i, e) begins at some split k
+            for d in xrange(m - 1, -1, -1):
+                parent, label, is_terminal = G.parent[node], G.label[node], G.is_terminal[node]
+                if d == 0:
+                    k = i
+                else:
+                    x, k = self._split_points(i, e, parent, label, is_terminal)
+                    r, i, e, head, node, tails = r[x], i[x], e[x], head[x], node[x], tails[x]
+                    parent, label, is_terminal = parent[x], label[x], is_terminal[x]
+                tails[:, d] = np.where(is_terminal, terminal_base + label, (k * width + e) * N + label)
+                node, e = parent, k
+            groups.append((r, head, tails))
+        return groups
+
+    def get_forest(self, goal, root):
+        """
+        Builds the forest of the derivations of the root from an initial state to a final state.
+        The root is given in the grammar's own encoding (see `wcfg.encode`), the goal is a string.
+        """
+        G = self._grammar
+        N, width = G.n_nonterminals, self._n + 1
+        terminal_base = width * width * N
+        b = G.nonterminal_id(root)
+        tops = [(start * width + end) * N + b for start in self._wfsa.iterinitial() for end in self._wfsa.iterfinal()
+                if start < end and self.derives(root, start, end)]
+        if not tops:
+            return Hypergraph([], [], [0], [], [], self._wcfg.decode)
+        groups = self._edges()
+        rules = np.concatenate([r for r, _, _ in groups])
+        heads = np.concatenate([head for _, head, _ in groups])
+        tails = np.concatenate([rhs.ravel() for _, _, rhs in groups])
+        arity = np.concatenate([np.repeat(rhs.shape[1], len(r)) for r, _, rhs in groups])
+        tail_offset = np.concatenate(([0], np.cumsum(arity)))
+        # top-down reachability from the root (node codes index dense vectors, thus nothing is hashed)
+        n_codes = terminal_base + G.n_terminals
+        order = np.argsort(heads, kind='mergesort')
+        offset = np.concatenate(([0], np.cumsum(np.bincount(heads, minlength=n_codes))))
+        reached = np.zeros(n_codes, dtype=bool)
+        frontier = np.array(tops, dtype=np.int64)
+        reached[frontier] = True
+        while len(frontier):
+            edges, _ = expand_segments(offset, frontier)
+            children, _ = expand_segments(tail_offset, order[edges])
+            children = tails[children]
+            frontier = np.unique(children[~reached[children]])
+            reached[frontier] = True
+        # reachable edges (grouped by head) and nodes, the goal node comes last
+        keep = order[reached[heads[order]]]
+        nodes = np.flatnonzero(reached)
+        new_id = np.cumsum(reached) - 1
+        positions, sizes = expand_segments(tail_offset, keep)
+        keys = []
+        for code in nodes.tolist():
+            if code < terminal_base:
+                span, sym = divmod(code, N)
+                keys.append((G.nonterminal(sym),) + divmod(span, width))
+            else:
+                keys.append(self._wcfg.decode(G.terminal(code - terminal_base)))
+        keys.append(goal)
+        heads = np.concatenate((new_id[heads[keep]], np.repeat(len(nodes), len(tops))))
+        tail_offset = np.concatenate(([0], np.cumsum(np.concatenate((sizes, np.ones(len(tops), dtype=np.int64))))))
+        tails = np.concatenate((new_id[tails[positions]], new_id[tops]))
+        # the chart knows the span of every node, thus levels come without a top-sort (terminals and the goal are
+        # given widths below and above every span)
+        spans = nodes // N
+        widths = np.concatenate((np.where(nodes < terminal_base, spans % width - spans // width, -1), [width]))
+        return Hypergraph(keys, heads, tail_offset, tails,
+                          np.concatenate((G.rule_log_prob[rules[keep]], np.zeros(len(tops)))),
+                          self._wcfg.decode,
+                          node_levels=span_levels(widths, heads, tail_offset, tails))
+
+    def do(self, root='[S]', goal='[GOAL]'):
+        """Runs the program and returns the intersected CFG"""
+        self.inference()
+        return self.get_forest(goal, self._wcfg.encode(root))
+
+
+class SlicedCKY(CKY):
+    """
+    CKY intersection where a rule proves its LHS over a span only if its log probability
+    is above the slice variable of the LHS over the span (as in SlicedNederhof).
+    """
+
+    def __init__(self, wcfg, wfsa, slice_vars, grammar=None):
+        """
+        :param slice_vars: a SliceVariable
+        :param grammar: a BinarisedGrammar for `wcfg` (built if not given, share it across iterations)
+        """
+        CKY.__init__(self, wcfg, wfsa, grammar)
+        self.slice_vars = slice_vars
+
+    def admit(self, rules, start, end):
+        G = self._grammar
+        ids, inverse = np.unique(G.rule_lhs[rules], return_inverse=True)
+        u = np.array([self.slice_vars.get(G.nonterminal(b), start, end) for b in ids.tolist()], dtype=float)
+        return G.rule_log_prob[rules] > u[inverse]
@@ -0,0 +1,346 @@
+"""
+A WCFG compiled to dense integer symbols and array-backed rule tables.
+
+Every terminal and nonterminal is interned to an integer id and the terminal/nonterminal distinction is
+stored in a flag array, thus the parsers no longer hash, compare or index into strings in their inner loops.
+Rules are stored column-wise: LHS ids, RHS ids (flat, delimited by offsets) and log probabilities.
+
+A compiled grammar can be saved to a binary file which is later memory-mapped (see `save` and `load`),
+in which case the tables are read-only numpy views of the mapped pages.
+
+:Authors: - Wilker Aziz
+"""
+
+import mmap
+import os
+import numpy as np
+from array import array
+from symbol import is_terminal
+from rule import Rule, InternedRule
+from wfsa import WDFSA
+
+
+class SymbolTable(object):
+    """
+    Maps symbols to dense integer ids (in order of first occurrence) and remembers which ids are terminals.
+
+    >>> table = SymbolTable(['[S]', 'dog'])
+    >>> table.encode('[S]'), table.encode('dog'), table.encode('[NP]')
+    (0, 1, 2)
+    >>> table.is_terminal(1), table.is_nonterminal(2)
+    (True, True)
+    >>> table.decode(2)
+    '[NP]'
+    """
+
+    def __init__(self, symbols=[], flags=None):
+        """
+        :param symbols: symbols in order of id
+        :param flags: optionally, their terminal flags (otherwise they are worked out from the symbols)
+        """
+        self._symbols = []  # id -> symbol
+        self._ids = {}  # symbol -> id
+        self._terminal = bytearray()  # id -> 1 if terminal else 0
+        if flags is not None:
+            self._symbols.extend(symbols)
+            self._ids.update((sym, sid) for sid, sym in enumerate(self._symbols))
+            self._terminal.extend(flags)
+        else:
+            for sym in symbols:
+                self.encode(sym)
+
+    def __len__(self):
+        return len(self._symbols)
+
+    def __contains__(self, symbol):
+        return symbol in self._ids
+
+    def __iter__(self):
+        return iter(self._symbols)
+
+    def encode(self, symbol):
+        """Returns the id of a symbol (interning it if necessary)."""
+        sid = self._ids.get(symbol, None)
+        if sid is None:
+            sid = len(self._symbols)
+            self._symbols.append(symbol)
+            self._ids[symbol] = sid
+            self._terminal.append(1 if is_terminal(symbol) else 0)
+        return sid
+
+    @property
+    def flags(self):
+        """Terminal flags indexed by id."""
+        return self._terminal
+
+    def get(self, symbol, default=None):
+        """Returns the id of a symbol without interning it."""
+        return self._ids.get(symbol, default)
+
+    def decode(self, sid):
+        """Returns the symbol associated with an id."""
+        return self._symbols[sid]
+
+    def is_terminal(self, sid):
+        return self._terminal[sid] == 1
+
+    def is_nonterminal(self, sid):
+        return self._terminal[sid] == 0
+
+
+class CompiledWCFG(object):
+    """
+    A WCFG whose symbols are integer ids.
+
+    It exposes the same interface as `wcfg.WCFG` (rules are `Rule` objects whose LHS and RHS are ids),
+    thus the intersection algorithms run on either of them.
+    The tables are the actual storage, `Rule` views are created once per rule and on demand.
+
+    >>> from rule import Rule
+    >>> G = CompiledWCFG([Rule('[S]', ['[X]'], 0.0), Rule('[X]', ['a'], -1.0), Rule('[X]', ['[X]', '[X]'], -2.0)])
+    >>> len(G), len(G.symbols)
+    (3, 3)
+    >>> X = G.encode('[X]')
+    >>> [G.decode_rule(r) for r in G.get(X)]
+    [[X] -> a (-1.0), [X] -> [X] [X] (-2.0)]
+    >>> G.is_terminal(G.encode('a')), G.can_rewrite(G.encode('a'))
+    (True, False)
+    >>> sorted(G.terminals)
+    ['a']
+    """
+
+    def __init__(self, rules=[], symbols=None):
+        """
+        :param rules: rules whose symbols are strings (e.g. a `wcfg.WCFG`)
+        :param symbols: optionally, a `SymbolTable` shared with other grammars
+        """
+        self._symbols = SymbolTable() if symbols is None else symbols
+        # rule tables
+        self._lhs = array('i')  # rule id -> LHS id
+        self._rhs_offset = array('i', [0])  # RHS of rule r is _rhs[_rhs_offset[r]:_rhs_offset[r + 1]]
+        self._rhs = array('i')  # flat RHS ids
+        self._log_prob = array('d')  # rule id -> log probability
+        self._rules_by_lhs = {}  # LHS id -> rule ids
+        self._views = []  # rule id -> Rule (or None if it has not been requested yet)
+        self._views_by_lhs = {}  # LHS id -> list of Rule views
+        self._terminals = None  # string terminals (computed on demand)
+        for rule in rules:
+            self.add(rule)
+
+    @property
+    def symbols(self):
+        return self._symbols
+
+    def add(self, rule):
+        """Compiles and stores a rule whose symbols are strings, returns its compiled view."""
+        encode = self._symbols.encode
+        return self.rule(self._append(encode(rule.lhs), [encode(sym) for sym in rule.rhs], rule.log_prob))
+
+    def update(self, rules):
+        for rule in rules:
+            self.add(rule)
+
+    def _append(self, lhs, rhs, log_prob):
+        if not isinstance(self._lhs, array):  # mapped tables are read-only
+            self._thaw()
+        rid = len(self._lhs)
+        self._lhs.append(lhs)
+        self._rhs.extend(rhs)
+        self._rhs_offset.append(len(self._rhs))
+        self._log_prob.append(log_prob)
+        rids = self._rules_by_lhs.get(lhs, None)
+        if rids is None:
+            self._rules_by_lhs[lhs] = [rid]
+        elif isinstance(rids, list):
+            rids.append(rid)
+        else:  # a view of a mapped table
+            self._rules_by_lhs[lhs] = rids.tolist() + [rid]
+        self._views.append(None)
+        self._views_by_lhs.pop(lhs, None)
+        if self._terminals is not None:
+            self._terminals.update(self._symbols.decode(s) for s in rhs if self._symbols.is_terminal(s))
+        return rid
+
+    def rule(self, rid):
+        """Returns the `Rule` view of a rule id (views are interned, thus compared by identity)."""
+        r = self._views[rid]
+        if r is None:
+            r = InternedRule(int(self._lhs[rid]),
+                             self._rhs[self._rhs_offset[rid]:self._rhs_offset[rid + 1]].tolist(),
+                             float(self._log_prob[rid]))
+            self._views[rid] = r
+        return r
+
+    def lhs(self, rid):
+        return int(self._lhs[rid])
+
+    def rhs(self, rid):
+        return tuple(self._rhs[self._rhs_offset[rid]:self._rhs_offset[rid + 1]].tolist())
+
+    def log_prob(self, rid):
+        return float(self._log_prob[rid])
+
+    @property
+    def nonterminals(self):
+        is_nonterminal = self._symbols.is_nonterminal
+        return frozenset(s for s in set(self._lhs.tolist()).union(self._rhs.tolist()) if is_nonterminal(s))
+
+    @property
+    def terminals(self):
+        """Set of terminals (as strings), handy for lexicon lookups."""
+        if self._terminals is None:
+            decode = self._symbols.decode
+            is_terminal = self._symbols.is_terminal
+            self._terminals = set(decode(s) for s in set(self._rhs.tolist()) if is_terminal(s))
+        return self._terminals
+
+    def __len__(self):
+        return len(self._lhs)
+
+    def __getitem__(self, lhs):
+        return self.get(lhs)
+
+    def get(self, lhs, default=frozenset()):
+        rules = self._views_by_lhs.get(lhs, None)
+        if rules is None:
+            rids = self._rules_by_lhs.get(lhs, None)
+            if rids is None:
+                return default
+            rules = [self.rule(rid) for rid in rids]
+            self._views_by_lhs[lhs] = rules
+        return rules
+
+    def can_rewrite(self, lhs):
+        return lhs in self._rules_by_lhs
+
+    def __iter__(self):
+        return (self.rule(rid) for rid in xrange(len(self._lhs)))
+
+    def iteritems(self):
+        return ((lhs, self.get(lhs)) for lhs in self._rules_by_lhs.iterkeys())
+
+    def is_terminal(self, sym):
+        return self._symbols.is_terminal(sym)
+
+    def is_nonterminal(self, sym):
+        return self._symbols.is_nonterminal(sym)
+
+    def encode(self, symbol):
+        return self._symbols.encode(symbol)
+
+    def decode(self, sym):
+        return self._symbols.decode(sym)
+
+    def encode_rule(self, rule):
+        """Returns a `Rule` whose symbols are ids (the rule is not added to the grammar)."""
+        encode = self._symbols.encode
+        return Rule(encode(rule.lhs), [encode(s) for s in rule.rhs], rule.log_prob)
+
+    def decode_rule(self, rule):
+        """Returns a `Rule` whose symbols are strings."""
+        decode = self._symbols.decode
+        return Rule(decode(rule.lhs), [decode(s) for s in rule.rhs], rule.log_prob)
+
+    def encode_fsa(self, wfsa):
+        """Returns a copy of the automaton whose labels are symbol ids."""
+        fsa = WDFSA()
+        for sfrom, sto, sym, w in wfsa.iterarcs():
+            fsa.add_arc(sfrom, sto, self._symbols.encode(sym), w)
+        for state in wfsa.iterinitial():
+            fsa.make_initial(state)
+        for state in wfsa.iterfinal():
+            fsa.make_final(state)
+        return fsa
+
+    def __str__(self):
+        return '\n'.join(str(self.decode_rule(r)) for r in self)
+
+    def _thaw(self):
+        """Replaces mapped (read-only) tables by in-memory copies."""
+        self._lhs = array('i', self._lhs.tolist())
+        self._rhs_offset = array('i', self._rhs_offset.tolist())
+        self._rhs = array('i', self._rhs.tolist())
+        self._log_prob = array('d', self._log_prob.tolist())
+
+    def save(self, path):
+        """
+        Writes the compiled grammar to a binary file which can be memory-mapped by `CompiledWCFG.load`.
+        The file is written to a temporary location and then renamed, thus readers never see partial files.
+        """
+        lhs = np.asarray(self._lhs, dtype=np.int32)
+        lhs_order, lhs_index = _index_by_lhs(lhs, len(self._symbols))
+        sections = [np.frombuffer(bytes(self._symbols.flags), dtype=np.uint8),
+                    lhs,
+                    np.asarray(self._rhs_offset, dtype=np.int32),
+                    np.asarray(self._rhs, dtype=np.int32),
+                    np.asarray(self._log_prob, dtype=np.float64),
+                    lhs_index,
+                    lhs_order,
+                    np.frombuffer('\n'.join(self._symbols), dtype=np.uint8)]
+        tmp = '%s.tmp%d' % (path, os.getpid())
+        with open(tmp, 'wb') as fo:
+            fo.write(_MAGIC)
+            fo.write(np.array([len(section) for section in sections], dtype=np.int64).tobytes())
+            for section in sections:
+                fo.write(section.tobytes())
+                fo.write('\0' * _padding(section.nbytes))
+        os.rename(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """Memory-maps a grammar written by `CompiledWCFG.save` (pages are shared among processes)."""
+        with open(path, 'rb') as fi:
+            buf = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+        if buf[:len(_MAGIC)] != _MAGIC:
+            raise ValueError('Not a compiled grammar: %s' % path)
+        offset = len(_MAGIC)
+        sizes = np.frombuffer(buf, dtype=np.int64, count=len(_SECTIONS), offset=offset)
+        offset += sizes.nbytes
+        tables = []
+        for n, dtype in zip(sizes, _SECTIONS):
+            table = np.frombuffer(buf, dtype=dtype, count=n, offset=offset)
+            offset += table.nbytes + _padding(table.nbytes)
+            tables.append(table)
+        flags, lhs, rhs_offset, rhs, log_prob, lhs_index, lhs_order, symbols = tables
+        G = cls(symbols=SymbolTable(symbols.tobytes().split('\n') if len(flags) else [], flags))
+        G._set_tables(lhs, rhs_offset, rhs, log_prob, lhs_order, lhs_index)
+        G._mmap = buf
+        return G
+
+    @classmethod
+    def from_tables(cls, symbols, lhs, rhs_offset, rhs, log_prob):
+        """
+        Builds a grammar from numpy rule tables whose ids refer to a given `SymbolTable`.
+        The tables are not copied, thus they are treated as read-only (just like mapped ones).
+        """
+        G = cls(symbols=symbols)
+        G._set_tables(lhs, rhs_offset, rhs, log_prob, *_index_by_lhs(lhs, len(symbols)))
+        return G
+
+    def _set_tables(self, lhs, rhs_offset, rhs, log_prob, lhs_order, lhs_index):
+        self._lhs, self._rhs_offset, self._rhs, self._log_prob = lhs, rhs_offset, rhs, log_prob
+        self._rules_by_lhs = {sid: lhs_order[lhs_index[sid]:lhs_index[sid + 1]]
+                              for sid in np.flatnonzero(lhs_index[1:] - lhs_index[:-1]).tolist()}
+        self._views = [None] * len(lhs)
+        self._views_by_lhs = {}
+        self._terminals = None
+
+
+_MAGIC = b'CWCFG\x00\x01\n'
+_SECTIONS = [np.uint8, np.int32, np.int32, np.int32, np.float64, np.int32, np.int32, np.uint8]
+
+
+def _index_by_lhs(lhs, n_symbols):
+    """
+    Groups rule ids by LHS: rules rewriting `sid` are lhs_order[lhs_index[sid]:lhs_index[sid + 1]].
+    :returns: lhs_order, lhs_index
+    """
+    lhs_order = np.argsort(lhs, kind='mergesort').astype(np.int32)
+    lhs_index = np.zeros(n_symbols + 1, dtype=np.int32)
+    np.cumsum(np.bincount(lhs, minlength=n_symbols), out=lhs_index[1:])
+    return lhs_order, lhs_index
+
+
+def _padding(nbytes):
+    """Sections are 8-byte aligned."""
+    return -nbytes % 8
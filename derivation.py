@@ -0,0 +1,113 @@
+"""
+Compact derivations and their online aggregation.
+
+A derivation is a sequence of edge ids in the canonical order in which the samplers produce it
+(top-down, see GeneralisedSampling.sample), it is stored as the bytes of an int32 array,
+which is both its canonical hash key and a compact copy of it.
+Samples are aggregated as they are drawn, thus memory grows with the number of distinct derivations.
+
+:Authors: - Wilker Aziz
+"""
+
+from array import array
+from collections import defaultdict
+from heapq import nlargest
+from operator import itemgetter
+
+
+def encode_derivation(d):
+    """
+    Returns the canonical (compact) key of a sequence of edge ids.
+
+    >>> decode_derivation(encode_derivation([3, 0, 2]))
+    (3, 0, 2)
+    """
+    return array('i', d).tostring()
+
+
+def decode_derivation(key):
+    """Returns the tuple of edge ids of an encoded derivation."""
+    d = array('i')
+    d.fromstring(key)
+    return tuple(d)
+
+
+class DerivationCounter(object):
+    """
+    Counts derivations online.
+
+    >>> counter = DerivationCounter()
+    >>> counter.add([0, 2, 1]); counter.add([0, 3]); counter.add((0, 2, 1))
+    >>> counter.update([((0, 3), 5)])
+    >>> len(counter), counter.total, counter.most_common()
+    (2, 8, [((0, 3), 6), ((0, 2, 1), 2)])
+    """
+
+    def __init__(self):
+        self._counts = defaultdict(int)
+        self._total = 0
+
+    def __len__(self):
+        """Number of distinct derivations."""
+        return len(self._counts)
+
+    @property
+    def total(self):
+        """Number of samples."""
+        return self._total
+
+    def add(self, d, count=1):
+        """Counts a derivation (a sequence of edge ids)."""
+        self._counts[encode_derivation(d)] += count
+        self._total += count
+
+    def update(self, counts):
+        """Counts pairs of derivation and count (e.g. from GeneralisedSampling.sample_counts)."""
+        for d, n in counts:
+            self.add(d, n)
+
+    def most_common(self, n=None):
+        """List of pairs (derivation, count) from the most common derivation to the least, or the n most common."""
+        items = self._counts.iteritems()
+        items = sorted(items, key=itemgetter(1), reverse=True) if n is None else nlargest(n, items, key=itemgetter(1))
+        return [(decode_derivation(key), count) for key, count in items]
+
+
+class EdgeTable(object):
+    """
+    Interns edges (rules over node keys) so that derivations drawn from different forests,
+    e.g. across iterations of slice sampling, share edge ids.
+
+    >>> from rule import Rule
+    >>> table = EdgeTable()
+    >>> table.encode([Rule(('[S]', 0, 1), ['a'], 0.0), Rule('[GOAL]', [('[S]', 0, 1)], 0.0)])
+    [0, 1]
+    >>> table.encode([Rule(('[S]', 0, 1), ['a'], 0.0)]), table[1]
+    ([0], [GOAL] -> ('[S]', 0, 1) (0.0))
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self._rules = []
+
+    def __len__(self):
+        return len(self._rules)
+
+    def __getitem__(self, eid):
+        return self._rules[eid]
+
+    def encode(self, rules):
+        """Returns the ids of a sequence of rules (interning them if necessary)."""
+        ids = []
+        for rule in rules:
+            eid = self._ids.get(rule, None)
+            if eid is None:
+                eid = len(self._rules)
+                self._rules.append(rule)
+                self._ids[rule] = eid
+            ids.append(eid)
+        return ids
+
+    def decode(self, ids):
+        """Returns the rules of a sequence of ids."""
+        return [self._rules[eid] for eid in ids]
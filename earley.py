@@ -3,34 +3,57 @@
 """
 
 EMPTY_SET = frozenset()
-from agenda import Agenda, ActiveQueue
+from functools import partial
+from agenda import Agenda, ActiveQueue, PriorityQueue, get_cfg
+from best_first import ItemPriority
 from item import ItemFactory
-from symbol import is_terminal, make_symbol, is_nonterminal
-from rule import Rule
-from wcfg import WCFG
-import itertools
+from grammar_index import GrammarIndex
+from collections import defaultdict
 
 
 class Earley(object):
     """
     """
 
-    def __init__(self, wcfg, wfsa):
+    def __init__(self, wcfg, wfsa, index=None, item_factory=None, viable=None,
+                 best_first=False, heuristic=None, stop_early=False):
         """
+        :param index: a GrammarIndex for `wcfg` (built if not given, share it across parsers of the same grammar)
+        :param item_factory: an ItemFactory (created if not given, clear it before reusing it for another parse)
+        :param viable: a ViableSet (see recogniser.py), if given, nonterminals over spans outside it are skipped
+        :param best_first: pops active items by their inside score (see best_first.py)
+        :param heuristic: an outside estimate added to the inside score of items (e.g. best_first.OutsideEstimates), i.e. A*
+        :param stop_early: stops as soon as the root is proven over the automaton (best-first or A* only),
+            the forest then contains the best derivation (and those found so far)
         """
 
         self._wcfg = wcfg
-        self._wfsa = wfsa
-        self._agenda = Agenda(active_container_type=ActiveQueue)
+        self._wfsa = wcfg.encode_fsa(wfsa)
+        self._index = GrammarIndex(wcfg) if index is None else index
+        self._priority = ItemPriority(heuristic) if best_first or heuristic is not None else None
+        if stop_early and self._priority is None:
+            raise ValueError('I can only stop early with a best-first or A* agenda')
+        self._stop_early = stop_early
+        self._agenda = Agenda(active_container_type=ActiveQueue if self._priority is None else partial(PriorityQueue, self._priority))
         self._predictions = set()  # (LHS, start)
-        self._item_factory = ItemFactory()
+        self._item_factory = ItemFactory() if item_factory is None else item_factory
+        self._viable_set = viable
+        # left-corner filter: symbols which may start a constituent from a given state
+        self._viable = defaultdict(set)
+        for sfrom, sto, sym, w in self._wfsa.iterarcs():
+            self._viable[sfrom].add(sym)
+            self._viable[sfrom].update(self._index.left_corner_ancestors(sym))
 
     def get_item(self, rule, dot, inner=[]):
         return self._item_factory.get_item(rule, dot, inner)
 
     def advance(self, item, dot):
         """returns a new item whose dot has been advanced"""
-        return self.get_item(item.rule, dot, item.inner + (item.dot,))
+        return self._item_factory.advance(item, dot)
+
+    def is_viable(self, item):
+        """Whether the LHS of a complete item takes part in some parse over the item's span."""
+        return self._viable_set is None or (item.rule.lhs, item.start, item.dot) in self._viable_set
 
     def axioms(self, symbol, start):
         rules = self._wcfg.get(symbol, None)
@@ -40,9 +63,20 @@ class Earley(object):
             return True
         # otherwise add rewritings to the agenda
         self._predictions.add((symbol, start))
-        self._agenda.extend(self.get_item(rule, start) for rule in rules)
+        self._agenda.extend(self.get_item(rule, start) for rule in self.viable_rules(rules, start))
         return True
 
+    def viable_rules(self, rules, start):
+        """
+        Rules whose first RHS symbol can start a constituent from a given state (left-corner filter)
+        and, given a ViableSet, whose LHS takes part in some parse from that state.
+        """
+        viable = self._viable.get(start, EMPTY_SET)
+        if self._viable_set is not None:
+            can_start = self._viable_set.can_start
+            return [rule for rule in rules if rule.rhs[0] in viable and can_start(rule.lhs, start)]
+        return [rule for rule in rules if rule.rhs[0] in viable]
+
     def prediction(self, item):
         """
         This operation tris to create items from the rules associated with the nonterminal ahead of the dot.
@@ -51,7 +85,7 @@ class Earley(object):
         if (item.next, item.dot) in self._predictions:  # prediction already happened
             return False
         self._predictions.add((item.next, item.dot))
-        new_items = [self.get_item(rule, item.dot) for rule in self._wcfg.get(item.next, frozenset())]
+        new_items = [self.get_item(rule, item.dot) for rule in self.viable_rules(self._wcfg.get(item.next, EMPTY_SET), item.dot)]
         self._agenda.extend(new_items)
         return True
 
@@ -62,6 +96,7 @@ class Earley(object):
         If we get to a nondeterminism, we stop scanning and add the relevant items to the agenda.
         """
         states = [item.dot]
+        is_terminal = self._wcfg.is_terminal
         for sym in item.nextsymbols():
             if is_terminal(sym):
                 arcs = self._wfsa.get_arcs(origin=states[-1], symbol=sym)
@@ -110,19 +145,28 @@ class Earley(object):
 
         # start items of the kind
         # GOAL -> * ROOT, where * is an intial state of the wfsa
+        symbol, root = root, wcfg.encode(root)
         if not any(self.axioms(root, start) for start in wfsa.iterinitial()):
-            raise ValueError('No rule for the start symbol %s' % root)
+            raise ValueError('No rule for the start symbol %s' % symbol)
         new_roots = set()
+        priority = self._priority
 
         while agenda:
             item = agenda.pop()  # always returns an active item
 
             if item.is_complete():
+                if not self.is_viable(item):  # the symbol takes no part in any parse
+                    agenda.discard(item)
+                    continue
+                if priority is not None:  # in best-first order the first proof of a symbol is its best
+                    priority.prove(item.rule.lhs, item.start, item.dot, priority.inside(item))
                 # complete root item spanning from a start wfsa state to a final wfsa state
                 if item.rule.lhs == root and wfsa.is_initial(item.start) and wfsa.is_final(item.dot):
                     agenda.make_complete(item)
                     new_roots.add((root, item.start, item.dot))
                     agenda.make_passive(item)
+                    if self._stop_early:
+                        break
                 else:
                     if self.complete_others(item):
                         agenda.make_complete(item)
@@ -130,12 +174,12 @@ class Earley(object):
                     else:  # a complete state is only kept in case it could potentially complete others
                         agenda.discard(item)
             else:
-                if is_terminal(item.next):
+                if wcfg.is_terminal(item.next):
                     # fire the operation 'scan'
                     self.scan(item)
                     agenda.discard(item)  # scanning renders incomplete items of this kind useless
                 else:
-                    if not wcfg.can_rewrite(item.next):  # if the NT does not exist this item is useless
+                    if not self._index.can_rewrite(item.next):  # if the NT does not exist this item is useless
                         agenda.discard(item)
                     else:
                         if not self.prediction(item):  # try to predict, otherwise try to complete itself
@@ -144,46 +188,8 @@ class Earley(object):
         # converts complete items into rules
         return self.get_cfg(goal, root)
 
-    def get_intersected_rule(self, item):
-        lhs = make_symbol(item.rule.lhs, item.start, item.dot)
-        positions = item.inner + (item.dot,)
-        rhs = [make_symbol(sym, positions[i], positions[i + 1]) for i, sym in enumerate(item.rule.rhs)]
-        return Rule(lhs, rhs, item.rule.log_prob)
-
     def get_cfg(self, goal, root):
         """
-        Constructs the CFG by visiting complete items in a top-down fashion.
-        This is effectively a reachability test and it serves the purpose of filtering nonterminal symbols
-        that could never be reached from the root.
-        Note that bottom-up intersection typically does enumerate a lot of useless (unreachable) items.
-        This is the recursive procedure described in the paper (Nederhof and Satta, 2008).
+        Constructs the CFG by visiting complete items in a top-down fashion (see `agenda.get_cfg`).
         """
-
-        G = WCFG()
-        processed = set()
-        fsa = self._wfsa
-        itergenerating = self._agenda.itergenerating
-        itercomplete = self._agenda.itercomplete
-
-        def make_rules(lhs, start, end):
-            if (start, lhs, end) in processed:
-                return
-            processed.add((lhs, start, end))
-            for item in itercomplete(lhs, start, end):
-                G.add(self.get_intersected_rule(item))
-                fsa_states = item.inner + (item.dot,)
-                for i, sym in itertools.ifilter(lambda (_, s): is_nonterminal(s), enumerate(item.rule.rhs)):
-                    if (sym, fsa_states[i], fsa_states[
-                            i + 1]) not in processed:  # Nederhof does not perform this test, but in python it turned out crucial
-                        make_rules(sym, fsa_states[i], fsa_states[i + 1])
-
-        # create goal items
-        for start, ends in itergenerating(root):
-            if not fsa.is_initial(start):
-                continue
-            for end in itertools.ifilter(lambda q: fsa.is_final(q), ends):
-                make_rules(root, start, end)
-                G.add(Rule(make_symbol(goal, None, None),
-                           [make_symbol(root, start, end)], 0.0))
-
-        return G
\ No newline at end of file
+        return get_cfg(goal, root, self._wfsa, self._agenda, self._wcfg)
@@ -2,20 +2,39 @@
 :Authors: - Iason
 """
 
-from symbol import is_nonterminal
 import random
+from bisect import bisect_right
 import numpy as np
+from inference import edge_inside
+from semiring import cumsum_by_segment
 
 
 class GeneralisedSampling(object):
-
-    def __init__(self, forest, inside_node, omega=lambda edge: edge.log_prob):
+    """
+    Samples derivations from a forest with respect to the inside weight distribution.
+
+    The distribution over the edges incoming to each node is computed once per forest:
+    edges are sorted by decreasing mass and their cumulative probabilities are stored contiguously (by head node),
+    thus every draw is a bisection within the edges of a node.
+
+    >>> from hypergraph import HypergraphBuilder
+    >>> from inference import inside
+    >>> B = HypergraphBuilder()
+    >>> goal, s, a, b = B.node('[GOAL]'), B.node('[S]'), B.node('a'), B.node('b')
+    >>> B.add_edge(goal, [s], 0.0); B.add_edge(s, [a], np.log(0.25)); B.add_edge(s, [b], np.log(0.75))
+    >>> H = B.build()
+    >>> sampler = GeneralisedSampling(H, inside(H))
+    >>> [H.tail(e).tolist() for e in sampler.edges(s)], [round(p, 6) for p in sampler.cumulative(s)]
+    ([[3], [2]], [0.75, 1.0])
+    """
+
+    def __init__(self, forest, inside_node, omega=None):
         """
 
-        :param forest: an acyclic hypergraph
-        :param inside_node: a dictionary mapping nodes to their inside weights.
-        :param omega: a function that returns the weight of an edge.
-            By default we return the edge's log probability, but omega
+        :param forest: an acyclic hypergraph (see Hypergraph)
+        :param inside_node: a vector mapping nodes to their inside weights.
+        :param omega: edge weights, either a vector or a vectorised function of edge ids (see `inference.edge_weights`).
+            By default we use the edges' log probabilities, but omega
             can be used in situations where we must compute a function of that weight, for example,
             when we want to convert from a semiring to another,
             or when we want to compute a uniform probability based on assingments of the slice variables.
@@ -23,19 +42,37 @@ class GeneralisedSampling(object):
 
         self.forest = forest
         self.inside_node = inside_node
-        self.inside_edge = dict()  # cache for the inside weight of edges
-        self.omega = omega
+        # the inside weight of each edge: its own weight and the inside of its children
+        self.inside_edge = edge_inside(forest, inside_node, omega)
+        # the probability of each edge given its head
+        with np.errstate(invalid='ignore', over='ignore'):
+            mass = np.exp(self.inside_edge - inside_node[forest.heads])
+        mass[np.isnan(mass)] = 0.0
+        # edges grouped by head and sorted by decreasing mass
+        order = np.lexsort((-mass, forest.heads))
+        mass = mass[order]
+        # cumulative probabilities within each node
+        offset = forest.offset
+        cumulative = cumsum_by_segment(mass, offset)
+        self._mass = mass
+        self._edges = order.tolist()
+        self._cumulative = cumulative.tolist()
+        self._offset = offset.tolist()
+        self._tail_offset = forest.tail_offset.tolist()
+        self._tails = forest.tails.tolist()
 
     def sample(self, goal='[GOAL]'):
         """
         the generalised sample algorithm
+        :param goal: the key of the goal node
+        :returns: a derivation as a list of edge ids
         """
 
         # an empty partial derivation
         d = []
 
         # Q, a queue of nodes to be visited, starting from [GOAL]
-        Q = [goal]
+        Q = [self.forest.fetch(goal)]
 
         while Q:
             parent = Q.pop()
@@ -47,49 +84,95 @@ class GeneralisedSampling(object):
             d.append(edge)
 
             # queue the non-terminal nodes in the tail of the selected edge
-            for child in edge.rhs:
-                if is_nonterminal(child):
+            for child in self.tail(edge):
+                if self._offset[child] != self._offset[child + 1]:
                     Q.append(child)
 
         return d
 
+    def sample_counts(self, n, goal='[GOAL]'):
+        """
+        Draws n derivations at once by pushing counts top-down.
+        A group of samples shares a partial derivation and the nodes it has yet to expand,
+        expanding a node splits the group's count over the node's incoming edges (a multinomial draw),
+        thus the cost grows with the number of distinct derivations rather than with n.
+
+        >>> from hypergraph import HypergraphBuilder
+        >>> from inference import inside
+        >>> B = HypergraphBuilder()
+        >>> goal, s, x, a, b = B.node('[GOAL]'), B.node('[S]'), B.node('[X]'), B.node('a'), B.node('b')
+        >>> B.add_edge(goal, [s], 0.0); B.add_edge(s, [x, x], 0.0); B.add_edge(x, [a], np.log(0.5)); B.add_edge(x, [b], np.log(0.5))
+        >>> H = B.build()
+        >>> counts = GeneralisedSampling(H, inside(H)).sample_counts(1000)
+        >>> sum(n for d, n in counts), len(counts) == len(set(d for d, n in counts)) <= 4
+        (1000, True)
+
+        :param n: number of samples
+        :param goal: the key of the goal node
+        :returns: list of pairs (derivation, count) where a derivation is a tuple of edge ids (as in `sample`)
+        """
+        results = []
+        multinomial, uniform = np.random.multinomial, np.random.random
+        # groups of samples: (partial derivation, nodes to be expanded, count)
+        # derivations and queues are linked lists of pairs (head, rest) so that groups share their prefixes
+        stack = [(None, (self.forest.fetch(goal), None), n)]
+        while stack:
+            d, Q, count = stack.pop()
+            if Q is None:  # a complete derivation
+                edges = []
+                while d is not None:
+                    edge, d = d
+                    edges.append(edge)
+                edges.reverse()
+                results.append((tuple(edges), count))
+                continue
+            parent, Q = Q
+            if count == 1:  # a single draw from the same generator as the multinomial splits
+                selected = [(self.select(parent, uniform()), 1)]
+            else:
+                first, last = self._offset[parent], self._offset[parent + 1]
+                if first == last:
+                    raise ValueError('I cannot sample an incoming edge to a terminal node')
+                p = self._mass[first:last]
+                split = multinomial(count, p / p.sum())
+                selected = [(self._edges[first + i], int(split[i])) for i in np.flatnonzero(split)]
+            for edge, k in selected:
+                # queue the non-terminal nodes in the tail of the selected edge
+                R = Q
+                for child in self.tail(edge):
+                    if self._offset[child] != self._offset[child + 1]:
+                        R = (child, R)
+                stack.append(((edge, d), R, k))
+        return results
+
+    def tail(self, edge):
+        return self._tails[self._tail_offset[edge]:self._tail_offset[edge + 1]]
+
+    def edges(self, parent):
+        """Edges incoming to a node sorted by decreasing probability."""
+        return self._edges[self._offset[parent]:self._offset[parent + 1]]
+
+    def cumulative(self, parent):
+        """Cumulative probabilities of the edges incoming to a node (see `edges`)."""
+        return self._cumulative[self._offset[parent]:self._offset[parent + 1]]
+
     def get_edge_inside(self, edge):
-        """Compute the inside weight of an edge (caching the result)."""
-        w = self.inside_edge.get(edge, None)
-        if w is None:
-            # starting from the edge's own weight
-            # and including the inside of each child node
-            # accumulate (log-domain) all contributions
-            w = sum((self.inside_node[child] for child in edge.rhs), self.omega(edge))
-            self.inside_edge[edge] = w
-        return w
-
-    def select(self, parent):
+        """The inside weight of an edge."""
+        return self.inside_edge[edge]
+
+    def select(self, parent, u=None):
         """
         select method, draws a random edge with respect to the Inside weight distribution
+        :param u: a uniform draw in [0, 1), by default it comes from python's random module
         """
-        # self.iq = dict()
-        incoming = self.forest.get(parent, frozenset())
-
-        if not incoming:
+        first, last = self._offset[parent], self._offset[parent + 1]
+        if first == last:
             raise ValueError('I cannot sample an incoming edge to a terminal node')
 
-        # the inside weight of the parent node
-        ip = self.inside_node[parent]
-
-        # select an edge randomly with respect to the distribution of the edges
-        # threshold for selecting an edge
-        threshold = np.log(random.uniform(0, np.exp(ip)))
-
-        acc = -float("inf")
-        for e in incoming:
-            # acc = math.log(math.exp(acc) + math.exp(self.get_edge_inside(e)))
-            acc = np.logaddexp(acc, self.get_edge_inside(e))
-            if acc > threshold:
-                return e
+        # the total is 1 up to rounding errors
+        threshold = (random.random() if u is None else u) * self._cumulative[last - 1]
+        i = bisect_right(self._cumulative, threshold, first, last)
 
-        # if there is not yet an edge returned for some rare rounding error,
+        # if there is not yet an edge selected for some rare rounding error,
         # return the last edge, hence that is the edge closest to the threshold
-        return e
-
-
+        return self._edges[min(i, last - 1)]
@@ -0,0 +1,201 @@
+"""
+Grammar lookups shared by the intersection engines.
+
+An index is built once per grammar (a single scan through its rules) and can be shared by every parser
+built for that grammar, across sentences and across slice sampling iterations.
+
+:Authors: - Wilker Aziz
+"""
+
+from collections import defaultdict
+
+
+class GrammarIndex(object):
+    """
+    Indexes rules by their first RHS symbol and by the symbols they contain (lexical rules by their terminals),
+    and keeps the set of rewritable nonterminals, the left-corner relation and the depth of unary chains (computed on demand).
+
+    >>> from wcfg import WCFG
+    >>> from rule import Rule
+    >>> G = WCFG([Rule('[S]', ['[NP]', '[VP]'], 0.0), Rule('[NP]', ['[D]', '[N]'], 0.0), Rule('[D]', ['the'], 0.0), Rule('[VP]', ['barks'], 0.0)])
+    >>> index = GrammarIndex(G)
+    >>> index.first('[D]')
+    [[NP] -> [D] [N] (0.0)]
+    >>> index.lexical('the')
+    [[D] -> the (0.0)]
+    >>> index.containing('[VP]')
+    [[S] -> [NP] [VP] (0.0)]
+    >>> index.can_rewrite('[N]')
+    False
+    >>> sorted(index.left_corners('[S]'))
+    ['[D]', '[NP]', 'the']
+    >>> sorted(index.left_corner_ancestors('the'))
+    ['[D]', '[NP]', '[S]']
+    >>> index.unary_rank('[NP]'), GrammarIndex(WCFG([Rule('[S]', ['[NP]'], 0.0), Rule('[NP]', ['[N]'], 0.0)])).unary_rank('[S]')
+    (0, 2)
+    """
+
+    def __init__(self, wcfg, rules=None):
+        """
+        :param wcfg: the grammar
+        :param rules: the rules to be indexed (defaults to every rule in the grammar)
+        """
+        self._wcfg = wcfg
+        self._is_terminal = wcfg.is_terminal
+        self._firstsym = defaultdict(list)  # first RHS symbol -> rules
+        self._occurs = defaultdict(list)  # RHS symbol -> rules containing it
+        self._rewritable = set()  # nonterminals which can be rewritten
+        self._left_corners = {}  # nonterminal -> left corners (memoised)
+        self._left_corner_ancestors = {}  # symbol -> nonterminals it is a left corner of (memoised)
+        self._unary_ranks = {}  # nonterminal -> depth of its unary chains (memoised)
+        for rule in (wcfg if rules is None else rules):
+            self.add(rule)
+
+    def add(self, rule):
+        """Indexes a rule newly added to the grammar (symbols encoded as in the grammar)."""
+        self._firstsym[rule.rhs[0]].append(rule)
+        self._rewritable.add(rule.lhs)
+        for sym in set(rule.rhs):
+            self._occurs[sym].append(rule)
+        if self._left_corners or self._left_corner_ancestors:  # the relation might have changed
+            self._left_corners = {}
+            self._left_corner_ancestors = {}
+        if self._unary_ranks and len(rule.rhs) == 1:
+            self._unary_ranks = {}
+
+    def update(self, rules):
+        for rule in rules:
+            self.add(rule)
+
+    @property
+    def rewritable(self):
+        """Set of nonterminals which can be rewritten."""
+        return self._rewritable
+
+    def can_rewrite(self, sym):
+        return sym in self._rewritable
+
+    def first(self, sym):
+        """Rules whose first RHS symbol is `sym`."""
+        return self._firstsym.get(sym, [])
+
+    def lexical(self, terminal):
+        """Rules whose RHS contains a given terminal."""
+        return self.containing(terminal) if self._is_terminal(terminal) else []
+
+    def containing(self, sym):
+        """Rules whose RHS contains a given symbol."""
+        return self._occurs.get(sym, [])
+
+    def left_corners(self, sym):
+        """
+        Symbols Y such that `sym` derives a string starting with Y (reflexive closure excluded).
+        Terminals are their own left corners.
+        """
+        if self._is_terminal(sym):
+            return frozenset([sym])
+        corners = self._left_corners.get(sym, None)
+        if corners is None:
+            corners = set()
+            stack = [sym]
+            while stack:
+                for rule in self._wcfg.get(stack.pop()):
+                    first = rule.rhs[0]
+                    if first not in corners:
+                        corners.add(first)
+                        if not self._is_terminal(first):
+                            stack.append(first)
+            corners = frozenset(corners)
+            self._left_corners[sym] = corners
+        return corners
+
+    def left_corner_ancestors(self, sym):
+        """
+        Nonterminals X such that `sym` is a left corner of X.
+        This is the inverse of `left_corners`, it is typically asked for terminals of a given input,
+        thus it remains small where the forward relation of a large lexicon would not.
+        """
+        ancestors = self._left_corner_ancestors.get(sym, None)
+        if ancestors is None:
+            ancestors = set()
+            stack = [sym]
+            while stack:
+                for rule in self.first(stack.pop()):
+                    if rule.lhs not in ancestors:
+                        ancestors.add(rule.lhs)
+                        stack.append(rule.lhs)
+            ancestors = frozenset(ancestors)
+            self._left_corner_ancestors[sym] = ancestors
+        return ancestors
+
+    def unary_rank(self, sym):
+        """
+        The length of the longest chain of unary rules from a nonterminal to another nonterminal (0 if there is none),
+        thus a nonterminal ranks above every nonterminal it rewrites to by a unary rule.
+        Raises ValueError if unary rules form a cycle.
+        """
+        rank = self._unary_ranks.get(sym, None)
+        if rank is not None:
+            return rank
+        is_terminal = self._is_terminal
+        visiting = set()
+        stack = [sym]
+        while stack:
+            lhs = stack[-1]
+            if lhs in self._unary_ranks:
+                stack.pop()
+                continue
+            visiting.add(lhs)
+            children = [rule.rhs[0] for rule in self._wcfg.get(lhs, ())
+                        if len(rule.rhs) == 1 and not is_terminal(rule.rhs[0])]
+            pending = [child for child in children if child not in self._unary_ranks]
+            if pending:
+                for child in pending:
+                    if child in visiting:
+                        raise ValueError('Unary rules form a cycle through %s' % self._wcfg.decode(child))
+                    stack.append(child)
+                continue
+            self._unary_ranks[lhs] = max([self._unary_ranks[child] + 1 for child in children] or [0])
+            visiting.discard(lhs)
+            stack.pop()
+        return self._unary_ranks[sym]
+
+
+class OverlayIndex(GrammarIndex):
+    """
+    Index of an OverlayWCFG: lookups combine the shared index of the base grammar with an index of the local rules,
+    thus the base grammar is not scanned again.
+
+    >>> from wcfg import WCFG, OverlayWCFG
+    >>> from rule import Rule
+    >>> base = WCFG([Rule('[S]', ['[X]'], 0.0), Rule('[X]', ['a'], 0.0)])
+    >>> index = GrammarIndex(base)
+    >>> overlay = OverlayIndex(index, OverlayWCFG(base, [Rule('[Y]', ['b'], 0.0)]))
+    >>> overlay.lexical('b'), overlay.can_rewrite('[Y]'), index.can_rewrite('[Y]')
+    ([[Y] -> b (0.0)], True, False)
+    >>> sorted(overlay.left_corners('[S]'))
+    ['[X]', 'a']
+    """
+
+    def __init__(self, index, wcfg):
+        """
+        :param index: a GrammarIndex for the base grammar
+        :param wcfg: an OverlayWCFG whose base is the grammar indexed by `index`
+        """
+        self._base = index
+        GrammarIndex.__init__(self, wcfg, wcfg.local)
+
+    @property
+    def rewritable(self):
+        return frozenset(self._base.rewritable).union(self._rewritable)
+
+    def can_rewrite(self, sym):
+        return sym in self._rewritable or self._base.can_rewrite(sym)
+
+    def first(self, sym):
+        local = self._firstsym.get(sym, None)
+        return self._base.first(sym) if local is None else self._base.first(sym) + local
+
+    def containing(self, sym):
+        local = self._occurs.get(sym, None)
+        return self._base.containing(sym) if local is None else self._base.containing(sym) + local
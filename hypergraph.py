@@ -0,0 +1,266 @@
+"""
+A compact representation of forests.
+
+Nodes are integers, the edges incoming to a node are contiguous (compressed sparse rows),
+the tails of all edges are stored in a single flat array and edge weights are stored in a numpy vector.
+Node keys (e.g. (symbol, start, end) triples) are only kept once per node.
+
+:Authors: - Wilker Aziz
+"""
+
+import numpy as np
+from array import array
+from rule import Rule
+from symbol import node_label
+from topsort import top_sort_levels
+
+
+class Hypergraph(object):
+    """
+    An immutable hypergraph whose edges are grouped by head node.
+
+    >>> B = HypergraphBuilder()
+    >>> goal, s, x, a = B.node('[GOAL]'), B.node(('[S]', 0, 1)), B.node(('[X]', 0, 1)), B.node('a')
+    >>> B.add_edge(x, [a], -1.0)
+    >>> B.add_edge(goal, [s], 0.0)
+    >>> B.add_edge(s, [x], -0.5)
+    >>> B.add_edge(s, [a], -2.0)
+    >>> H = B.build()
+    >>> len(H), H.n_nodes, H.fetch(('[S]', 0, 1))
+    (4, 4, 1)
+    >>> [(H.tail(e).tolist(), H.weight(e)) for e in H.incoming(1)]
+    [([2], -0.5), ([3], -2.0)]
+    >>> H.is_terminal(a), H.label(1)
+    (True, '[S,0-1]')
+    >>> H.rule(0)
+    [GOAL] -> ('[S]', 0, 1) (0.0)
+    >>> H.node_levels.tolist(), [nodes.tolist() for nodes in H.levels]
+    ([3, 2, 1, 0], [[3], [2], [1], [0]])
+    """
+
+    def __init__(self, nodes, heads, tail_offset, tails, weights, decode=lambda sym: sym, dtype=np.float64,
+                 node_levels=None):
+        """
+        :param nodes: node keys (the id of a node is its position)
+        :param heads: the head node of each edge
+        :param tail_offset: edge e has tail nodes tails[tail_offset[e]:tail_offset[e + 1]]
+        :param tails: tail nodes (flat)
+        :param weights: the weight of each edge (log probability)
+        :param decode: maps the symbols in node keys back to strings (see `wcfg.decode`)
+        :param dtype: floating point type of the weight vector (e.g. np.float32 halves its memory)
+        :param node_levels: the topological level of each node if known (leaves are in level 0),
+            otherwise levels are computed on demand (see `topsort.top_sort_levels`)
+        """
+        self._nodes = list(nodes)
+        self._node_ids = {key: i for i, key in enumerate(self._nodes)}
+        self._decode = decode
+        heads = np.asarray(heads, dtype=np.int32)
+        tail_offset = np.asarray(tail_offset, dtype=np.int32)
+        tails = np.asarray(tails, dtype=np.int32)
+        # group edges by head (stable, thus edges of a node keep their order)
+        order = np.argsort(heads, kind='mergesort')
+        lengths = np.diff(tail_offset)[order]
+        self._tail_offset = np.zeros(len(order) + 1, dtype=np.int32)
+        np.cumsum(lengths, out=self._tail_offset[1:])
+        self._tails = tails[np.repeat(tail_offset[:-1][order] - self._tail_offset[:-1], lengths)
+                            + np.arange(len(tails), dtype=np.int32)]
+        self._heads = heads[order]
+        self._weights = np.asarray(weights, dtype=dtype)[order]
+        self._offset = np.zeros(len(self._nodes) + 1, dtype=np.int32)
+        np.cumsum(np.bincount(self._heads, minlength=len(self._nodes)), out=self._offset[1:])
+        self._node_levels = None if node_levels is None else np.asarray(node_levels, dtype=np.int32)
+
+    def __len__(self):
+        """Number of edges."""
+        return len(self._heads)
+
+    @property
+    def n_nodes(self):
+        return len(self._nodes)
+
+    @property
+    def offset(self):
+        """Edges incoming to node n are offset[n]:offset[n + 1]."""
+        return self._offset
+
+    @property
+    def heads(self):
+        return self._heads
+
+    @property
+    def tail_offset(self):
+        """Edge e has tail nodes tails[tail_offset[e]:tail_offset[e + 1]]."""
+        return self._tail_offset
+
+    @property
+    def tails(self):
+        return self._tails
+
+    @property
+    def weights(self):
+        return self._weights
+
+    @property
+    def node_levels(self):
+        """The topological level of each node: leaves are in level 0 and a node is one level above its highest child."""
+        if self._node_levels is None:
+            self._node_levels = np.zeros(len(self._nodes), dtype=np.int32)
+            for level, nodes in enumerate(top_sort_levels(self)):
+                self._node_levels[nodes] = level
+        return self._node_levels
+
+    @property
+    def levels(self):
+        """List of arrays of nodes, one per topological level (from leaves to root)."""
+        node_levels = self.node_levels
+        if not len(node_levels):
+            return []
+        order = np.argsort(node_levels, kind='mergesort')
+        return np.split(order, np.cumsum(np.bincount(node_levels))[:-1])
+
+    def fetch(self, key, default=None):
+        """Returns the id of a node given its key."""
+        return self._node_ids.get(key, default)
+
+    def key(self, node):
+        return self._nodes[node]
+
+    def label(self, node):
+        """Returns the string of a node."""
+        return node_label(self._nodes[node], self._decode)
+
+    def incoming(self, node):
+        """Ids of the edges incoming to a node."""
+        return xrange(self._offset[node], self._offset[node + 1])
+
+    def is_terminal(self, node):
+        return self._offset[node] == self._offset[node + 1]
+
+    def is_nonterminal(self, node):
+        return self._offset[node] != self._offset[node + 1]
+
+    def head(self, edge):
+        return self._heads[edge]
+
+    def tail(self, edge):
+        return self._tails[self._tail_offset[edge]:self._tail_offset[edge + 1]]
+
+    def weight(self, edge):
+        return float(self._weights[edge])
+
+    def rule(self, edge):
+        """Returns an edge as a Rule over node keys."""
+        key = self._nodes
+        return Rule(key[self._heads[edge]], [key[child] for child in self.tail(edge)], self.weight(edge))
+
+    def iterrules(self):
+        return (self.rule(e) for e in xrange(len(self)))
+
+    def reachable(self, root):
+        """
+        Boolean mask of the nodes reachable from a root (e.g. the goal), computed one frontier at a time.
+
+        >>> B = HypergraphBuilder()
+        >>> goal, s, x, y, a = B.node('[GOAL]'), B.node('[S]'), B.node('[X]'), B.node('[Y]'), B.node('a')
+        >>> B.add_edge(y, [x, a], 0.0); B.add_edge(goal, [s], 0.0); B.add_edge(s, [x], -0.5); B.add_edge(x, [a], -1.0)
+        >>> H = B.build()
+        >>> H.reachable('[GOAL]').tolist(), H.reachable('[Z]').any()
+        ([True, True, True, False, True], False)
+        """
+        reached = np.zeros(len(self._nodes), dtype=bool)
+        root = self.fetch(root)
+        if root is None:
+            return reached
+        reached[root] = True
+        frontier = np.array([root])
+        while len(frontier):
+            # the tails of the edges incoming to the frontier
+            counts = self._offset[frontier + 1] - self._offset[frontier]
+            edges = np.repeat(self._offset[frontier] - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+            counts = self._tail_offset[edges + 1] - self._tail_offset[edges]
+            children = self._tails[np.repeat(self._tail_offset[edges] - (np.cumsum(counts) - counts), counts)
+                                   + np.arange(counts.sum())]
+            frontier = np.unique(children[~reached[children]])
+            reached[frontier] = True
+        return reached
+
+    def subgraph(self, nodes):
+        """
+        The hypergraph made of the nodes in a boolean mask and of the edges incoming to them (in the same order),
+        edges are kept where `nodes[heads]` holds, thus vectors over edges carry over by the same mask.
+        Every tail of a kept edge must be kept (e.g. the nodes are `reachable` from some root).
+
+        >>> B = HypergraphBuilder()
+        >>> goal, s, x, y, a = B.node('[GOAL]'), B.node('[S]'), B.node('[X]'), B.node('[Y]'), B.node('a')
+        >>> B.add_edge(y, [x, a], 0.0); B.add_edge(goal, [s], 0.0); B.add_edge(s, [x], -0.5); B.add_edge(x, [a], -1.0)
+        >>> H = B.build()
+        >>> S = H.subgraph(H.reachable('[GOAL]'))
+        >>> len(S), [S.key(node) for node in xrange(S.n_nodes)], S.fetch('[Y]')
+        (3, ['[GOAL]', '[S]', '[X]', 'a'], None)
+        """
+        if nodes.all():
+            return self
+        new_id = np.cumsum(nodes) - 1
+        edges = nodes[self._heads]
+        counts = np.diff(self._tail_offset)
+        return Hypergraph([key for key, keep in zip(self._nodes, nodes.tolist()) if keep],
+                          new_id[self._heads[edges]],
+                          np.concatenate(([0], np.cumsum(counts[edges]))),
+                          new_id[self._tails[np.repeat(edges, counts)]],
+                          self._weights[edges], self._decode, self._weights.dtype,
+                          None if self._node_levels is None else self._node_levels[nodes])
+
+    def __str__(self):
+        label = self.label
+        return '\n'.join('%s -> %s (%s)' % (label(self._heads[e]), ' '.join(label(child) for child in self.tail(e)),
+                                            self.weight(e)) for e in xrange(len(self)))
+
+
+class HypergraphBuilder(object):
+    """Collects nodes and edges (in any order) and builds a Hypergraph."""
+
+    def __init__(self):
+        self._nodes = []
+        self._node_ids = {}
+        self._levels = array('i')  # -1 if unknown
+        self._heads = array('i')
+        self._tail_offset = array('i', [0])
+        self._tails = array('i')
+        self._weights = array('d')
+
+    def __len__(self):
+        return len(self._heads)
+
+    def node(self, key):
+        """Returns the id of a node (creating it if necessary)."""
+        nid = self._node_ids.get(key, None)
+        if nid is None:
+            nid = len(self._nodes)
+            self._nodes.append(key)
+            self._node_ids[key] = nid
+            self._levels.append(-1)
+        return nid
+
+    def level(self, node):
+        """The topological level of a node (-1 if unknown)."""
+        return self._levels[node]
+
+    def set_level(self, node, level):
+        self._levels[node] = level
+
+    def add_edge(self, head, tails, weight):
+        self._heads.append(head)
+        self._tails.extend(tails)
+        self._tail_offset.append(len(self._tails))
+        self._weights.append(weight)
+
+    def build(self, decode=lambda sym: sym, dtype=np.float64):
+        """Builds the hypergraph, levels are kept if known for every node (see `set_level`)."""
+        levels = np.frombuffer(self._levels, dtype=np.int32) if self._levels else []
+        return Hypergraph(self._nodes,
+                          np.frombuffer(self._heads, dtype=np.int32) if self._heads else [],
+                          np.frombuffer(self._tail_offset, dtype=np.int32),
+                          np.frombuffer(self._tails, dtype=np.int32) if self._tails else [],
+                          np.frombuffer(self._weights, dtype=np.float64) if self._weights else [],
+                          decode, dtype,
+                          levels if len(levels) and levels.min() >= 0 else None)
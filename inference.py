@@ -2,40 +2,227 @@
 :Authors: - Iason
 """
 
-from collections import defaultdict
 import numpy as np
+from semiring import Log, segment_logsumexp, segment_starts, cumsum_by_segment
 
 
-def inside(forest, topsort, omega=lambda edge: edge.log_prob):
+def edge_weights(forest, omega=None):
     """
-    Inside recursion.
-    :param forest: an acyclic hypergraph.
-    :param topsort: a partial ordering of the nodes in the forest.
-    :param omega: a function that computes the weight of an edge (defaults to the edge's own log probability)
-    :return: a dictionary mapping a symbol to its inside weight.
+    Returns the vector of edge weights given by omega.
+    :param omega: None (the edges' own log probabilities), a vector of weights,
+        or a vectorised function which maps a vector of edge ids to a vector of weights
     """
-    inside_prob = defaultdict(float)
+    if omega is None:
+        return forest.weights.astype(np.float64)
+    if callable(omega):
+        omega = omega(np.arange(len(forest)))
+    omega = np.asarray(omega, dtype=np.float64)
+    if omega.shape != (len(forest),):
+        raise ValueError('Expected %d edge weights, got shape %s' % (len(forest), omega.shape))
+    return omega
 
-    # visit nodes bottom up
-    for parent in topsort:
 
-        incoming = forest.get(parent, frozenset())
+class LevelOrder(object):
+    """
+    The edges of a forest sorted by the topological level of their heads
+    (within a level, edges of the same head remain contiguous), with their tails laid out in the same order.
+    This is the schedule shared by the level-synchronous passes (e.g. `inside` visits levels bottom up,
+    `outside` top down).
+    """
 
-        # leaves have inside weight 1
-        if not incoming:
-            # log(1) = 0
-            inside_prob[parent] = 0
+    def __init__(self, forest, levels=None):
+        """
+        :param forest: an acyclic hypergraph (see Hypergraph).
+        :param levels: topological levels of the nodes in the forest (defaults to the levels recorded in the forest,
+            see `Hypergraph.levels`).
+        """
+        if levels is None:
+            node_level = forest.node_levels
+            n_levels = node_level.max() + 1 if len(node_level) else 0
         else:
-            # log(0) = -inf
-            total = -float("inf")
+            node_level = np.zeros(forest.n_nodes, dtype=np.int64)
+            for level, nodes in enumerate(levels):
+                node_level[nodes] = level
+            n_levels = len(levels)
+        self.n_levels = n_levels
+        # edge ids sorted by level
+        self.order = np.argsort(node_level[forest.heads], kind='mergesort')
+        self.heads = forest.heads[self.order]
+        lengths = np.diff(forest.tail_offset)[self.order]
+        self.tail_offset = np.zeros(len(self.order) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.tail_offset[1:])
+        self.tails = forest.tails[np.repeat(forest.tail_offset[:-1][self.order] - self.tail_offset[:-1], lengths)
+                                  + np.arange(len(forest.tails))]
+        # position (in the sorted edges) of the edge of each tail
+        self.edge_of_tail = np.repeat(np.arange(len(self.order)), lengths)
+        # level boundaries in the sorted edges
+        self.level_offset = np.searchsorted(node_level[self.heads], np.arange(n_levels + 1))
+
+    def edges(self, level):
+        """Range of (sorted) edges whose heads are in a given level."""
+        return self.level_offset[level], self.level_offset[level + 1]
+
+
+def inside(forest, levels=None, omega=None, semiring=Log):
+    """
+    Inside recursion (level-synchronous).
+    All edges whose heads are in the same topological level are processed at once:
+    a vectorised product over their tails followed by a vectorised sum per head node
+    (in the log semiring, a sum and a log-sum-exp).
+
+    >>> from hypergraph import HypergraphBuilder
+    >>> B = HypergraphBuilder()
+    >>> goal, s, x, a = B.node('[GOAL]'), B.node('[S]'), B.node('[X]'), B.node('a')
+    >>> B.add_edge(goal, [s], 0.0); B.add_edge(s, [x, x], np.log(0.5)); B.add_edge(s, [a], np.log(0.5)); B.add_edge(x, [a], 0.0)
+    >>> H = B.build()
+    >>> np.exp(inside(H)).tolist()
+    [1.0, 1.0, 1.0, 1.0]
+    >>> np.exp(inside(H, omega=np.log([1.0, 0.5, 0.25, 0.5]))).tolist()
+    [0.375, 0.375, 0.5, 1.0]
+    >>> from semiring import Counting, Viterbi
+    >>> inside(H, semiring=Counting).tolist(), np.exp(inside(H, semiring=Viterbi)).tolist()
+    ([2, 2, 1, 1], [0.5, 0.5, 1.0, 1.0])
 
-            for edge in incoming:
-                w = sum((inside_prob[child] for child in edge.rhs), omega(edge))
-                # log(a) + log(b) = log(exp(a) + exp(b))
-                # total = log(exp(total) + exp(w))
-                total = np.logaddexp(total, w)
+    :param forest: an acyclic hypergraph (see Hypergraph).
+    :param levels: topological levels of the nodes in the forest (defaults to the levels recorded in the forest,
+        see `Hypergraph.levels`), or a LevelOrder.
+    :param omega: edge weights, either a vector or a vectorised function of edge ids (see `edge_weights`),
+        defaults to the edges' own log probabilities
+    :param semiring: a Semiring (see semiring.py), edge weights are mapped into it with `semiring.from_log`
+    :return: a vector mapping a node to its inside weight (in the semiring).
+    """
+    omega = semiring.from_log(edge_weights(forest, omega))
+    inside_prob = semiring.ones(forest.n_nodes)  # leaves have inside weight 1
+    if not len(forest):
+        return inside_prob
+
+    schedule = levels if isinstance(levels, LevelOrder) else LevelOrder(forest, levels)
+    heads, tails, tail_offset, edge_of_tail = schedule.heads, schedule.tails, schedule.tail_offset, schedule.edge_of_tail
+    weights = omega[schedule.order]
 
-            inside_prob[parent] = total
+    # visit levels bottom up
+    for level in xrange(1, schedule.n_levels):
+        first, last = schedule.edges(level)
+        if first == last:
+            continue
+        t0, t1 = tail_offset[first], tail_offset[last]
+        # the inside of an edge: its own weight times the inside of its children
+        w = semiring.times(weights[first:last], semiring.product_segments(inside_prob[tails[t0:t1]],
+                                                                          edge_of_tail[t0:t1] - first, last - first))
+        # the sum over the edges of each head
+        h = heads[first:last]
+        starts = segment_starts(h)
+        inside_prob[h[starts]] = semiring.sum_segments(w, starts)
 
     return inside_prob
 
+
+def edge_inside(forest, inside_node, omega=None):
+    """
+    The inside weight of each edge: its own weight and the inside weights of its tail nodes.
+    :param inside_node: a vector mapping nodes to their inside weights (see `inside`)
+    :param omega: edge weights (see `edge_weights`)
+    """
+    lengths = np.diff(forest.tail_offset)
+    return edge_weights(forest, omega) + np.bincount(np.repeat(np.arange(len(forest)), lengths),
+                                                     weights=inside_node[forest.tails],
+                                                     minlength=len(forest))
+
+
+def outside(forest, inside_node, goal='[GOAL]', levels=None, omega=None):
+    """
+    Outside recursion (level-synchronous), it visits the levels of `inside` top down.
+    The outside weight of a tail node collects, from every edge it belongs to,
+    the outside weight of the edge's head times the edge's weight times the inside weights of its siblings.
+
+    >>> from hypergraph import HypergraphBuilder
+    >>> B = HypergraphBuilder()
+    >>> goal, s, x, a = B.node('[GOAL]'), B.node('[S]'), B.node('[X]'), B.node('a')
+    >>> B.add_edge(goal, [s], 0.0); B.add_edge(s, [x, x], np.log(0.5)); B.add_edge(s, [a], np.log(0.5)); B.add_edge(x, [a], 0.0)
+    >>> H = B.build()
+    >>> np.exp(outside(H, inside(H))).tolist()
+    [1.0, 1.0, 1.0, 1.5]
+    >>> y, b = B.node('[Y]'), B.node('b')
+    >>> B.add_edge(s, [x, y], np.log(0.5)); B.add_edge(y, [b], -np.inf)  # [Y] derives nothing (its inside is 0)
+    >>> H = B.build()
+    >>> np.exp(outside(H, inside(H))).tolist()
+    [1.0, 1.0, 1.0, 1.5, 0.5, 0.0]
+
+    :param forest: an acyclic hypergraph (see Hypergraph).
+    :param inside_node: a vector mapping nodes to their inside weights (see `inside`),
+        nodes whose inside weight is 0 (-inf) do not pass outside weight to their siblings, but they do get outside weight
+    :param goal: the key of the root node (whose outside weight is 1)
+    :param levels: as in `inside`
+    :param omega: edge weights, as in `inside` (the ones used to compute inside_node)
+    :return: a vector mapping a node to its outside weight.
+    """
+    outside_prob = np.empty(forest.n_nodes)
+    outside_prob.fill(-np.inf)
+    root = forest.fetch(goal)
+    if root is None:
+        return outside_prob
+    outside_prob[root] = 0.0
+    if not len(forest):
+        return outside_prob
+
+    schedule = levels if isinstance(levels, LevelOrder) else LevelOrder(forest, levels)
+    heads, tails, tail_offset, edge_of_tail = schedule.heads, schedule.tails, schedule.tail_offset, schedule.edge_of_tail
+    weights = edge_weights(forest, omega)[schedule.order]
+
+    # visit levels top down, all parents of a node are in higher levels
+    for level in xrange(schedule.n_levels - 1, 0, -1):
+        first, last = schedule.edges(level)
+        if first == last:
+            continue
+        t0, t1 = tail_offset[first], tail_offset[last]
+        children = tails[t0:t1]
+        # the inside of the siblings before and after each child (sums within the tails of each edge,
+        # the inside of the child itself is never divided out, it may be 0)
+        values = inside_node[children]
+        offset = tail_offset[first:last + 1] - t0
+        before = np.roll(cumsum_by_segment(values, offset), 1)
+        after = np.roll(cumsum_by_segment(values[::-1], offset[-1] - offset[::-1])[::-1], -1)
+        nonempty = offset[:-1] < offset[1:]
+        before[offset[:-1][nonempty]] = 0.0
+        after[offset[1:][nonempty] - 1] = 0.0
+        # outside(head) * weight(edge) * inside(siblings)
+        w = (outside_prob[heads[first:last]] + weights[first:last])[edge_of_tail[t0:t1] - first] + before + after
+        # accumulate by child
+        order = np.argsort(children, kind='mergesort')
+        children = children[order]
+        starts = segment_starts(children)
+        nodes = children[starts]
+        outside_prob[nodes] = np.logaddexp(outside_prob[nodes], segment_logsumexp(w[order], starts))
+
+    return outside_prob
+
+
+def posteriors(forest, goal='[GOAL]', levels=None, omega=None):
+    """
+    Exact posterior marginals of edges and nodes, that is, the expected number of times a derivation of the goal uses them.
+    In parse forests a non-terminal node (a symbol and a span) occurs at most once in a derivation,
+    thus the expectation is the probability that a derivation uses it.
+
+    >>> from hypergraph import HypergraphBuilder
+    >>> B = HypergraphBuilder()
+    >>> goal, s, x, a = B.node('[GOAL]'), B.node('[S]'), B.node('[X]'), B.node('a')
+    >>> B.add_edge(goal, [s], 0.0); B.add_edge(s, [x, x], np.log(0.5)); B.add_edge(s, [a], np.log(0.5)); B.add_edge(x, [a], 0.0)
+    >>> edges, nodes = posteriors(B.build())
+    >>> edges.tolist(), nodes.tolist()
+    ([1.0, 0.5, 0.5, 1.0], [1.0, 1.0, 1.0, 1.5])
+
+    :param goal: the key of the root node
+    :param levels: as in `inside`
+    :param omega: edge weights, as in `inside`
+    :return: a pair of vectors (edge posteriors, node posteriors)
+    """
+    schedule = LevelOrder(forest, levels)
+    inside_node = inside(forest, schedule, omega)
+    outside_node = outside(forest, inside_node, goal, schedule, omega)
+    Z = inside_node[forest.fetch(goal)]
+    with np.errstate(invalid='ignore'):
+        edges = np.exp(outside_node[forest.heads] + edge_inside(forest, inside_node, omega) - Z)
+        nodes = np.exp(outside_node + inside_node - Z)
+    edges[np.isnan(edges)] = 0.0
+    nodes[np.isnan(nodes)] = 0.0
+    return edges, nodes
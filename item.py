@@ -2,9 +2,14 @@
 @author wilkeraziz
 """
 
-from collections import defaultdict, deque
+from array import array
 
 class Item(object):
+    """
+    An immutable state of the intersection, identified by its uid (see ItemFactory).
+    """
+
+    __slots__ = ('uid_', 'rule_', 'dot_', 'inner_', 'start_', 'next_')
 
     def __init__(self, sid, rule, dot, inner):
         """
@@ -29,7 +34,7 @@ class Item(object):
         return self.uid_ != other.uid_
 
     def __hash__(self):
-        return hash(self.uid_)
+        return self.uid_  # uids are small non-negative integers, thus their own hash
 
     def __str__(self):
         return '%d) %s %s %d' % (self.uid_, str(self.rule_), tuple(self.inner_), self.dot_)
@@ -66,20 +71,103 @@ class Item(object):
 
 
 class ItemFactory(object):
+    """
+    An arena of items.
+
+    An item is identified by three integers: the id of its rule, its dot (an automaton state)
+    and the id of the sequence of states intersected thus far.
+    Inner sequences are interned in a trie, thus advancing the dot of an item costs a lookup of a pair of integers
+    rather than hashing a growing tuple.
+    These columns are stored in growable arrays indexed by the item's uid (next to the items themselves)
+    and the arena can be cleared at once, so that it can be reused across sentences.
+
+    >>> from rule import Rule
+    >>> r = Rule('[S]', ['[X]', '[Y]'], 0.0)
+    >>> factory = ItemFactory()
+    >>> item = factory.get_item(r, 0)
+    >>> factory.advance(item, 1) is factory.get_item(r, 1, (0,))
+    True
+    >>> len(factory), factory.key(1), factory[1].inner
+    (2, (0, 1, 1), (0,))
+    >>> factory.clear()
+    >>> len(factory)
+    0
+    """
 
     def __init__(self):
-        self._uid_by_key = defaultdict(None)
-        self._items = deque()
+        self._rule_ids = {}  # rule -> rule id
+        self._inner_ids = {}  # (inner id, state) -> inner id of the extended sequence
+        self._inner_seqs = [()]  # inner id -> sequence of states (0 is the empty sequence)
+        self._uid_by_key = {}  # (rule id, dot, inner id) -> uid
+        self._rule = array('i')  # uid -> rule id
+        self._dot = array('i')  # uid -> dot
+        self._inner = array('i')  # uid -> inner id
+        self._items = []  # uid -> item
+
+    def __len__(self):
+        return len(self._items)
 
-    def get_item(self, rule, dot, inner=[]):
-        key = (rule, dot, tuple(inner))
+    def __getitem__(self, uid):
+        return self._items[uid]
+
+    def key(self, uid):
+        """Returns the triple (rule id, dot, inner id) which identifies an item."""
+        return self._rule[uid], self._dot[uid], self._inner[uid]
+
+    def clear(self):
+        """Discards every item (as well as interned rules and sequences)."""
+        self._rule_ids.clear()
+        self._inner_ids.clear()
+        del self._inner_seqs[1:]
+        self._uid_by_key.clear()
+        del self._rule[:]
+        del self._dot[:]
+        del self._inner[:]
+        del self._items[:]
+
+    def _extend(self, iid, state):
+        """Returns the id of the inner sequence `iid` extended by `state`."""
+        key = (iid, state)
+        extended = self._inner_ids.get(key, None)
+        if extended is None:
+            extended = len(self._inner_seqs)
+            self._inner_seqs.append(self._inner_seqs[iid] + (state,))
+            self._inner_ids[key] = extended
+        return extended
+
+    def _get(self, rid, rule, dot, iid):
+        key = (rid, dot, iid)
         uid = self._uid_by_key.get(key, None)
         if uid is None:
             uid = len(self._items)
-            self._items.append(Item(uid, rule, dot, inner))
+            self._items.append(Item(uid, rule, dot, self._inner_seqs[iid]))
+            self._rule.append(rid)
+            self._dot.append(dot)
+            self._inner.append(iid)
             self._uid_by_key[key] = uid
         return self._items[uid]
 
-
-    def __getitem__(self, uid):
-        return self._items[uid]
+    def get_item(self, rule, dot, inner=()):
+        rid = self._rule_ids.get(rule, None)
+        if rid is None:
+            rid = len(self._rule_ids)
+            self._rule_ids[rule] = rid
+        iid = 0
+        for state in inner:
+            iid = self._extend(iid, state)
+        return self._get(rid, rule, dot, iid)
+
+    def advance(self, item, dot, rule=None):
+        """
+        Returns the item whose dot has been moved from `item.dot` to `dot`.
+        :param rule: the rule of the new item if it is not that of `item` (e.g. a longer prefix, see trie_earley.py)
+        """
+        uid = item.uid_
+        iid = self._extend(self._inner[uid], item.dot_)
+        if rule is None:
+            return self._get(self._rule[uid], item.rule_, dot, iid)
+        rid = self._rule_ids.get(rule, None)
+        if rid is None:
+            rid = len(self._rule_ids)
+            self._rule_ids[rule] = rid
+        return self._get(rid, rule, dot, iid)
@@ -7,8 +7,7 @@ import itertools
 import argparse
 import sys
 from rule import Rule
-from symbol import is_nonterminal, is_terminal
-from wcfg import WCFG, read_grammar_rules, count_derivations
+from wcfg import WCFG, Forest, read_grammar_rules, count_derivations, iteryields
 from wfsa import WDFSA, make_linear_fsa
 from earley import Earley
 
@@ -26,9 +25,10 @@ def main(args):
         if not forest:
             print 'NO PARSE FOUND'
             continue
+        forest = Forest(forest.iterrules())  # a WCFG over the nodes of the hypergraph (we add rules to it)
         new_rules = []
         for rule in forest:
-            if len(rule.rhs) > 1 and all(map(is_nonterminal, rule.rhs)):
+            if len(rule.rhs) > 1 and all(map(forest.is_nonterminal, rule.rhs)):
                 new_rules.append(Rule(rule.lhs, reversed(rule.rhs), rule.log_prob))
         [forest.add(rule) for rule in new_rules]
         print '# FOREST'
@@ -37,12 +37,16 @@ def main(args):
 
         if args.show_permutations:
             print '# PERMUTATIONS'
-            counts = count_derivations(forest, '[GOAL]')
-            total = 0
-            for p, n in sorted(counts['p'].iteritems(), key=lambda (k, v): k):
+            total = count_derivations(forest, '[GOAL]')
+            shown = 0
+            yields = iteryields(forest, '[GOAL]')
+            for p, n in itertools.islice(yields, args.max_permutations or None):
                 print 'permutation=(%s) derivations=%d' % (' '.join(str(i) for i in p), n)
-                total += n
-            print 'permutations=%d derivations=%d' % (len(counts['p'].keys()), total)
+                shown += 1
+            if args.max_permutations and next(yields, None) is not None:  # not every permutation was enumerated
+                print 'shown=%d derivations=%d' % (shown, total)
+            else:
+                print 'permutations=%d derivations=%d' % (shown, total)
             print
 
 
@@ -64,6 +68,9 @@ def argparser():
     parser.add_argument('--show-permutations',
             action='store_true',
             help='dumps all permutations (use with caution)')
+    parser.add_argument('--max-permutations',
+            type=int, default=0,
+            help='stop after this many permutations (0 means all), derivations are counted regardless')
     parser.add_argument('--verbose', '-v',
             action='store_true',
             help='increase the verbosity level')
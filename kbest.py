@@ -0,0 +1,139 @@
+"""
+Lazy k-best derivations of a forest.
+
+This is Algorithm 3 of
+
+    @inproceedings{Huang+2005:kbest,
+        Author = {Liang Huang and David Chiang},
+        Booktitle = {Proceedings of the Ninth International Workshop on Parsing Technology},
+        Pages = {53--64},
+        Title = {Better k-best Parsing},
+        Year = {2005}
+    }
+
+A derivation of a node is identified by an incoming edge and the rank of the derivation chosen for each of its tail nodes.
+Derivations of a node are enumerated best-first and only on demand,
+thus the cost of the k-best derivations of the goal is roughly that of a Viterbi pass
+(`inference.inside` in the Viterbi semiring) plus O(k |d| log k).
+
+:Authors: - Wilker Aziz
+"""
+
+import heapq
+from inference import edge_weights, inside
+from semiring import Viterbi
+
+
+class KBest(object):
+    """
+    Lazy enumeration of the best derivations of the nodes of a forest.
+
+    >>> from hypergraph import HypergraphBuilder
+    >>> B = HypergraphBuilder()
+    >>> goal, s, x, a, b = B.node('[GOAL]'), B.node('[S]'), B.node('[X]'), B.node('a'), B.node('b')
+    >>> B.add_edge(goal, [s], 0.0); B.add_edge(s, [x, x], -1.0); B.add_edge(x, [a], -1.0); B.add_edge(x, [b], -2.0)
+    >>> H = B.build()
+    >>> for d, score in KBest(H).iterderivations('[GOAL]', 5):
+    ...     print score, ' '.join(H.key(child) for e in reversed(d) for child in H.tail(e) if H.is_terminal(child))
+    -3.0 a a
+    -4.0 a b
+    -4.0 b a
+    -5.0 b b
+    """
+
+    def __init__(self, forest, omega=None):
+        """
+        :param forest: an acyclic hypergraph (see Hypergraph)
+        :param omega: edge weights (see `inference.edge_weights`), defaults to the edges' log probabilities
+        """
+        self.forest = forest
+        self._omega = edge_weights(forest, omega).tolist()
+        self._best = inside(forest, omega=omega, semiring=Viterbi).tolist()
+        self._offset = forest.offset.tolist()
+        self._tail_offset = forest.tail_offset.tolist()
+        self._tails = forest.tails.tolist()
+        self._derivations = {}  # node -> list of (score, edge, ranks) in best-first order
+        self._candidates = {}  # node -> heap of (-score, edge, ranks)
+        self._seen = {}  # node -> set of (edge, ranks) ever pushed
+
+    def tail(self, edge):
+        return self._tails[self._tail_offset[edge]:self._tail_offset[edge + 1]]
+
+    def is_terminal(self, node):
+        return self._offset[node] == self._offset[node + 1]
+
+    def _score(self, edge, ranks):
+        """The score of the derivation that follows an edge and the given derivations (ranks) of its tail nodes."""
+        return sum((self.get(child, rank)[0] for child, rank in zip(self.tail(edge), ranks)
+                    if not self.is_terminal(child)), self._omega[edge])
+
+    def _init(self, node):
+        """The best derivation through each incoming edge uses the best derivation of each tail node."""
+        heap = []
+        best = self._best
+        for edge in xrange(self._offset[node], self._offset[node + 1]):
+            tails = self.tail(edge)
+            heap.append((-sum((best[child] for child in tails), self._omega[edge]), edge, (0,) * len(tails)))
+        heapq.heapify(heap)
+        self._candidates[node] = heap
+        self._seen[node] = set((edge, ranks) for _, edge, ranks in heap)
+        self._derivations[node] = []
+
+    def _push_successors(self, node, edge, ranks):
+        """Pushes the neighbours of a derivation: one tail node at a time moves to its next best derivation."""
+        tails = self.tail(edge)
+        seen = self._seen[node]
+        for i, child in enumerate(tails):
+            if self.is_terminal(child):
+                continue
+            successor = ranks[:i] + (ranks[i] + 1,) + ranks[i + 1:]
+            if (edge, successor) in seen:
+                continue
+            if self.get(child, successor[i]) is None:  # the tail node has no more derivations
+                continue
+            seen.add((edge, successor))
+            heapq.heappush(self._candidates[node], (-self._score(edge, successor), edge, successor))
+
+    def get(self, node, k):
+        """
+        Returns the k-th best derivation (0-based) of a node as a triple (score, edge, ranks),
+        or None if there are no more than k derivations.
+        """
+        if node not in self._derivations:
+            self._init(node)
+        derivations = self._derivations[node]
+        candidates = self._candidates[node]
+        while len(derivations) <= k:
+            if derivations:
+                _, edge, ranks = derivations[-1]
+                self._push_successors(node, edge, ranks)
+            if not candidates:
+                return None
+            score, edge, ranks = heapq.heappop(candidates)
+            derivations.append((-score, edge, ranks))
+        return derivations[k]
+
+    def derivation(self, node, k):
+        """The k-th best derivation of a node as a list of edge ids (in the order of GeneralisedSampling.sample)."""
+        d = []
+        Q = [(node, k)]
+        while Q:
+            parent, rank = Q.pop()
+            _, edge, ranks = self.get(parent, rank)
+            d.append(edge)
+            for child, r in zip(self.tail(edge), ranks):
+                if not self.is_terminal(child):
+                    Q.append((child, r))
+        return d
+
+    def iterderivations(self, goal='[GOAL]', k=1):
+        """
+        Generates up to k pairs (derivation, score) from the best derivation of the goal node to the k-th best.
+        :param goal: the key of the goal node
+        """
+        node = self.forest.fetch(goal)
+        for i in xrange(k):
+            entry = self.get(node, i)
+            if entry is None:
+                break
+            yield self.derivation(node, i), entry[0]
@@ -6,21 +6,29 @@ import argparse
 import sys
 import logging
 import math
+import numpy as np
 from reader import load_grammar
-from collections import defaultdict, Counter
+from collections import defaultdict
 from sentence import make_sentence
 from slice_variable import SliceVariable
 from sliced_earley import SlicedEarley
 from sliced_nederhof import SlicedNederhof
-from topsort import top_sort
+from agenda import ForestInside
 from inference import inside
 from generalisedSampling import GeneralisedSampling
-from symbol import parse_annotated_nonterminal, make_nonterminal
+from symbol import node_label, make_nonterminal
 import time
 import re
-from wcfg import WCFG
+from wcfg import WCFG, OverlayWCFG
 from earley import Earley
+from trie_earley import TrieEarley, SlicedTrieEarley, RuleTrie
 from nederhof import Nederhof
+from cky import CKY, SlicedCKY, BinarisedGrammar
+from item import ItemFactory
+from derivation import DerivationCounter, EdgeTable
+from grammar_index import GrammarIndex, OverlayIndex
+from prefilter import prefilter
+from recogniser import recognise
 from nltk import Tree
 
 
@@ -29,16 +37,17 @@ def inlinetree(t):
     return re.sub(' +', ' ', s)
 
 
-def make_nltk_tree(derivation):
+def make_nltk_tree(derivation, label=str):
     """
     Recursively constructs an nlt Tree from a list of rules.
     @param top: index to the top rule (0 and -1 are the most common values)
+    @param label: returns the string of a node (e.g. Forest.label)
     """
     d = defaultdict(None, ((r.lhs, r) for r in derivation))
 
     def make_tree(sym):
         r = d[sym]
-        return Tree(str(r.lhs), (str(child) if child not in d else make_tree(child) for child in r.rhs))
+        return Tree(label(r.lhs), (label(child) if child not in d else make_tree(child) for child in r.rhs))
     return make_tree(derivation[0].lhs)
 
 
@@ -47,7 +56,8 @@ def get_conditions(d):
     update conditions: the probability of each state of the previous derivation is assigned
     to the condition of that state
     """
-    return {parse_annotated_nonterminal(rule.lhs): rule.log_prob for rule in d}
+    # nodes are (symbol, start, end) triples, except for the goal which has no slice variable
+    return {rule.lhs: rule.log_prob for rule in d if type(rule.lhs) is tuple}
 
 
 def permutation_length(nonterminal):
@@ -76,15 +86,20 @@ def initialise(wcfg, wfsa, root, goal, intersection):
 
     logging.debug('Creating a smaller grammar for initial conditions...')
     for line in wcfg:
-        if 0 < permutation_length(line.lhs) <= 2:
-            smaller.add(line)
-        elif line.lhs == root or line.lhs == '[UNK]':
-            smaller.add(line)
+        lhs = wcfg.decode(line.lhs)
+        if 0 < permutation_length(lhs) <= 2:
+            smaller.add(wcfg.decode_rule(line))
+        elif lhs == root or lhs == '[UNK]':
+            smaller.add(wcfg.decode_rule(line))
 
     if intersection == 'nederhof':
         init_parser = Nederhof(smaller, wfsa)
     elif intersection == 'earley':
         init_parser = Earley(smaller, wfsa)
+    elif intersection == 'trie-earley':
+        init_parser = TrieEarley(smaller, wfsa)
+    elif intersection == 'cky':
+        init_parser = CKY(smaller, wfsa)
     else:
         raise NotImplementedError('I do not know this algorithm: %s' % intersection)
 
@@ -97,37 +112,48 @@ def initialise(wcfg, wfsa, root, goal, intersection):
     else:
         logging.debug('Forest: rules=%d', len(init_forest))
 
-        logging.debug('Init Topsorting...')
-        # sort the forest
-        sorted_nodes = top_sort(init_forest)
-
-        # calculate the inside weight of the sorted forest
+        # calculate the inside weight of the forest (nodes are visited in the topological order recorded by the parser)
         logging.debug('Init Inside...')
-        init_inside_prob = inside(init_forest, sorted_nodes)
+        init_inside_prob = inside(init_forest)
 
         logging.debug('Init Sampling...')
         gen_sampling = GeneralisedSampling(init_forest, init_inside_prob)
-        init_d = gen_sampling.sample(goal)
+        init_d = [init_forest.rule(e) for e in gen_sampling.sample(goal)]
 
-    return get_conditions(init_d)
+    # the smaller grammar is made of strings, slice variables are indexed by symbols of the original grammar
+    return {(wcfg.encode(sym), start, end): theta for (sym, start, end), theta in get_conditions(init_d).iteritems()}
 
 
 def sliced_sampling(wcfg, wfsa, root='[S]', goal='[GOAL]', n_samples=100, n_burn=100, max_iterations=1000, a=[0.1, 0.1],
-                    b=[1.0, 1.0], intersection='nederhof', grammarfmt='milos'):
+                    b=[1.0, 1.0], intersection='nederhof', grammarfmt='milos', index=None, viable=None):
     """
     Sample N derivations in maximum K iterations with Slice Sampling
+    :param index: a GrammarIndex shared by the parsers of every iteration (built if not given)
+    :param viable: a ViableSet shared by the parsers of every iteration (see recogniser.py)
     """
     
+    samples = DerivationCounter()
+    edges = EdgeTable()  # derivations come from different forests, thus we intern their edges
+    if index is None:
+        index = GrammarIndex(wcfg)
+    item_factory = ItemFactory()  # reused by the parsers of every iteration
+
     if intersection == 'nederhof':
         logging.info('Using Nederhof parser')
-        parser_type = SlicedNederhof
+        make_parser = lambda slice_vars: SlicedNederhof(wcfg, wfsa, slice_vars, index, item_factory, viable)
     elif intersection == 'earley':
-        parser_type = SlicedEarley
         logging.info('Using Earley parser')
+        make_parser = lambda slice_vars: SlicedEarley(wcfg, wfsa, slice_vars, index, item_factory, viable)
+    elif intersection == 'trie-earley':
+        logging.info('Using Earley parser over RHS prefixes')
+        trie = RuleTrie(wcfg)  # shared by the parsers of every iteration
+        make_parser = lambda slice_vars: SlicedTrieEarley(wcfg, wfsa, slice_vars, index, item_factory, viable, trie)
+    elif intersection == 'cky':
+        logging.info('Using CKY parser')
+        grammar = BinarisedGrammar(wcfg)  # shared by the parsers of every iteration
+        make_parser = lambda slice_vars: SlicedCKY(wcfg, wfsa, slice_vars, grammar)
     else:
         raise NotImplementedError('I do not know this algorithm: %s' % intersection)
-    
-    samples = []
 
     # the initial conditions function is only implemented for the 'milos' grammarformat,
     # this could be extended to other grammar formats as well.
@@ -142,18 +168,19 @@ def sliced_sampling(wcfg, wfsa, root='[S]', goal='[GOAL]', n_samples=100, n_burn
         slice_vars = SliceVariable(a=a[0], b=b[0])
 
     it = 0
-    while len(samples) < n_samples and it < max_iterations:
+    while samples.total < n_samples and it < max_iterations:
         it += 1
         if it % 10 == 0:
-            logging.info('it=%d samples=%d', it, len(samples))
+            logging.info('it=%d samples=%d', it, samples.total)
         
-        d = sliced_sample(root, goal, parser_type(wcfg, wfsa, slice_vars))
+        item_factory.clear()
+        d = sliced_sample(root, goal, make_parser(slice_vars))
 
         if d is not None:
             if n_burn > 0:  # in case we are burning derivations, we do not add them to the list
                 n_burn -= 1  # but we still use them to update the slice variables
             else:
-                samples.append(d)
+                samples.add(edges.encode(d))
 
             # because we have a derivation
             # we reset the assignments of the slice variables
@@ -169,29 +196,46 @@ def sliced_sampling(wcfg, wfsa, root='[S]', goal='[GOAL]', n_samples=100, n_burn
             # similarly, we do not change the parameters of the beta
             slice_vars.reset()
 
-    counts = Counter(tuple(d) for d in samples)
-    for d, n in counts.most_common():
+    for d, n in samples.most_common():
+        d = edges.decode(d)
         score = sum(r.log_prob for r in d)
-        print '# n=%s estimate=%s score=%s' % (n, float(n)/len(samples), score)
-        tree = make_nltk_tree(d)
+        print '# n=%s estimate=%s score=%s' % (n, float(n)/samples.total, score)
+        tree = make_nltk_tree(d, lambda node: node_label(node, wcfg.decode))
         inline_tree = inlinetree(tree)
         print inline_tree, "\n"
 
 
-def edge_uniform_weight(edge, goal, slicevars):
+def edge_uniform_weights(forest, goal, slicevars):
     """
-    Return a uniform view of the edge's log-probability.
-    :param edge: an edge
+    Return a uniform view of the log-probabilities of the edges in a forest.
+    :param forest: a Hypergraph
     :param goal: the goal node (gets a special treatment because there are no slice variables for it)
     :param slicevars: a SliceVariable object
-    :returns: 1/beta.pdf(u_s; a, b)
+    :returns: a vector whose entries are 1/beta.pdf(u_s; a, b) where s is the head of an edge
     """
-    if edge.lhs == goal:
-        # rules rooted by the goal symbol have probability 1 (or 0 in log-domain) and there is no slice variable for the goal symbol
-        return 0.0
-    else:
-        sym, start, end = parse_annotated_nonterminal(edge.lhs)
-        return slicevars.weight(sym, start, end, edge.log_prob)
+    # rules rooted by the goal symbol have probability 1 (or 0 in log-domain) and there is no slice variable for the goal symbol
+    weights = np.zeros(len(forest))
+    edges = np.flatnonzero(forest.heads != goal)
+    weights[edges] = slicevars.weights([forest.key(head) for head in forest.heads[edges].tolist()], forest.weights[edges])
+    return weights
+
+
+def slice_weight(slicevars):
+    """
+    Return the uniform weight of an edge (see `edge_uniform_weights`) as a function of (rule, start, end).
+    :param slicevars: a SliceVariable object
+    :returns: a function that memoises the weight of each state
+    """
+    weights = {}
+
+    def weight(rule, start, end):
+        state = (rule.lhs, start, end)
+        w = weights.get(state, None)
+        if w is None:
+            w = weights[state] = slicevars.weight(rule.lhs, start, end, rule.log_prob)
+        return w
+
+    return weight
 
 
 def sliced_sample(root, goal, parser):
@@ -201,7 +245,12 @@ def sliced_sample(root, goal, parser):
     """
 
     logging.debug('Parsing...')
-    forest = parser.do(root, goal)
+    if isinstance(parser, ForestInside):
+        # the parser adds up inside weights (under the uniform weight function) as items complete
+        forest, uniform_weights, inside_prob = parser.do_inside(root, goal, weight=slice_weight(parser.slice_vars))
+    else:
+        forest = parser.do(root, goal)
+        uniform_weights, inside_prob = None, None
 
     if not forest:
         logging.debug('NO PARSE FOUND')
@@ -209,23 +258,21 @@ def sliced_sample(root, goal, parser):
 
     else:
         logging.debug('Forest: rules=%d', len(forest))
-        logging.debug('Topsorting...')
-
-        # sort the forest
-        sorted_nodes = top_sort(forest)
-
-        # calculate the inside weight of the sorted forest
-        logging.debug('Inside...')
-        # here we compute inside weights, however with a new uniform weight function over edges
-        inside_prob = inside(forest, sorted_nodes, omega=lambda edge: edge_uniform_weight(edge, goal, parser.slice_vars))
+        if inside_prob is None:
+            # calculate the inside weight of the forest (nodes are visited in the topological order recorded by the parser)
+            logging.debug('Inside...')
+            # here we compute inside weights, however with a new uniform weight function over edges
+            uniform_weights = edge_uniform_weights(forest, forest.fetch(goal), parser.slice_vars)
+            inside_prob = inside(forest, omega=uniform_weights)
 
         logging.debug('Sampling...')
         # retrieve a random derivation, with respect to the inside weight distribution
         # again, we sample with respect to a uniform function over edges
-        gen_sampling = GeneralisedSampling(forest, inside_prob, omega=lambda edge: edge_uniform_weight(edge, goal, parser.slice_vars))
+        gen_sampling = GeneralisedSampling(forest, inside_prob, omega=uniform_weights)
         d = gen_sampling.sample(goal)
 
-        return d
+        # edge ids are specific to this forest, thus we return rules over node keys
+        return [forest.rule(e) for e in d]
 
 
 def main(args):
@@ -248,28 +295,49 @@ def core(args):
 
     logging.info('Loading grammar...')
     if args.log:
-        wcfg = load_grammar(args.grammar, args.grammarfmt, transform=math.log)
+        wcfg = load_grammar(args.grammar, args.grammarfmt, transform=math.log, cache=not args.no_cache, jobs=args.load_jobs)
     else:
-        wcfg = load_grammar(args.grammar, args.grammarfmt, transform=float)
+        wcfg = load_grammar(args.grammar, args.grammarfmt, transform=float, cache=not args.no_cache, jobs=args.load_jobs)
 
     logging.info(' %d rules', len(wcfg))
+    index = GrammarIndex(wcfg)
 
     jobs = [input_str.strip() for input_str in args.input]
 
     for jid, input_str in enumerate(jobs, 1):
         sentence, extra_rules = make_sentence(input_str, wcfg.terminals, args.unkmodel, args.default_symbol, split_bars=args.split_input)
         logging.info('[%d/%d] Parsing %d words: %s', jid, len(jobs), len(sentence), ' '.join(sentence.words))
-        wcfg.update(extra_rules)
+        # the base grammar is shared by all sentences, rules for unknown words only exist in this sentence's overlay
+        if extra_rules:
+            sentence_wcfg = OverlayWCFG(wcfg, extra_rules)
+            sentence_index = OverlayIndex(index, sentence_wcfg)
+        else:
+            sentence_wcfg, sentence_index = wcfg, index
 
         start = time.time()
-
-        sliced_sampling(wcfg, sentence.fsa,
+        if args.no_prefilter:
+            grammar, grammar_index = sentence_wcfg, sentence_index
+        else:
+            grammar = prefilter(sentence_wcfg, sentence.fsa, make_nonterminal(args.start), sentence_index)
+            grammar_index = GrammarIndex(grammar)
+        viable = None
+        if not args.no_recogniser:
+            # the grammar is the same in every iteration, thus a single boolean pass prunes all of them
+            viable = recognise(grammar, sentence.fsa, make_nonterminal(args.start))
+            if viable is None:
+                print 'NO PARSE FOUND'
+                logging.info("Duration %ss", time.time() - start)
+                continue
+
+        sliced_sampling(grammar, sentence.fsa,
                         make_nonterminal(args.start),
                         make_nonterminal(args.goal),
                         args.samples, args.burn, args.max,
                         args.a, args.b,
                         args.intersection,
-                        args.grammarfmt)
+                        args.grammarfmt,
+                        grammar_index,
+                        viable)
 
         end = time.time()
         logging.info("Duration %ss", end - start)
@@ -292,8 +360,8 @@ def argparser():
             action='store_true',
             help='assumes the input is given separated by triple bars')
     parser.add_argument('--intersection',
-            type=str, default='nederhof', choices=['nederhof', 'earley'],
-            help="intersection algorithm (nederhof: bottom-up; earley: top-down)")
+            type=str, default='nederhof', choices=['nederhof', 'earley', 'trie-earley', 'cky'],
+            help="intersection algorithm (nederhof: bottom-up; earley: top-down; trie-earley: top-down over RHS prefixes shared by rules; cky: bottom-up over spans, linear inputs only)")
     parser.add_argument('--log',
             action='store_true',
             help='applies the log transform to the probabilities of the rules')
@@ -325,6 +393,18 @@ def argparser():
     parser.add_argument('--default-symbol',
             type=str, default='X',
             help='default nonterminal (use for pass-through rules)')
+    parser.add_argument('--no-prefilter',
+            action='store_true',
+            help='intersect the whole grammar rather than the rules that might parse the sentence')
+    parser.add_argument('--no-recogniser',
+            action='store_true',
+            help='skip the boolean recognition pass which rejects unparsable sentences and prunes the intersection')
+    parser.add_argument('--load-jobs',
+            type=int, default=1,
+            help='number of processes used to parse the grammar when it is not cached')
+    parser.add_argument('--no-cache',
+            action='store_true',
+            help='neither read nor write the compiled grammar cache')
     parser.add_argument('--verbose', '-v',
             action='store_true',
             help='increase the verbosity level')
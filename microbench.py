@@ -0,0 +1,138 @@
+"""
+Micro-benchmark for the objects the intersection creates and hashes the most: rules and items.
+
+It compares the current (slotted, hash-caching) Rule and Item with the previous implementations
+(reproduced below as LegacyRule and LegacyItem), reporting objects created per second,
+hashes per second and bytes per object.
+
+    python microbench.py -n 200000
+
+:Authors: - Wilker Aziz
+"""
+
+import argparse
+import sys
+import time
+from rule import Rule
+from item import Item
+
+
+class LegacyRule(object):
+    """The previous Rule: a __dict__ per instance and a tuple hashed on every call."""
+
+    def __init__(self, lhs, rhs, log_prob):
+        self.lhs_ = lhs
+        self.rhs_ = tuple(rhs)
+        self.log_prob_ = log_prob
+
+    def __eq__(self, other):
+        return self.lhs_ == other.lhs_ and self.rhs_ == other.rhs_ and self.log_prob_ == other.log_prob_
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    def __hash__(self):
+        return hash((self.lhs_, self.rhs_, self.log_prob_))
+
+    @property
+    def rhs(self):
+        return self.rhs_
+
+
+class LegacyItem(object):
+    """The previous Item: a __dict__ per instance."""
+
+    def __init__(self, sid, rule, dot, inner):
+        self.uid_ = sid
+        self.rule_ = rule
+        self.dot_ = dot
+        self.inner_ = tuple(inner)
+        self.start_ = inner[0] if inner else dot
+        n = len(inner)
+        self.next_ = rule.rhs_[n] if n < len(rule.rhs_) else None
+
+    def __eq__(self, other):
+        return self.uid_ == other.uid_
+
+    def __hash__(self):
+        return hash(self.uid_)
+
+
+def sizeof(obj):
+    """Shallow size of an object including its __dict__ (if any)."""
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def rate(n, seconds):
+    return n / seconds if seconds > 0 else float('inf')
+
+
+def bench(rule_type, item_type, n, repeats):
+    """Returns a dict of measurements for a pair of rule and item types."""
+    results = {}
+    specs = [('[X%d]' % (i % 100), ('[Y%d]' % (i % 37), '[Z%d]' % (i % 53), 'w%d' % i), -0.1 * (i % 10))
+             for i in xrange(n)]
+
+    t0 = time.time()
+    rules = [rule_type(lhs, rhs, w) for lhs, rhs, w in specs]
+    results['rule/s created'] = rate(n, time.time() - t0)
+
+    t0 = time.time()
+    for _ in xrange(repeats):
+        for r in rules:
+            hash(r)
+    results['rule/s hashed'] = rate(n * repeats, time.time() - t0)
+
+    # keys of the form (rule, dot, inner) as hashed by the tuple-keyed item store
+    t0 = time.time()
+    keys = {}
+    for _ in xrange(repeats):
+        for i, r in enumerate(rules):
+            keys[(r, i % 50, (i % 7,))] = i
+    results['key/s hashed'] = rate(n * repeats, time.time() - t0)
+
+    t0 = time.time()
+    items = [item_type(i, r, i % 50, (i % 7, i % 11)) for i, r in enumerate(rules)]
+    results['item/s created'] = rate(n, time.time() - t0)
+
+    t0 = time.time()
+    seen = set()
+    for _ in xrange(repeats):
+        for item in items:
+            seen.add(item)
+    results['item/s hashed'] = rate(n * repeats, time.time() - t0)
+
+    results['bytes/rule'] = sizeof(rules[0])
+    results['bytes/item'] = sizeof(items[0])
+    return results
+
+
+def main(args):
+    before = bench(LegacyRule, LegacyItem, args.n, args.repeats)
+    after = bench(Rule, Item, args.n, args.repeats)
+    print '%-16s %14s %14s %8s' % ('measure', 'before', 'after', 'ratio')
+    for key in sorted(before):
+        print '%-16s %14.0f %14.0f %8.2f' % (key, before[key], after[key], float(after[key]) / before[key])
+
+
+def argparser():
+    """parse command line arguments"""
+    parser = argparse.ArgumentParser(prog='microbench')
+
+    parser.description = 'Rule and Item micro-benchmark'
+    parser.formatter_class = argparse.ArgumentDefaultsHelpFormatter
+
+    parser.add_argument('-n',
+            type=int, default=200000,
+            help='number of objects')
+    parser.add_argument('--repeats',
+            type=int, default=5,
+            help='how many times each object is hashed')
+
+    return parser
+
+if __name__ == '__main__':
+    main(argparser().parse_args())
@@ -17,32 +17,51 @@ This is an implementation of the bottom-up intersection by Nederhof and Satta (2
 
 from collections import defaultdict, deque
 from itertools import ifilter
-from agenda import Agenda, ActiveQueue, get_cfg
+from functools import partial
+from agenda import Agenda, ActiveQueue, PriorityQueue, ForestInside, get_cfg
+from best_first import ItemPriority
 from item import ItemFactory
-from symbol import is_terminal, make_symbol, is_nonterminal
-from rule import Rule
-from wcfg import WCFG
+from grammar_index import GrammarIndex
 import logging
 
 
-class Nederhof(object):
+class Nederhof(ForestInside):
     """
     This is an implementation of the CKY-inspired intersection due to Nederhof and Satta (2008).
     """
 
-    def __init__(self, wcfg, wfsa):
+    def __init__(self, wcfg, wfsa, index=None, item_factory=None, viable=None,
+                 best_first=False, heuristic=None, stop_early=False):
+        """
+        :param index: a GrammarIndex for `wcfg` (built if not given, share it across parsers of the same grammar)
+        :param item_factory: an ItemFactory (created if not given, clear it before reusing it for another parse)
+        :param viable: a ViableSet (see recogniser.py), if given, nonterminals over spans outside it are skipped
+        :param best_first: pops active items by their inside score (see best_first.py)
+        :param heuristic: an outside estimate added to the inside score of items (e.g. best_first.OutsideEstimates), i.e. A*
+        :param stop_early: stops as soon as the root is proven over the automaton (best-first or A* only),
+            the forest then contains the best derivation (and those found so far)
+        """
         self._wcfg = wcfg
-        self._wfsa = wfsa
-        self._agenda = Agenda(active_container_type=ActiveQueue)
-        self._firstsym = defaultdict(set)  # index rules by their first RHS symbol
-        self._item_factory = ItemFactory()
+        self._wfsa = wcfg.encode_fsa(wfsa)
+        self._priority = ItemPriority(heuristic) if best_first or heuristic is not None else None
+        if stop_early and self._priority is None:
+            raise ValueError('I can only stop early with a best-first or A* agenda')
+        self._stop_early = stop_early
+        self._agenda = Agenda(active_container_type=ActiveQueue if self._priority is None else partial(PriorityQueue, self._priority))
+        self._index = GrammarIndex(wcfg) if index is None else index  # indexes rules by their first RHS symbol
+        self._item_factory = ItemFactory() if item_factory is None else item_factory
+        self._viable_set = viable
 
     def get_item(self, rule, dot, inner=[]):
         return self._item_factory.get_item(rule, dot, inner)
     
     def advance(self, item, dot):
         """returns a new item whose dot has been advanced"""
-        return self.get_item(item.rule, dot, item.inner + (item.dot,))
+        return self._item_factory.advance(item, dot)
+
+    def is_viable(self, item):
+        """Whether the LHS of a complete item takes part in some parse over the item's span."""
+        return self._viable_set is None or (item.rule.lhs, item.start, item.dot) in self._viable_set
         
     def add_symbol(self, sym, sfrom, sto):
         """
@@ -61,31 +80,45 @@ class Nederhof(object):
 
         # you may interpret this as a delayed axiom
         # every compatible rule in the grammar
-        for r in self._firstsym.get(sym, set()):  
-            self._agenda.add(self.get_item(r, sto, inner=(sfrom,)))  # can be interpreted as a lazy axiom
+        viable = self._viable_set
+        for r in self._index.first(sym):
+            if viable is None or viable.can_start(r.lhs, sfrom):
+                self._agenda.add(self.get_item(r, sto, inner=(sfrom,)))  # can be interpreted as a lazy axiom
 
         return True
 
     def axioms(self):
         """
         The axioms of the program are based on the FSA transitions. 
+        Rules are indexed by their first RHS symbol once per grammar (see GrammarIndex),
+        you may interpret them as a sort of lazy axiom.
         """
-        # you may interpret the following as a sort of lazy axiom (based on grammar rules)
-        for r in self._wcfg:
-            self._firstsym[r.rhs[0]].add(r)
         # these are axioms based on the transitions of the automaton
         for sfrom, sto, sym, w in self._wfsa.iterarcs():
             self.add_symbol(sym, sfrom, sto)  
 
-    def inference(self):
-        """Exhausts the queue of active items"""
+    def inference(self, root=None):
+        """
+        Exhausts the queue of active items
+        :param root: the start symbol (encoded), with `stop_early` inference stops once it is proven over the automaton
+        """
         agenda = self._agenda
+        priority = self._priority
+        wfsa = self._wfsa
         while agenda:
             item = agenda.pop()  # always returns an ACTIVE item
             # complete other items (by calling add_symbol), in case the input item is complete
             if item.is_complete():
+                if not self.is_viable(item):  # the symbol takes no part in any parse
+                    continue
+                if priority is not None:  # in best-first order the first proof of a symbol is its best
+                    priority.prove(item.rule.lhs, item.start, item.dot, priority.inside(item))
                 self.add_symbol(item.rule.lhs, item.start, item.dot)  # prove the symbol
                 agenda.make_complete(item)  # mark the item as complete
+                if self._forest is not None:
+                    self._forest.add(item)
+                if self._stop_early and item.rule.lhs == root and wfsa.is_initial(item.start) and wfsa.is_final(item.dot):
+                    break
             else:
                 # merges the input item with previously completed items effectively moving the input item's dot forward
                 agenda.make_passive(item)
@@ -94,6 +127,7 @@ class Nederhof(object):
 
     def do(self, root='[S]', goal='[GOAL]'):
         """Runs the program and returns the intersected CFG"""
+        root = self._wcfg.encode(root)
         self.axioms()
-        self.inference()
-        return get_cfg(goal, root, self._wfsa, self._agenda)
+        self.inference(root)
+        return get_cfg(goal, root, self._wfsa, self._agenda, self._wcfg)
@@ -8,15 +8,27 @@ import argparse
 import logging
 import sys
 import math
+import numpy as np
 from reader import load_grammar
-from collections import Counter, defaultdict
-from symbol import make_nonterminal
+from collections import defaultdict
+from symbol import make_nonterminal, node_label
 from earley import Earley
+from trie_earley import TrieEarley
 from nederhof import Nederhof
-from topsort import top_sort
+from agenda import ForestInside
+from cky import CKY
+from binarise import binarise
+from item import ItemFactory
+from derivation import DerivationCounter
+from grammar_index import GrammarIndex, OverlayIndex
+from prefilter import prefilter
+from recogniser import recognise
+from wcfg import OverlayWCFG
 from sentence import make_sentence
-from inference import inside
+from inference import inside, posteriors
 from generalisedSampling import GeneralisedSampling
+from kbest import KBest
+from best_first import OutsideEstimates
 from nltk import Tree
 
 
@@ -25,37 +37,68 @@ def inlinetree(t):
     return re.sub(' +', ' ', s)
 
 
-def make_nltk_tree(derivation):
+def make_nltk_tree(derivation, label=str, binarisation=None):
     """
     Recursively constructs an nlt Tree from a list of rules.
     @param top: index to the top rule (0 and -1 are the most common values)
+    @param label: returns the string of a node (e.g. Forest.label)
+    @param binarisation: if the grammar was binarised (see binarise.Binarisation), the tree is made of the original rules
     """
+    if binarisation is not None:
+        derivation = binarisation.restore(derivation)
     d = defaultdict(None, ((r.lhs, r) for r in derivation))
 
     def make_tree(sym):
         r = d[sym]
-        return Tree(str(r.lhs), (str(child) if child not in d else make_tree(child) for child in r.rhs))
+        return Tree(label(r.lhs), (label(child) if child not in d else make_tree(child) for child in r.rhs))
     return make_tree(derivation[0].lhs)
 
 
-def exact_sample(wcfg, wfsa, root='[S]', goal='[GOAL]', n=1, intersection='nederhof'):
+def exact_sample(wcfg, wfsa, root='[S]', goal='[GOAL]', n=1, intersection='nederhof', index=None, item_factory=None,
+                 batch=False, kbest=0, marginals=False, viable=None, binarisation=None, agenda='queue', stop_early=False):
     """
     Sample a derivation given a wcfg and a wfsa, with exact sampling, a
     form of MC-sampling
+    :param index: a GrammarIndex shared across sentences
+    :param item_factory: an ItemFactory reused across sentences (it is cleared before parsing)
+    :param batch: draw all samples at once (see GeneralisedSampling.sample_counts)
+    :param kbest: if positive, prints the k best derivations (and their exact probabilities) instead of sampling
+    :param marginals: prints the exact posterior marginals of nodes and edges (inside-outside) instead of sampling
+    :param viable: a ViableSet which prunes the intersection (see recogniser.py), cky does not need one
+    :param binarisation: how the grammar was binarised (see binarise.py), derivations are printed in the original rules
+    :param agenda: order of the active items of nederhof and earley: 'queue', 'best-first' or 'astar' (see best_first.py)
+    :param stop_early: stops the intersection once the best derivation is proven (best-first or astar only)
     """
-    samples = []
-
+    samples = DerivationCounter()
+    if item_factory is not None:
+        item_factory.clear()
+
+    if agenda != 'queue' and intersection not in ('nederhof', 'earley'):
+        raise NotImplementedError('I can only use the %s agenda with nederhof or earley' % agenda)
+    # A* estimates come from the grammar of this sentence, they are tighter than those of the whole grammar
+    heuristic = OutsideEstimates(wcfg, root) if agenda == 'astar' else None
     if intersection == 'nederhof':
-        parser = Nederhof(wcfg, wfsa)
+        parser = Nederhof(wcfg, wfsa, index, item_factory, viable, agenda == 'best-first', heuristic, stop_early)
         logging.info('Using Nederhof parser')
     elif intersection == 'earley':
-        parser = Earley(wcfg, wfsa)
+        parser = Earley(wcfg, wfsa, index, item_factory, viable, agenda == 'best-first', heuristic, stop_early)
         logging.info('Using Earley parser')
+    elif intersection == 'trie-earley':
+        parser = TrieEarley(wcfg, wfsa, index, item_factory, viable)
+        logging.info('Using Earley parser over RHS prefixes')
+    elif intersection == 'cky':
+        parser = CKY(wcfg, wfsa)
+        logging.info('Using CKY parser')
     else:
         raise NotImplementedError('I do not know this algorithm: %s' % intersection)
 
     logging.debug('Parsing...')
-    forest = parser.do(root, goal)
+    if isinstance(parser, ForestInside) and agenda == 'queue':
+        # the parser adds up inside weights as items complete
+        forest, _, inside_prob = parser.do_inside(root, goal)
+    else:
+        forest = parser.do(root, goal)
+        inside_prob = None
 
     if not forest:
         print 'NO PARSE FOUND'
@@ -64,34 +107,58 @@ def exact_sample(wcfg, wfsa, root='[S]', goal='[GOAL]', n=1, intersection='neder
 
         logging.debug('Forest: rules=%d', len(forest))
 
-        logging.debug('Topsorting...')
-        # sort the forest
-        sorted_nodes = top_sort(forest)
-
-        # calculate the inside weight of the sorted forest
-        logging.debug('Inside...')
-        inside_prob = inside(forest, sorted_nodes)
+        if inside_prob is None:
+            # calculate the inside weight of the forest (nodes are visited in the topological order recorded by the parser)
+            logging.debug('Inside...')
+            inside_prob = inside(forest)
+
+        if marginals:
+            logging.debug('Outside...')
+            edge_posterior, node_posterior = posteriors(forest, goal)
+            print '# node posteriors'
+            for node in np.argsort(-node_posterior, kind='mergesort'):
+                if forest.is_nonterminal(node) and node_posterior[node] > 0:
+                    print '%s\t%s' % (node_posterior[node], forest.label(node))
+            print '# edge posteriors'
+            for e in np.argsort(-edge_posterior, kind='mergesort'):
+                if edge_posterior[e] > 0:
+                    print '%s\t%s -> %s' % (edge_posterior[e], forest.label(forest.head(e)),
+                                            ' '.join(forest.label(child) for child in forest.tail(e)))
+            print
+            return True
+
+        if kbest > 0:
+            logging.debug('K-best...')
+            for k, (d, score) in enumerate(KBest(forest).iterderivations(goal, kbest), 1):
+                prob = math.exp(score - inside_prob[forest.fetch(goal)])
+                print '# k=%s prob=%s score=%s' % (k, prob, score)
+                tree = make_nltk_tree([forest.rule(e) for e in d], lambda node: node_label(node, wcfg.decode), binarisation)
+                print inlinetree(tree), "\n"
+            return True
 
         gen_sampling = GeneralisedSampling(forest, inside_prob)
 
         logging.debug('Sampling...')
-        it = 0
-        while len(samples) < n:
-            it += 1
-            if it % 10 == 0:
-                logging.info('%d/%d', it, n)
-
-            # retrieve a random derivation, with respect to the inside weight distribution
-            d = gen_sampling.sample(goal)
-
-            samples.append(d)
-
-        counts = Counter(tuple(d) for d in samples)
-        for d, n in counts.most_common():
-            score = sum(r.log_prob for r in d)
-            prob = math.exp(score - inside_prob[goal])
-            print '# n=%s estimate=%s prob=%s score=%s' % (n, float(n)/len(samples), prob, score)
-            tree = make_nltk_tree(d)
+        if batch:
+            # unique derivations and their counts
+            samples.update(gen_sampling.sample_counts(n, goal))
+        else:
+            it = 0
+            while samples.total < n:
+                it += 1
+                if it % 10 == 0:
+                    logging.info('%d/%d', it, n)
+
+                # retrieve a random derivation, with respect to the inside weight distribution
+                d = gen_sampling.sample(goal)
+
+                samples.add(d)
+
+        for d, n in samples.most_common():
+            score = sum(forest.weight(e) for e in d)
+            prob = math.exp(score - inside_prob[forest.fetch(goal)])
+            print '# n=%s estimate=%s prob=%s score=%s' % (n, float(n)/samples.total, prob, score)
+            tree = make_nltk_tree([forest.rule(e) for e in d], lambda node: node_label(node, wcfg.decode), binarisation)
             inline_tree = inlinetree(tree)
             print inline_tree, "\n"
 
@@ -116,10 +183,16 @@ def core(args):
 
     logging.info('Loading grammar...')
     if args.log:
-        wcfg = load_grammar(args.grammar, args.grammarfmt, transform=math.log)
+        wcfg = load_grammar(args.grammar, args.grammarfmt, transform=math.log, cache=not args.no_cache, jobs=args.load_jobs)
     else:
-        wcfg = load_grammar(args.grammar, args.grammarfmt, transform=float)
+        wcfg = load_grammar(args.grammar, args.grammarfmt, transform=float, cache=not args.no_cache, jobs=args.load_jobs)
     logging.info(' %d rules', len(wcfg))
+    binarisation = None
+    if args.binarise:
+        wcfg, binarisation = binarise(wcfg, args.binarise, share=not args.binarise_per_lhs)
+        logging.info(' %d rules after %s binarisation (%d intermediate symbols)', len(wcfg), args.binarise, len(binarisation))
+    index = GrammarIndex(wcfg)
+    item_factory = ItemFactory()
 
     start_symbol = make_nonterminal(args.start)
     goal_symbol = make_nonterminal(args.goal)
@@ -128,10 +201,29 @@ def core(args):
     for jid, input_str in enumerate(jobs, 1):
         sentence, extra_rules = make_sentence(input_str, wcfg.terminals, args.unkmodel, args.default_symbol, split_bars=args.split_input)
         logging.info('[%d/%d] Parsing %d words: %s', jid, len(jobs), len(sentence), ' '.join(sentence.words))
-        wcfg.update(extra_rules)
+        # the base grammar is shared by all sentences, rules for unknown words only exist in this sentence's overlay
+        if extra_rules:
+            sentence_wcfg = OverlayWCFG(wcfg, extra_rules)
+            sentence_index = OverlayIndex(index, sentence_wcfg)
+        else:
+            sentence_wcfg, sentence_index = wcfg, index
 
         start = time.time()
-        exact_sample(wcfg, sentence.fsa, start_symbol, goal_symbol, args.samples, args.intersection)
+        if args.no_prefilter:
+            grammar, grammar_index = sentence_wcfg, sentence_index
+        else:
+            grammar = prefilter(sentence_wcfg, sentence.fsa, start_symbol, sentence_index)
+            grammar_index = GrammarIndex(grammar)
+        viable = None
+        if not args.no_recogniser and args.intersection != 'cky':  # the CKY chart is itself a recognition pass
+            # a boolean pass decides whether the sentence can be parsed at all before the weighted intersection
+            viable = recognise(grammar, sentence.fsa, start_symbol)
+            if viable is None:
+                print 'NO PARSE FOUND'
+                logging.info("Duration %ss", time.time() - start)
+                continue
+        exact_sample(grammar, sentence.fsa, start_symbol, goal_symbol, args.samples, args.intersection, grammar_index, item_factory,
+                     args.batch, args.kbest, args.posteriors, viable, binarisation, args.agenda, args.stop_early)
         end = time.time()
         logging.info("Duration %ss", end - start)
 
@@ -153,8 +245,15 @@ def argparser():
             type=argparse.FileType('r'), default=sys.stdin,
             help='input corpus (one sentence per line)')
     parser.add_argument('--intersection',
-            type=str, default='nederhof', choices=['nederhof', 'earley'],
-            help="intersection algorithm (nederhof: bottom-up; earley: top-down)")
+            type=str, default='nederhof', choices=['nederhof', 'earley', 'trie-earley', 'cky'],
+            help="intersection algorithm (nederhof: bottom-up; earley: top-down; trie-earley: top-down over RHS prefixes shared by rules; cky: bottom-up over spans, linear inputs only)")
+    parser.add_argument('--agenda',
+            type=str, default='queue', choices=['queue', 'best-first', 'astar'],
+            help="order in which nederhof and earley process items (best-first: by inside score; astar: plus an outside estimate from the grammar)")
+    parser.add_argument('--stop-early',
+            action='store_true',
+            help='stops intersecting once the best derivation is proven (needs --agenda best-first or astar, e.g. with --kbest 1), '
+                 'probabilities are then relative to the part of the forest explored')
     parser.add_argument('--split-input',
             action='store_true',
             help='assumes the input is given separated by triple bars')
@@ -177,6 +276,24 @@ def argparser():
     parser.add_argument('--default-symbol',
             type=str, default='X',
             help='default nonterminal (use for pass-through rules)')
+    parser.add_argument('--binarise',
+            type=str, default=None, choices=['left', 'right'],
+            help='binarises the grammar before parsing (derivations are printed in the original rules)')
+    parser.add_argument('--binarise-per-lhs',
+            action='store_true',
+            help='intermediate symbols of --binarise are specific to the LHS of each rule rather than shared')
+    parser.add_argument('--no-prefilter',
+            action='store_true',
+            help='intersect the whole grammar rather than the rules that might parse the sentence')
+    parser.add_argument('--no-recogniser',
+            action='store_true',
+            help='skip the boolean recognition pass which rejects unparsable sentences and prunes the intersection')
+    parser.add_argument('--load-jobs',
+            type=int, default=1,
+            help='number of processes used to parse the grammar when it is not cached')
+    parser.add_argument('--no-cache',
+            action='store_true',
+            help='neither read nor write the compiled grammar cache')
     parser.add_argument('--verbose', '-v',
             action='store_true',
             help='increase the verbosity level')
@@ -184,6 +301,15 @@ def argparser():
     parser.add_argument('--samples',
                         type=int, default=100,
                         help='The number of samples')
+    parser.add_argument('--batch',
+                        action='store_true',
+                        help='draw all samples at once by splitting counts top-down (cost grows with the number of distinct derivations)')
+    parser.add_argument('--kbest',
+                        type=int, default=0,
+                        help='prints the k best derivations (and their exact probabilities) instead of sampling')
+    parser.add_argument('--posteriors',
+                        action='store_true',
+                        help='prints the exact posterior marginals of spans (nodes) and rules (edges) instead of sampling')
     parser.add_argument('--profile',
             help='enables profiling')
 
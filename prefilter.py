@@ -0,0 +1,90 @@
+"""
+Sentence-specific grammar prefiltering.
+
+Before intersecting a grammar with the automaton of a sentence, we discard rules which cannot take part in any parse:
+    1) a rule is productive if every symbol in its RHS is productive,
+       where terminals are productive only if they label some transition of the automaton
+       and nonterminals are productive if they rewrite through a productive rule;
+    2) a productive rule is kept if its LHS is reachable from the start symbol through productive rules.
+
+This disregards word order, thus it is a sound (but not tight) approximation of the set of useful rules.
+
+:Authors: - Wilker Aziz
+"""
+
+import logging
+from collections import deque
+from grammar_index import GrammarIndex
+from wcfg import SubWCFG
+
+
+def productive_rules(wcfg, terminals, index):
+    """
+    Bottom-up closure from a set of terminals.
+    :param terminals: terminals (encoded as in the grammar) labelling the automaton
+    :returns: list of productive rules
+    """
+    missing = {}  # id(rule) -> number of RHS symbols not yet known to be productive
+    productive = set(terminals)
+    agenda = deque(productive)
+    rules = []
+    while agenda:
+        sym = agenda.popleft()
+        for rule in index.containing(sym):
+            key = id(rule)
+            n = missing.get(key, None)
+            if n is None:
+                n = len(set(rule.rhs))
+            n -= 1
+            missing[key] = n
+            if n == 0:
+                rules.append(rule)
+                if rule.lhs not in productive:
+                    productive.add(rule.lhs)
+                    agenda.append(rule.lhs)
+    return rules
+
+
+def reachable_rules(root, rules, is_nonterminal):
+    """Top-down reachability from the root through a given set of rules."""
+    by_lhs = {}
+    for rule in rules:
+        by_lhs.setdefault(rule.lhs, []).append(rule)
+    reachable = set([root])
+    agenda = deque([root])
+    kept = []
+    while agenda:
+        for rule in by_lhs.get(agenda.popleft(), []):
+            kept.append(rule)
+            for sym in rule.rhs:
+                if is_nonterminal(sym) and sym not in reachable:
+                    reachable.add(sym)
+                    agenda.append(sym)
+    return kept
+
+
+def prefilter(wcfg, wfsa, root, index=None):
+    """
+    Restricts a grammar to the rules that might take part in the intersection with a given automaton.
+
+    >>> from wcfg import WCFG
+    >>> from rule import Rule
+    >>> from wfsa import make_linear_fsa
+    >>> G = WCFG([Rule('[S]', ['[NP]', '[VP]'], 0.0), Rule('[NP]', ['dogs'], 0.0), Rule('[NP]', ['cats'], 0.0), Rule('[VP]', ['bark'], 0.0), Rule('[X]', ['bark'], 0.0)])
+    >>> sorted(str(r) for r in prefilter(G, make_linear_fsa('dogs bark'), '[S]'))
+    ['[NP] -> dogs (0.0)', '[S] -> [NP] [VP] (0.0)', '[VP] -> bark (0.0)']
+
+    :param wcfg: a WCFG or a CompiledWCFG
+    :param wfsa: the automaton (symbols as strings)
+    :param root: the start symbol (as a string)
+    :param index: a GrammarIndex for `wcfg` (shared across sentences)
+    :returns: a SubWCFG
+    """
+    if index is None:
+        index = GrammarIndex(wcfg)
+    terminals = set(wcfg.encode_fsa(wfsa).itersymbols())
+    productive = productive_rules(wcfg, terminals, index)
+    rules = reachable_rules(wcfg.encode(root), productive, wcfg.is_nonterminal)
+    logging.info('Prefilter: kept %d of %d rules (%d lexical rules matched, %d rules productive)',
+                 len(rules), len(wcfg), sum(len(index.lexical(t)) for t in terminals), len(productive))
+    return SubWCFG(wcfg, rules)
@@ -5,17 +5,40 @@
 
 import wcfg
 import discodopfmt
+from compiled_wcfg import CompiledWCFG
+from bulk_reader import bulk_load
 from utils import smart_open
+import hashlib
+import logging
 import math
+import os
 
-def load_grammar(path, grammarfmt, transform):
-    """
-    Load a WCFG from a file.
 
-    :args path: path to the grammar (or prefix path to rules and lexicon)
-    :args grammarfmt: 'bar',  'discodop' or 'milos' (which looks like 'bar' but with terminals surrounded by quotes)
-    :returns: WCFG
+def grammar_files(path, grammarfmt):
+    """Returns the files a grammar is read from."""
+    if grammarfmt == 'discodop':
+        return ['{0}.rules.gz'.format(path), '{0}.lex.gz'.format(path)]
+    return [path]
+
+
+def cache_path(path, grammarfmt, transform):
     """
+    Returns the path to the compiled version of a grammar, or None if the transform cannot be identified.
+    The cache is keyed on the path, size and modification time of the grammar files (which are not read),
+    on the format and on the transform.
+    """
+    name = getattr(transform, '__name__', '<lambda>')
+    if name == '<lambda>':  # anonymous functions cannot be told apart
+        return None
+    key = hashlib.sha1('{0}\t{1}.{2}'.format(grammarfmt, getattr(transform, '__module__', None), name))
+    for fname in grammar_files(path, grammarfmt):
+        stat = os.stat(fname)
+        key.update('\t{0}\t{1}\t{2!r}'.format(os.path.abspath(fname), stat.st_size, stat.st_mtime))
+    return '{0}.{1}.cwcfg'.format(path, key.hexdigest()[:16])
+
+
+def read_grammar(path, grammarfmt, transform):
+    """Parses a grammar file (or pair of files) into a WCFG."""
     if grammarfmt == 'bar':
         istream = smart_open(path)
         grammar = wcfg.WCFG(wcfg.read_grammar_rules(istream, transform))
@@ -27,3 +50,35 @@ def load_grammar(path, grammarfmt, transform):
     else:
         raise NotImplementedError("I don't know this grammar format: %s" % grammarfmt)
     return grammar
+
+
+def load_grammar(path, grammarfmt, transform, cache=True, jobs=1):
+    """
+    Load a WCFG from a file.
+
+    The first time a grammar is loaded, its compiled version is written next to it,
+    later runs memory-map the compiled version instead of parsing the grammar again.
+
+    :args path: path to the grammar (or prefix path to rules and lexicon)
+    :args grammarfmt: 'bar',  'discodop' or 'milos' (which looks like 'bar' but with terminals surrounded by quotes)
+    :args cache: whether to use (and create) the compiled grammar cache
+    :args jobs: number of processes used to parse the grammar (see `bulk_reader`)
+    :returns: CompiledWCFG
+    """
+    if grammarfmt not in ('bar', 'milos', 'discodop'):
+        raise NotImplementedError("I don't know this grammar format: %s" % grammarfmt)
+    cached = cache_path(path, grammarfmt, transform) if cache else None
+    if cached is not None and os.path.exists(cached):
+        logging.debug('Mapping compiled grammar: %s', cached)
+        return CompiledWCFG.load(cached)
+    if jobs > 1:
+        grammar = bulk_load(path, grammarfmt, transform, jobs)
+    else:
+        grammar = CompiledWCFG(read_grammar(path, grammarfmt, transform))
+    if cached is not None:
+        try:
+            grammar.save(cached)
+            logging.debug('Compiled grammar saved to: %s', cached)
+        except (IOError, OSError) as e:
+            logging.warning('Could not save compiled grammar: %s', e)
+    return grammar
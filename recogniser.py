@@ -0,0 +1,300 @@
+"""
+Bit-parallel boolean recognition.
+
+A CKY-style pass which decides whether an automaton (a sentence) can be parsed at all
+and which nonterminals may take part in a parse over each span, before any weighted intersection.
+
+Each span (a pair of states) stores Python integers used as bitsets:
+    - one bit per nonterminal which derives the span;
+    - one bit per RHS prefix which derives the span, prefixes of every rule share a trie,
+      thus rules of any arity are recognised without binarising the grammar.
+
+The states of the automaton must be topologically sorted (every arc goes from a lower to a higher state),
+which is the case of the automaton of a sentence (see `sentence.make_sentence`).
+
+:Authors: - Wilker Aziz
+"""
+
+from collections import defaultdict
+
+
+def iterbits(bits):
+    """
+    Positions of the bits set in an integer (lowest first).
+
+    >>> list(iterbits(0b10110))
+    [1, 2, 4]
+    """
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
+
+
+class Recogniser(object):
+    """
+    Prefix tables of a grammar, built once and shared by every automaton (e.g. across sentences or iterations).
+
+    >>> from wcfg import WCFG
+    >>> from rule import Rule
+    >>> from wfsa import make_linear_fsa
+    >>> G = WCFG([Rule('[S]', ['[NP]', '[VP]'], 0.0), Rule('[NP]', ['dogs'], 0.0), Rule('[NP]', ['[NP]', '[NP]'], 0.0),
+    ...           Rule('[VP]', ['bark'], 0.0), Rule('[VP]', ['[V]', '[NP]'], 0.0), Rule('[V]', ['bark'], 0.0)])
+    >>> R = Recogniser(G)
+    >>> chart = R.chart(make_linear_fsa('dogs bark dogs'))
+    >>> chart.recognises('[S]'), sorted(chart.nonterminals(0, 2))
+    (True, ['[S]'])
+    >>> viable = chart.viable('[S]')
+    >>> sorted(viable), viable.can_start('[NP]', 2), viable.can_start('[NP]', 1)
+    ([('[NP]', 0, 1), ('[NP]', 2, 3), ('[S]', 0, 3), ('[VP]', 1, 3), ('[V]', 1, 2)], True, False)
+    >>> recognise(G, make_linear_fsa('bark dogs'), '[S]', R) is None
+    True
+    """
+
+    def __init__(self, wcfg):
+        """
+        :param wcfg: the grammar (symbols are encoded as in the grammar, see `wcfg.encode`)
+        """
+        self._wcfg = wcfg
+        self._nonterminals = []  # bit -> nonterminal
+        self._nt_bit = {}  # nonterminal -> bit
+        # trie of RHS prefixes, node 0 is the empty prefix
+        self._parent = [0]
+        self._label = [None]  # the last symbol of a prefix
+        self._child = {}  # (node, symbol) -> node
+        self._lhs = [0]  # node -> bitset of the nonterminals rewriting into the prefix
+        self._extends = defaultdict(int)  # symbol -> bitset of (non-empty) prefixes which it extends
+        self._complete = 0  # bitset of prefixes which are the RHS of some rule
+        self._rhs = defaultdict(int)  # nonterminal bit -> bitset of the prefixes which are its RHS
+        # the same relation by nonterminal bits, which is what the chart iterates over
+        self._label_bit = [-1]  # node -> bit of its last symbol (-1 for terminals)
+        self._successors = defaultdict(int)  # node -> bitset of the nonterminals which extend it
+        self._child_by_bit = {}  # (node, bit) -> node
+        is_nonterminal = wcfg.is_nonterminal
+        for rule in wcfg:
+            node = 0
+            for sym in rule.rhs:
+                child = self._child.get((node, sym), None)
+                if child is None:
+                    child = len(self._parent)
+                    self._parent.append(node)
+                    self._label.append(sym)
+                    self._lhs.append(0)
+                    self._child[(node, sym)] = child
+                    if node:
+                        self._extends[sym] |= 1 << node
+                    if is_nonterminal(sym):
+                        b = self.bit(sym)
+                        self._label_bit.append(b)
+                        self._successors[node] |= 1 << b
+                        self._child_by_bit[(node, b)] = child
+                    else:
+                        self._label_bit.append(-1)
+                node = child
+            b = self.bit(rule.lhs)
+            self._lhs[node] |= 1 << b
+            self._rhs[b] |= 1 << node
+            self._complete |= 1 << node
+
+    def bit(self, sym):
+        """The bit of a nonterminal (allocated if necessary)."""
+        b = self._nt_bit.get(sym, None)
+        if b is None:
+            b = len(self._nonterminals)
+            self._nonterminals.append(sym)
+            self._nt_bit[sym] = b
+        return b
+
+    def nonterminal(self, bit):
+        return self._nonterminals[bit]
+
+    def lhs(self, prefixes):
+        """Bitset of the nonterminals rewriting into some of the given prefixes."""
+        lhs = self._lhs
+        bits = 0
+        for node in iterbits(prefixes & self._complete):
+            bits |= lhs[node]
+        return bits
+
+    def extend(self, prefixes, sym):
+        """Bitset of the prefixes obtained by extending the given (non-empty) prefixes with a symbol."""
+        child = self._child
+        bits = 0
+        for node in iterbits(prefixes & self._extends.get(sym, 0)):
+            bits |= 1 << child[(node, sym)]
+        return bits
+
+    def start(self, sym):
+        """Bitset of the prefix made of a single symbol (0 if no rule starts with it)."""
+        node = self._child.get((0, sym), None)
+        return 0 if node is None else 1 << node
+
+    def chart(self, wfsa):
+        """Recognises an automaton (with symbols as strings) bottom-up, returns a Chart."""
+        return Chart(self, self._wcfg.encode_fsa(wfsa))
+
+
+class Chart(object):
+    """Bitsets of nonterminals and of RHS prefixes by span (see Recogniser.chart)."""
+
+    def __init__(self, recogniser, wfsa):
+        """
+        :param recogniser: a Recogniser
+        :param wfsa: an automaton whose symbols are encoded as in the grammar and whose states are topologically sorted
+        """
+        self._recogniser = recogniser
+        self._wfsa = wfsa
+        self._arcs = set()  # (origin, destination, terminal)
+        arcs_to = defaultdict(list)  # destination -> (origin, terminal)
+        for sfrom, sto, sym, w in wfsa.iterarcs():
+            if not sfrom < sto:
+                raise ValueError('I can only recognise automata whose states are topologically sorted: arc %s -> %s' % (sfrom, sto))
+            self._arcs.add((sfrom, sto, sym))
+            arcs_to[sto].append((sfrom, sym))
+        self._nonterminals = {}  # (start, end) -> bitset of nonterminals
+        self._prefixes = {}  # (start, end) -> bitset of prefixes
+        states = sorted(wfsa.iterstates())
+        for j in states:
+            for i in reversed(states):
+                if i < j:
+                    self._span(i, j, arcs_to[j], [k for k in states if i < k < j])
+
+    def _span(self, i, j, arcs, splits):
+        """Fills the bitsets of a span whose subspans are complete."""
+        R = self._recogniser
+        nonterminals, prefixes = self._nonterminals, self._prefixes
+        p = 0
+        # terminals ending in j
+        for k, sym in arcs:
+            if k == i:
+                p |= R.start(sym)
+            elif k > i:
+                q = prefixes.get((i, k), 0)
+                if q:
+                    p |= R.extend(q, sym)
+        # nonterminals ending in j (loops over bits are inlined, this is where recognition spends its time)
+        successors, child_by_bit = R._successors, R._child_by_bit
+        for k in splits:
+            q = prefixes.get((i, k), 0)
+            if not q:
+                continue
+            n = nonterminals.get((k, j), 0)
+            while q and n:
+                low = q & -q
+                q ^= low
+                node = low.bit_length() - 1
+                m = successors.get(node, 0) & n
+                while m:
+                    low = m & -m
+                    m ^= low
+                    p |= 1 << child_by_bit[(node, low.bit_length() - 1)]
+        # nonterminals over the whole span, which may in turn start (unary) prefixes over the same span
+        n = 0
+        new = R.lhs(p)
+        while new:
+            n |= new
+            unary = 0
+            for b in iterbits(new):
+                unary |= R.start(R.nonterminal(b))
+            unary &= ~p
+            p |= unary
+            new = R.lhs(unary) & ~n
+        if p:
+            prefixes[(i, j)] = p
+        if n:
+            nonterminals[(i, j)] = n
+
+    def nonterminals(self, start, end):
+        """Nonterminals deriving a span."""
+        R = self._recogniser
+        return [R.nonterminal(b) for b in iterbits(self._nonterminals.get((start, end), 0))]
+
+    def derives(self, sym, start, end):
+        R = self._recogniser
+        b = R._nt_bit.get(sym, None)
+        return b is not None and bool(self._nonterminals.get((start, end), 0) >> b & 1)
+
+    def recognises(self, root):
+        """
+        Whether the root derives the automaton (from some initial state to some final state).
+        :param root: the start symbol (as a string)
+        """
+        root = self._recogniser._wcfg.encode(root)
+        return any(self.derives(root, i, j) for i in self._wfsa.iterinitial() for j in self._wfsa.iterfinal())
+
+    def viable(self, root):
+        """
+        Top-down pass from the root: the (nonterminal, start, end) triples which take part in some parse.
+        :param root: the start symbol (as a string)
+        :returns: a ViableSet (empty if the automaton cannot be parsed)
+        """
+        R = self._recogniser
+        root = R._wcfg.encode(root)
+        nonterminals = self._nonterminals
+        viable = set()
+        visited = set()  # (prefix, start, end)
+        stack = [(root, i, j) for i in self._wfsa.iterinitial() for j in self._wfsa.iterfinal() if self.derives(root, i, j)]
+        viable.update(stack)
+        prefixes = []
+        while stack or prefixes:
+            if stack:
+                # the complete prefixes (RHS) through which a viable nonterminal derives its span
+                sym, i, j = stack.pop()
+                for node in iterbits(self._prefixes.get((i, j), 0) & R._rhs[R._nt_bit[sym]]):
+                    if (node, i, j) not in visited:
+                        visited.add((node, i, j))
+                        prefixes.append((node, i, j))
+                continue
+            # the last symbol of a viable prefix and the (shorter) prefix it extends
+            node, i, j = prefixes.pop()
+            sym, b, parent = R._label[node], R._label_bit[node], R._parent[node]
+            if not parent:
+                starts = [i]
+            else:
+                starts = []
+                pbit = 1 << parent
+                for k in xrange(i + 1, j):
+                    if self._prefixes.get((i, k), 0) & pbit and \
+                            ((k, j, sym) in self._arcs if b < 0 else nonterminals.get((k, j), 0) >> b & 1):
+                        starts.append(k)
+                        if (parent, i, k) not in visited:
+                            visited.add((parent, i, k))
+                            prefixes.append((parent, i, k))
+            if b >= 0:
+                for k in starts:
+                    if (sym, k, j) not in viable:
+                        viable.add((sym, k, j))
+                        stack.append((sym, k, j))
+        return ViableSet(viable)
+
+
+class ViableSet(object):
+    """Nonterminals annotated with spans, i.e. (symbol, start, end), that take part in some parse."""
+
+    def __init__(self, triples):
+        self._triples = frozenset(triples)
+        self._starts = frozenset((sym, start) for sym, start, end in self._triples)
+
+    def __len__(self):
+        return len(self._triples)
+
+    def __iter__(self):
+        return iter(self._triples)
+
+    def __contains__(self, triple):
+        return triple in self._triples
+
+    def can_start(self, sym, start):
+        """Whether some viable span of a nonterminal begins at a given state."""
+        return (sym, start) in self._starts
+
+
+def recognise(wcfg, wfsa, root, recogniser=None):
+    """
+    Returns the ViableSet of an automaton or None if the automaton cannot be parsed.
+    :param recogniser: a Recogniser for `wcfg` (built if not given)
+    """
+    chart = (Recogniser(wcfg) if recogniser is None else recogniser).chart(wfsa)
+    if not chart.recognises(root):
+        return None
+    return chart.viable(root)
@@ -2,35 +2,65 @@
 @author wilkeraziz
 """
 
-from collections import defaultdict
+import math
+
 
 class Rule(object):
+    """
+    An immutable weighted rule.
+    Rules are hashed constantly (item keys, edge caches, derivation counts), thus the hash is computed once.
+
+    >>> r = Rule('[S]', ['[X]'], 0.0)
+    >>> r == Rule('[S]', ('[X]',), 0.0), hash(r) == hash(Rule('[S]', ['[X]'], 0.0))
+    (True, True)
+    >>> r == None, r != ('[S]', ('[X]',), 0.0)
+    (False, True)
+    >>> r.lhs = '[Y]'
+    Traceback (most recent call last):
+    ...
+    AttributeError: can't set attribute
+    """
+
+    __slots__ = ('lhs_', 'rhs_', 'log_prob_', 'hash_')
 
     def __init__(self, lhs, rhs, log_prob):
         """
         Constructs a Rule.
         @param lhs: the LHS nonterminal
         @param rhs: a sequence of RHS symbols
-        @param log_prob: log probability of the rule 
+        @param log_prob: log probability of the rule
         """
         self.lhs_ = lhs
         self.rhs_ = tuple(rhs)
         self.log_prob_ = log_prob
+        self.hash_ = hash((lhs, self.rhs_, log_prob))
 
     def __eq__(self, other):
-        return self.lhs_ == other.lhs_ and self.rhs_ == other.rhs_ and self.log_prob_ == other.log_prob_
+        if self is other:
+            return True
+        if not isinstance(other, Rule):
+            return NotImplemented
+        return (self.hash_ == other.hash_ and self.lhs_ == other.lhs_ and self.rhs_ == other.rhs_
+                and self.log_prob_ == other.log_prob_)
 
     def __ne__(self, other):
-        return not (self == other)
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
 
     def __hash__(self):
-        return hash((self.lhs_, self.rhs_, self.log_prob_))
+        return self.hash_
 
     def __repr__(self):
         return '%s -> %s (%s)' % (self.lhs_,
                 ' '.join(str(sym) for sym in self.rhs_),
                 self.log_prob_)
 
+    def __getstate__(self):
+        return self.lhs_, self.rhs_, self.log_prob_
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
     @property
     def lhs(self):
         return self.lhs_
@@ -38,12 +68,32 @@ class Rule(object):
     @property
     def rhs(self):
         return self.rhs_
-    
+
     @property
     def log_prob(self):
         return self.log_prob_
 
     @property
     def prob(self):
-        return Math.exp(self.log_prob_)
+        return math.exp(self.log_prob_)
+
+
+class InternedRule(Rule):
+    """
+    A rule which exists in a single copy (e.g. the rule views of a CompiledWCFG), thus equality is identity.
 
+    >>> r = InternedRule(0, [1], 0.0)
+    >>> r == r, r == InternedRule(0, [1], 0.0)
+    (True, False)
+    """
+
+    __slots__ = ()
+
+    def __eq__(self, other):
+        return self is other
+
+    def __ne__(self, other):
+        return self is not other
+
+    def __hash__(self):
+        return self.hash_
@@ -0,0 +1,284 @@
+"""
+Semirings for inside-style dynamic programs.
+
+A semiring is a class (never instantiated) with a `zero`, a `one`, elementwise `plus` and `times`,
+and vectorised reductions over segments of a vector of values, which is what the level-synchronous passes need
+(see `inference.inside`):
+
+    - `sum_segments`: plus within consecutive non-empty segments (the edges incoming to each head node)
+    - `product_segments`: times within segments given by sorted segment ids (the tail nodes of each edge)
+
+Edge weights are log probabilities, `from_log` maps them into the semiring and `to_log` maps values back.
+
+    Log: log probabilities (log-sum-exp, +)
+    Viterbi: the best derivation (max, +) over log probabilities
+    Counting: number of derivations (+, *) as exact (python) integers
+    Boolean: recognition (or, and)
+    Probability: probabilities (+, *) each stored as a mantissa and a power of 2, thus it neither underflows
+        nor needs logarithms (only frexp/ldexp)
+
+:Authors: - Wilker Aziz
+"""
+
+import numpy as np
+
+
+def segment_logsumexp(values, starts):
+    """
+    log(sum(exp(values))) within consecutive non-empty segments of values beginning at `starts`.
+
+    >>> segment_logsumexp(np.log([0.5, 0.25, 0.25, 1.0]), np.array([0, 1, 3])).round(4).tolist()
+    [-0.6931, -0.6931, 0.0]
+    """
+    m = np.maximum.reduceat(values, starts)
+    m[~np.isfinite(m)] = 0.0  # segments of -inf stay -inf
+    lengths = np.diff(np.append(starts, len(values)))
+    with np.errstate(divide='ignore'):
+        return np.log(np.add.reduceat(np.exp(values - np.repeat(m, lengths)), starts)) + m
+
+
+def segment_starts(ids):
+    """Positions where a sorted vector of ids changes value (the beginning of each segment)."""
+    return np.flatnonzero(np.concatenate(([True], ids[1:] != ids[:-1]))) if len(ids) else np.zeros(0, dtype=np.int64)
+
+
+def cumsum_by_segment(values, offset):
+    """
+    Cumulative sums which restart at every segment, i.e. values[offset[n]:offset[n + 1]] for each n.
+    Sums never cross segments (a running total over the whole vector would cancel out the small values of late segments),
+    a segment of length d costs log2(d) vectorised additions.
+
+    >>> cumsum_by_segment(np.array([1.0, 2.0, 3.0, 1e-17, 0.0, 1e-17, 5.0]), np.array([0, 3, 6, 7])).tolist()
+    [1.0, 3.0, 6.0, 1e-17, 1e-17, 2e-17, 5.0]
+    """
+    cumulative = np.array(values, dtype=float)
+    lengths = np.diff(offset)
+    if not len(cumulative):
+        return cumulative
+    segment = np.repeat(np.arange(len(lengths)), lengths)
+    shift, longest = 1, lengths.max()
+    while shift < longest:
+        # adds the partial sums `shift` positions behind (within the same segment)
+        cumulative[shift:] += np.where(segment[shift:] == segment[:-shift], cumulative[:-shift], 0.0)
+        shift *= 2
+    return cumulative
+
+
+class Semiring(object):
+    """
+    The interface of a semiring, reductions default to the ufuncs `plus_ufunc` and `times_ufunc`.
+    """
+
+    dtype = np.float64
+    zero = None
+    one = None
+    plus_ufunc = None
+    times_ufunc = None
+
+    @classmethod
+    def plus(cls, x, y):
+        return cls.plus_ufunc(x, y)
+
+    @classmethod
+    def times(cls, x, y):
+        return cls.times_ufunc(x, y)
+
+    @classmethod
+    def zeros(cls, n):
+        values = np.empty(n, dtype=cls.dtype)
+        values.fill(cls.zero)
+        return values
+
+    @classmethod
+    def ones(cls, n):
+        values = np.empty(n, dtype=cls.dtype)
+        values.fill(cls.one)
+        return values
+
+    @classmethod
+    def from_log(cls, log_weights):
+        """Maps a vector of log probabilities into the semiring."""
+        raise NotImplementedError('I do not know how to map log probabilities into %s' % cls.__name__)
+
+    @classmethod
+    def to_log(cls, values):
+        """Maps a vector of values to log probabilities (or the log of whatever quantity the semiring computes)."""
+        raise NotImplementedError('I do not know how to map %s values to log probabilities' % cls.__name__)
+
+    @classmethod
+    def sum_segments(cls, values, starts):
+        """plus within consecutive non-empty segments of values beginning at `starts`."""
+        return cls.plus_ufunc.reduceat(values, starts)
+
+    @classmethod
+    def product_segments(cls, values, ids, n):
+        """times within segments of values given by sorted segment ids in [0, n), empty segments are `one`."""
+        out = cls.ones(n)
+        starts = segment_starts(ids)
+        if len(starts):
+            out[ids[starts]] = cls.times_ufunc.reduceat(values, starts)
+        return out
+
+
+class Log(Semiring):
+    """
+    >>> Log.to_log(Log.sum_segments(Log.from_log(np.log([0.5, 0.25, 0.25])), np.array([0, 1]))).round(4).tolist()
+    [-0.6931, -0.6931]
+    """
+
+    zero = -np.inf
+    one = 0.0
+    plus_ufunc = np.logaddexp
+    times_ufunc = np.add
+
+    @classmethod
+    def from_log(cls, log_weights):
+        return np.asarray(log_weights, dtype=cls.dtype)
+
+    @classmethod
+    def to_log(cls, values):
+        return values
+
+    @classmethod
+    def sum_segments(cls, values, starts):
+        return segment_logsumexp(values, starts)
+
+    @classmethod
+    def product_segments(cls, values, ids, n):
+        return np.bincount(ids, weights=values, minlength=n)
+
+
+class Viterbi(Log):
+    """
+    >>> Viterbi.sum_segments(np.log([0.5, 0.25, 0.25]), np.array([0, 1])).tolist() == np.log([0.5, 0.25]).tolist()
+    True
+    """
+
+    plus_ufunc = np.maximum
+
+    @classmethod
+    def sum_segments(cls, values, starts):
+        return np.maximum.reduceat(values, starts)
+
+
+class Counting(Semiring):
+    """
+    Counts are python integers (numpy object arrays), thus they never overflow.
+
+    >>> Counting.product_segments(Counting.from_log([0.0, -1.0, -np.inf]), np.array([0, 0, 2]), 4).tolist()
+    [1, 1, 0, 1]
+    """
+
+    dtype = object
+    zero = 0
+    one = 1
+    plus_ufunc = np.add
+    times_ufunc = np.multiply
+
+    @classmethod
+    def from_log(cls, log_weights):
+        """Edges with a non-zero probability count as 1."""
+        return np.where(np.isfinite(log_weights), 1, 0).astype(object)
+
+    @classmethod
+    def to_log(cls, values):
+        return np.array([np.log(float(v)) if v else -np.inf for v in values])
+
+
+class Boolean(Semiring):
+    """
+    >>> Boolean.sum_segments(Boolean.from_log([0.0, -np.inf, -np.inf]), np.array([0, 1])).tolist()
+    [True, False]
+    """
+
+    dtype = np.bool_
+    zero = False
+    one = True
+    plus_ufunc = np.logical_or
+    times_ufunc = np.logical_and
+
+    @classmethod
+    def from_log(cls, log_weights):
+        return np.isfinite(log_weights)
+
+    @classmethod
+    def to_log(cls, values):
+        return np.where(values, 0.0, -np.inf)
+
+
+class Probability(Semiring):
+    """
+    A value is a mantissa in [0.5, 1) (or 0) and an integer exponent: p = m * 2^e.
+    Products multiply mantissas and add exponents, sums align exponents with ldexp,
+    and values are renormalised with frexp, which are all exact operations on the exponent.
+
+    >>> p = Probability.from_log(np.array([-800.0, -800.0, 0.0]))
+    >>> np.exp(-800.0) * np.exp(-800.0)
+    0.0
+    >>> q = Probability.product_segments(p, np.array([0, 0, 1]), 2)
+    >>> Probability.to_log(q).round(4).tolist()
+    [-1600.0, 0.0]
+    >>> Probability.to_log(Probability.sum_segments(p, np.array([0, 2]))).round(4).tolist()
+    [-799.3069, 0.0]
+    """
+
+    dtype = np.dtype([('m', np.float64), ('e', np.int64)])
+    zero = (0.0, 0)
+    one = (0.5, 1)
+
+    @classmethod
+    def pack(cls, m, e):
+        """Values from mantissas and exponents (renormalised)."""
+        m, k = np.frexp(m)
+        values = np.empty(np.shape(m), dtype=cls.dtype)
+        values['m'] = m
+        values['e'] = np.where(m == 0, 0, np.asarray(e) + k)
+        return values
+
+    @classmethod
+    def plus(cls, x, y):
+        """
+        Zeros do not take part in the alignment of exponents (theirs is 0, which would underflow small values).
+
+        >>> Probability.to_log(Probability.plus(Probability.zeros(1), Probability.from_log([-2000.0]))).round(4).tolist()
+        [-2000.0]
+        """
+        e = np.where(x['m'] == 0, y['e'], np.where(y['m'] == 0, x['e'], np.maximum(x['e'], y['e'])))
+        return cls.pack(np.ldexp(x['m'], x['e'] - e) + np.ldexp(y['m'], y['e'] - e), e)
+
+    @classmethod
+    def times(cls, x, y):
+        return cls.pack(x['m'] * y['m'], x['e'] + y['e'])
+
+    @classmethod
+    def from_log(cls, log_weights):
+        log_weights = np.asarray(log_weights, dtype=np.float64)
+        # split the log probability in base 2 into an integer part (exponent) and a fractional part (mantissa)
+        with np.errstate(invalid='ignore'):
+            log2 = log_weights / np.log(2)
+            e = np.where(np.isfinite(log2), np.floor(log2), 0).astype(np.int64)
+            m = np.where(np.isfinite(log2), np.exp2(log2 - e), 0.0)
+        return cls.pack(m, e)
+
+    @classmethod
+    def to_log(cls, values):
+        with np.errstate(divide='ignore'):
+            return np.log(values['m']) + values['e'] * np.log(2)
+
+    @classmethod
+    def sum_segments(cls, values, starts):
+        lengths = np.diff(np.append(starts, len(values)))
+        e = np.maximum.reduceat(np.where(values['m'] > 0, values['e'], np.iinfo(np.int64).min), starts)
+        e[e == np.iinfo(np.int64).min] = 0  # segments of zeros
+        m = np.add.reduceat(np.ldexp(values['m'], values['e'] - np.repeat(e, lengths)), starts)
+        return cls.pack(m, e)
+
+    @classmethod
+    def product_segments(cls, values, ids, n):
+        out = cls.ones(n)
+        starts = segment_starts(ids)
+        if len(starts):
+            # mantissas are in [0.5, 1), thus a product of at most 1000 of them does not underflow
+            out[ids[starts]] = cls.pack(np.multiply.reduceat(values['m'], starts),
+                                        np.add.reduceat(values['e'], starts))
+        return out
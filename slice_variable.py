@@ -61,4 +61,19 @@ class SliceVariable(object):
         else:
             raise ValueError('I do not expect to reweight rules scoring less than the threshold')
 
+    def weights(self, states, theta):
+        """
+        Vectorised version of `weight`.
+        :param states: a sequence of states (sym, start, end)
+        :param theta: a vector with the log probability of a rule for each state
+        """
+        try:
+            u = numpy.array([self.slice_variables[state] for state in states], dtype=float)
+        except KeyError as e:
+            raise ValueError('I do not expect to reweight a rule for an unseen state: %s' % str(e.args[0]))
 
+        if numpy.all(theta > u):
+            return - beta.logpdf(numpy.exp(u), self.a, self.b)
+
+        else:
+            raise ValueError('I do not expect to reweight rules scoring less than the threshold')
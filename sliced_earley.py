@@ -9,12 +9,10 @@ And extended with Slice Sampling by Iason
 
 EMPTY_SET = frozenset()
 import logging
-from agenda import Agenda, ActiveQueue
+from agenda import Agenda, ActiveQueue, get_cfg
 from item import ItemFactory
-from symbol import is_terminal, make_symbol, is_nonterminal
-from rule import Rule
-from wcfg import WCFG
-import itertools
+from grammar_index import GrammarIndex
+from collections import defaultdict
 from slice_variable import SliceVariable
 
 
@@ -22,15 +20,25 @@ class SlicedEarley(object):
     """
     """
 
-    def __init__(self, wcfg, wfsa, slice_vars):
+    def __init__(self, wcfg, wfsa, slice_vars, index=None, item_factory=None, viable=None):
         """
+        :param index: a GrammarIndex for `wcfg` (built if not given, share it across parsers of the same grammar)
+        :param item_factory: an ItemFactory (created if not given, clear it before reusing it for another parse)
+        :param viable: a ViableSet (see recogniser.py), if given, nonterminals over spans outside it are skipped
         """
 
         self._wcfg = wcfg
-        self._wfsa = wfsa
+        self._wfsa = wcfg.encode_fsa(wfsa)
+        self._index = GrammarIndex(wcfg) if index is None else index
         self._agenda = Agenda(active_container_type=ActiveQueue)
         self._predictions = set()  # (LHS, start)
-        self._item_factory = ItemFactory()
+        self._item_factory = ItemFactory() if item_factory is None else item_factory
+        self._viable_set = viable
+        # left-corner filter: symbols which may start a constituent from a given state
+        self._viable = defaultdict(set)
+        for sfrom, sto, sym, w in self._wfsa.iterarcs():
+            self._viable[sfrom].add(sym)
+            self._viable[sfrom].update(self._index.left_corner_ancestors(sym))
         self.slice_vars = slice_vars
 
     def get_item(self, rule, dot, inner=[]):
@@ -38,7 +46,11 @@ class SlicedEarley(object):
 
     def advance(self, item, dot):
         """returns a new item whose dot has been advanced"""
-        return self.get_item(item.rule, dot, item.inner + (item.dot,))
+        return self._item_factory.advance(item, dot)
+
+    def is_viable(self, item):
+        """Whether the LHS of a complete item takes part in some parse over the item's span."""
+        return self._viable_set is None or (item.rule.lhs, item.start, item.dot) in self._viable_set
 
     def axioms(self, symbol, start):
         rules = self._wcfg.get(symbol, None)
@@ -48,9 +60,20 @@ class SlicedEarley(object):
             return True
         # otherwise add rewritings to the agenda
         self._predictions.add((symbol, start))
-        self._agenda.extend(self.get_item(rule, start) for rule in rules)
+        self._agenda.extend(self.get_item(rule, start) for rule in self.viable_rules(rules, start))
         return True
 
+    def viable_rules(self, rules, start):
+        """
+        Rules whose first RHS symbol can start a constituent from a given state (left-corner filter)
+        and, given a ViableSet, whose LHS takes part in some parse from that state.
+        """
+        viable = self._viable.get(start, EMPTY_SET)
+        if self._viable_set is not None:
+            can_start = self._viable_set.can_start
+            return [rule for rule in rules if rule.rhs[0] in viable and can_start(rule.lhs, start)]
+        return [rule for rule in rules if rule.rhs[0] in viable]
+
     def prediction(self, item):
         """
         This operation tris to create items from the rules associated with the nonterminal ahead of the dot.
@@ -59,7 +82,7 @@ class SlicedEarley(object):
         if (item.next, item.dot) in self._predictions:  # prediction already happened
             return False
         self._predictions.add((item.next, item.dot))
-        new_items = [self.get_item(rule, item.dot) for rule in self._wcfg.get(item.next, frozenset())]
+        new_items = [self.get_item(rule, item.dot) for rule in self.viable_rules(self._wcfg.get(item.next, EMPTY_SET), item.dot)]
         self._agenda.extend(new_items)
         return True
 
@@ -70,6 +93,7 @@ class SlicedEarley(object):
         If we get to a nondeterminism, we stop scanning and add the relevant items to the agenda.
         """
         states = [item.dot]
+        is_terminal = self._wcfg.is_terminal
         for sym in item.nextsymbols():
             if is_terminal(sym):
                 arcs = self._wfsa.get_arcs(origin=states[-1], symbol=sym)
@@ -118,14 +142,18 @@ class SlicedEarley(object):
 
         # start items of the kind
         # GOAL -> * ROOT, where * is an intial state of the wfsa
+        symbol, root = root, wcfg.encode(root)
         if not any(self.axioms(root, start) for start in wfsa.iterinitial()):
-            raise ValueError('No rule for the start symbol %s' % root)
+            raise ValueError('No rule for the start symbol %s' % symbol)
         new_roots = set()
 
         while agenda:
             item = agenda.pop()  # always returns an active item
 
             if item.is_complete():
+                if not self.is_viable(item):  # the symbol takes no part in any parse
+                    agenda.discard(item)
+                    continue
                 # get slice variable for the current completed item
                 u = self.slice_vars.get(item.rule.lhs, item.start, item.dot)
 
@@ -144,12 +172,12 @@ class SlicedEarley(object):
                         else:  # a complete state is only kept in case it could potentially complete others
                             agenda.discard(item)
             else:
-                if is_terminal(item.next):
+                if wcfg.is_terminal(item.next):
                     # fire the operation 'scan'
                     self.scan(item)
                     agenda.discard(item)  # scanning renders incomplete items of this kind useless
                 else:
-                    if not wcfg.can_rewrite(item.next):  # if the NT does not exist this item is useless
+                    if not self._index.can_rewrite(item.next):  # if the NT does not exist this item is useless
                         agenda.discard(item)
                     else:
                         if not self.prediction(item):  # try to predict, otherwise try to complete itself
@@ -159,46 +187,8 @@ class SlicedEarley(object):
         logging.debug('Making forest...')
         return self.get_cfg(goal, root)
 
-    def get_intersected_rule(self, item):
-        lhs = make_symbol(item.rule.lhs, item.start, item.dot)
-        positions = item.inner + (item.dot,)
-        rhs = [make_symbol(sym, positions[i], positions[i + 1]) for i, sym in enumerate(item.rule.rhs)]
-        return Rule(lhs, rhs, item.rule.log_prob)
-
     def get_cfg(self, goal, root):
         """
-        Constructs the CFG by visiting complete items in a top-down fashion.
-        This is effectively a reachability test and it serves the purpose of filtering nonterminal symbols
-        that could never be reached from the root.
-        Note that bottom-up intersection typically does enumerate a lot of useless (unreachable) items.
-        This is the recursive procedure described in the paper (Nederhof and Satta, 2008).
+        Constructs the CFG by visiting complete items in a top-down fashion (see `agenda.get_cfg`).
         """
-
-        G = WCFG()
-        processed = set()
-        fsa = self._wfsa
-        itergenerating = self._agenda.itergenerating
-        itercomplete = self._agenda.itercomplete
-
-        def make_rules(lhs, start, end):
-            if (start, lhs, end) in processed:
-                return
-            processed.add((lhs, start, end))
-            for item in itercomplete(lhs, start, end):
-                G.add(self.get_intersected_rule(item))
-                fsa_states = item.inner + (item.dot,)
-                for i, sym in itertools.ifilter(lambda (_, s): is_nonterminal(s), enumerate(item.rule.rhs)):
-                    if (sym, fsa_states[i], fsa_states[
-                            i + 1]) not in processed:  # Nederhof does not perform this test, but in python it turned out crucial
-                        make_rules(sym, fsa_states[i], fsa_states[i + 1])
-
-        # create goal items
-        for start, ends in itergenerating(root):
-            if not fsa.is_initial(start):
-                continue
-            for end in itertools.ifilter(lambda q: fsa.is_final(q), ends):
-                make_rules(root, start, end)
-                G.add(Rule(make_symbol(goal, None, None),
-                           [make_symbol(root, start, end)], 0.0))
-
-        return G
+        return get_cfg(goal, root, self._wfsa, self._agenda, self._wcfg)
@@ -19,26 +19,30 @@ This is an implementation of the bottom-up intersection by Nederhof and Satta (2
 
 from collections import defaultdict, deque
 from itertools import ifilter
-from agenda import Agenda, ActiveQueue, get_cfg
+from agenda import Agenda, ActiveQueue, ForestInside, get_cfg
 from item import ItemFactory
-from symbol import is_terminal, make_symbol, is_nonterminal
-from rule import Rule
-from wcfg import WCFG
+from grammar_index import GrammarIndex
 import logging
 from slice_variable import SliceVariable
 
 
-class SlicedNederhof(object):
+class SlicedNederhof(ForestInside):
     """
     This is an implementation of the CKY-inspired intersection due to Nederhof and Satta (2008).
     """
 
-    def __init__(self, wcfg, wfsa, slice_vars):
+    def __init__(self, wcfg, wfsa, slice_vars, index=None, item_factory=None, viable=None):
+        """
+        :param index: a GrammarIndex for `wcfg` (built if not given, share it across parsers of the same grammar)
+        :param item_factory: an ItemFactory (created if not given, clear it before reusing it for another parse)
+        :param viable: a ViableSet (see recogniser.py), if given, nonterminals over spans outside it are skipped
+        """
         self._wcfg = wcfg
-        self._wfsa = wfsa
+        self._wfsa = wcfg.encode_fsa(wfsa)
         self._agenda = Agenda(active_container_type=ActiveQueue)
-        self._firstsym = defaultdict(set)  # index rules by their first RHS symbol
-        self._item_factory = ItemFactory()
+        self._index = GrammarIndex(wcfg) if index is None else index  # indexes rules by their first RHS symbol
+        self._item_factory = ItemFactory() if item_factory is None else item_factory
+        self._viable_set = viable
         self.slice_vars = slice_vars
 
     def get_item(self, rule, dot, inner=[]):
@@ -46,7 +50,11 @@ class SlicedNederhof(object):
     
     def advance(self, item, dot):
         """returns a new item whose dot has been advanced"""
-        return self.get_item(item.rule, dot, item.inner + (item.dot,))
+        return self._item_factory.advance(item, dot)
+
+    def is_viable(self, item):
+        """Whether the LHS of a complete item takes part in some parse over the item's span."""
+        return self._viable_set is None or (item.rule.lhs, item.start, item.dot) in self._viable_set
         
     def add_symbol(self, sym, sfrom, sto):
         """
@@ -65,18 +73,19 @@ class SlicedNederhof(object):
 
         # you may interpret this as a delayed axiom
         # every compatible rule in the grammar
-        for r in self._firstsym.get(sym, set()):  
-            self._agenda.add(self.get_item(r, sto, inner=(sfrom,)))  # can be interpreted as a lazy axiom
+        viable = self._viable_set
+        for r in self._index.first(sym):
+            if viable is None or viable.can_start(r.lhs, sfrom):
+                self._agenda.add(self.get_item(r, sto, inner=(sfrom,)))  # can be interpreted as a lazy axiom
 
         return True
 
     def axioms(self):
         """
         The axioms of the program are based on the FSA transitions. 
+        Rules are indexed by their first RHS symbol once per grammar (see GrammarIndex),
+        you may interpret them as a sort of lazy axiom.
         """
-        # you may interpret the following as a sort of lazy axiom (based on grammar rules)
-        for r in self._wcfg:
-            self._firstsym[r.rhs[0]].add(r)
         # these are axioms based on the transitions of the automaton
         for sfrom, sto, sym, w in self._wfsa.iterarcs():
             self.add_symbol(sym, sfrom, sto)  
@@ -88,12 +97,16 @@ class SlicedNederhof(object):
             item = agenda.pop()  # always returns an ACTIVE item
             # complete other items (by calling add_symbol), in case the input item is complete
             if item.is_complete():
+                if not self.is_viable(item):  # the symbol takes no part in any parse
+                    continue
                 u = self.slice_vars.get(item.rule.lhs, item.start, item.dot)
                 # check whether the probability of the current completed item is above the threshold determined by
                 # the slice variable
                 if item.rule.log_prob > u:
                     self.add_symbol(item.rule.lhs, item.start, item.dot)  # prove the symbol
                     agenda.make_complete(item)  # mark the item as complete
+                    if self._forest is not None:
+                        self._forest.add(item)
             else:
                 # merges the input item with previously completed items effectively moving the input item's dot forward
                 agenda.make_passive(item)
@@ -104,4 +117,4 @@ class SlicedNederhof(object):
         """Runs the program and returns the intersected CFG"""
         self.axioms()
         self.inference()
-        return get_cfg(goal, root, self._wfsa, self._agenda)
+        return get_cfg(goal, self._wcfg.encode(root), self._wfsa, self._agenda, self._wcfg)
@@ -27,6 +27,18 @@ def make_symbol(base_symbol, sfrom, sto):
         return base_symbol
     return base_symbol if is_terminal(base_symbol) else '[%s,%s-%s]' % (base_symbol[1:-1], sfrom, sto)
 
+def node_label(node, decode=lambda sym: sym):
+    """
+    Returns the string of a forest node, (symbol, start, end) triples are formatted as annotated nonterminals.
+
+    >>> node_label(('[X]', 0, 2)), node_label('a')
+    ('[X,0-2]', 'a')
+    """
+    if type(node) is tuple:
+        sym, start, end = node
+        return make_symbol(decode(sym), start, end)
+    return node
+
 def parse_annotated_nonterminal(nt):
     m = NT_RE.match(nt)
     if m is None:
@@ -2,47 +2,54 @@
 :Authors: - Iason
 """
 
-from collections import defaultdict, deque
+import numpy as np
 
 
-def top_sort(forest):
+def _dependants(forest):
     """
-    Partial ordering of nodes in the forest.
-    :return: list of nodes ordered from leaves to root
+    Unique (parent, child) dependencies of a forest.
+    :returns: the number of distinct children of each node and the parents of each node (CSR over children)
+    """
+    n = forest.n_nodes
+    parents = np.repeat(forest.heads, np.diff(forest.tail_offset)).astype(np.int64)
+    pairs = np.unique(parents * n + forest.tails)
+    parents, children = pairs // n, pairs % n
+    waiting = np.bincount(parents, minlength=n)
+    dependants = parents[np.argsort(children, kind='mergesort')]
+    offset = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(children, minlength=n), out=offset[1:])
+    return waiting, dependants, offset
+
+
+def top_sort_levels(forest):
     """
+    Groups the nodes of a forest into topological levels:
+    leaves are in level 0 and a node is one level above the highest of its children.
+    Nodes in a level depend only on nodes in lower levels, thus a level can be processed at once.
+    :param forest: a Hypergraph
+    :return: list of arrays of nodes (ids) from leaves to root
+    """
+
+    waiting, dependants, offset = _dependants(forest)
+    frontier = np.flatnonzero(waiting == 0)
+    levels = []
+    while len(frontier):
+        levels.append(frontier)
+        # the parents of nodes in the frontier (with repetitions)
+        counts = offset[frontier + 1] - offset[frontier]
+        starts = np.cumsum(counts) - counts
+        parents = dependants[np.repeat(offset[frontier] - starts, counts) + np.arange(counts.sum())]
+        parents, ready = np.unique(parents, return_counts=True)
+        waiting[parents] -= ready
+        frontier = parents[waiting[parents] == 0]
+    return levels
 
-    dependencies = defaultdict(set)
-    dependants = defaultdict(set)
-    for lhs, rules in forest.iteritems():
-        for rule in rules:
-            dependencies[lhs].update(rule.rhs)
-            for s in rule.rhs:
-                dependants[s].add(lhs)
-
-    sorting = deque(forest.terminals)
-
-    # L, top ordered nodes
-    ordered = []
-
-    while sorting:
-        # remove and return a node from sorting
-        node = sorting.popleft()
-
-        # append node to L
-        ordered.append(node)
-
-        parents = dependants.get(node, None)
-        if parents:
-            for parent in parents:
-                deps = dependencies.get(parent, None)
-                if deps is not None:
-                    try:
-                        deps.remove(node)
-                    except KeyError:
-                        pass
-                    if len(deps) == 0:
-                        sorting.append(parent)
-                        del dependencies[parent]
-
-    return ordered
 
+def top_sort(forest):
+    """
+    Partial ordering of nodes in the forest.
+    :param forest: a Hypergraph
+    :return: list of nodes (ids) ordered from leaves to root
+    """
+    levels = top_sort_levels(forest)
+    return np.concatenate(levels).tolist() if levels else []
@@ -0,0 +1,254 @@
+"""
+Earley intersection over a prefix trie of the rules of each nonterminal.
+
+The rules rewriting a nonterminal are compiled into a trie of their RHS prefixes (a RuleTrie)
+and an item is a trie node (a dotted prefix shared by every rule that starts with it) annotated with the states it spans.
+Prediction creates a single item per nonterminal and state, scanning and completion advance it
+along the edges of the trie, thus rules are only told apart where their RHS diverge.
+This pays off for grammars in which many rules of the same LHS start alike (e.g. the [P...] rules of reordering grammars).
+
+When an item reaches a node which is the whole RHS of some rules, the complete items of those rules are stored in the Agenda,
+thus the forest is built as for the other engines (see `agenda.get_cfg`).
+
+:Authors: - Wilker Aziz
+"""
+
+EMPTY_SET = frozenset()
+from agenda import Agenda, ActiveQueue, get_cfg
+from item import ItemFactory
+from grammar_index import GrammarIndex
+from rule import InternedRule
+from collections import defaultdict
+
+
+class PrefixNode(InternedRule):
+    """
+    A node of a RuleTrie: a prefix of the RHS of some rules of a nonterminal.
+    A node is itself a rule (whose RHS is the prefix and which has no log probability),
+    thus items over prefixes are created and advanced by an ItemFactory like items over rules (see `ItemFactory.advance`).
+    """
+
+    __slots__ = ('rules', 'terminals', 'nonterminals')
+
+    def __init__(self, lhs, rhs):
+        super(PrefixNode, self).__init__(lhs, rhs, None)
+        self.rules = []  # rules whose RHS is the prefix
+        self.terminals = {}  # terminal -> longer prefix
+        self.nonterminals = {}  # nonterminal -> longer prefix
+
+
+class CompleteItem(object):
+    """
+    The complete item of a rule whose RHS is the prefix of an item, as stored in the Agenda (see `agenda.get_cfg`).
+    A prefix item is processed once, thus its complete items are unique and need not be interned by the ItemFactory.
+    """
+
+    __slots__ = ('rule', 'start', 'dot', 'inner')
+
+    def __init__(self, rule, item):
+        self.rule = rule
+        self.start = item.start
+        self.dot = item.dot
+        self.inner = item.inner
+
+
+class RuleTrie(object):
+    """
+    Tries of RHS prefixes by LHS, built once per grammar.
+
+    >>> from wcfg import WCFG
+    >>> from rule import Rule
+    >>> G = WCFG([Rule('[S]', ['[NP]', '[VP]'], 0.0), Rule('[S]', ['[NP]', '[VP]', '[PP]'], 0.0), Rule('[S]', ['[NP]', 'runs'], 0.0)])
+    >>> T = RuleTrie(G)
+    >>> len(T), len(G)
+    (5, 3)
+    >>> node = T.root('[S]').nonterminals['[NP]']
+    >>> sorted(node.terminals), sorted(node.nonterminals), node.rules
+    (['runs'], ['[VP]'], [])
+    >>> node.nonterminals['[VP]'].rules
+    [[S] -> [NP] [VP] (0.0)]
+    """
+
+    def __init__(self, wcfg):
+        """
+        :param wcfg: the grammar (symbols are encoded as in the grammar, see `wcfg.encode`)
+        """
+        self._roots = {}  # LHS -> node of the empty prefix
+        self._size = 0
+        is_terminal = wcfg.is_terminal
+        for rule in wcfg:
+            node = self._roots.get(rule.lhs, None)
+            if node is None:
+                node = self._roots[rule.lhs] = PrefixNode(rule.lhs, ())
+                self._size += 1
+            for sym in rule.rhs:
+                children = node.terminals if is_terminal(sym) else node.nonterminals
+                child = children.get(sym, None)
+                if child is None:
+                    child = children[sym] = PrefixNode(rule.lhs, node.rhs + (sym,))
+                    self._size += 1
+                node = child
+            node.rules.append(rule)
+
+    def __len__(self):
+        """Number of prefixes (including the empty prefix of each LHS)."""
+        return self._size
+
+    def root(self, lhs):
+        """The empty prefix of the rules of a nonterminal (None if it cannot be rewritten)."""
+        return self._roots.get(lhs, None)
+
+
+class TrieEarley(object):
+    """
+    Top-down intersection whose items are RHS prefixes shared by several rules.
+
+    >>> from wcfg import WCFG
+    >>> from rule import Rule
+    >>> from wfsa import make_linear_fsa
+    >>> from earley import Earley
+    >>> G = WCFG([Rule('[S]', ['[NP]', '[VP]'], -1.0), Rule('[S]', ['[NP]', '[VP]', '[NP]'], -2.0), Rule('[S]', ['[NP]', 'runs', '[NP]'], -2.0),
+    ...           Rule('[NP]', ['dogs'], 0.0), Rule('[NP]', ['[NP]', '[NP]'], -3.0), Rule('[VP]', ['runs'], 0.0), Rule('[VP]', ['[VP]', '[NP]'], -1.0)])
+    >>> fsa = make_linear_fsa('dogs runs dogs dogs')
+    >>> forest = TrieEarley(G, fsa).do('[S]', '[GOAL]')
+    >>> expected = Earley(G, fsa).do('[S]', '[GOAL]')
+    >>> len(forest), sorted(str(forest).split('\\n')) == sorted(str(expected).split('\\n'))
+    (13, True)
+    """
+
+    def __init__(self, wcfg, wfsa, index=None, item_factory=None, viable=None, trie=None):
+        """
+        :param index: a GrammarIndex for `wcfg` (built if not given, share it across parsers of the same grammar)
+        :param item_factory: an ItemFactory (created if not given, clear it before reusing it for another parse)
+        :param viable: a ViableSet (see recogniser.py), if given, nonterminals over spans outside it are skipped
+        :param trie: a RuleTrie for `wcfg` (built if not given, share it across parsers of the same grammar)
+        """
+
+        self._wcfg = wcfg
+        self._wfsa = wcfg.encode_fsa(wfsa)
+        self._index = GrammarIndex(wcfg) if index is None else index
+        self._trie = RuleTrie(wcfg) if trie is None else trie
+        self._agenda = Agenda(active_container_type=ActiveQueue)
+        self._predictions = set()  # (LHS, start)
+        self._waiting = defaultdict(list)  # (nonterminal, start) -> items whose prefix may be extended by it
+        self._item_factory = ItemFactory() if item_factory is None else item_factory
+        self._viable_set = viable
+        # left-corner filter: symbols which may start a constituent from a given state
+        self._viable = defaultdict(set)
+        for sfrom, sto, sym, w in self._wfsa.iterarcs():
+            self._viable[sfrom].add(sym)
+            self._viable[sfrom].update(self._index.left_corner_ancestors(sym))
+
+    def admit(self, rules, start, end):
+        """The rules (sharing a LHS and a RHS) whose complete items over a span are kept."""
+        return rules
+
+    def prediction(self, symbol, start):
+        """
+        Creates the item of the empty prefix of a nonterminal from a given state.
+        It returns True when prediction happens, and False if it already happened before.
+        """
+        if (symbol, start) in self._predictions:  # prediction already happened
+            return False
+        self._predictions.add((symbol, start))
+        node = self._trie.root(symbol)
+        if node is not None and (self._viable_set is None or self._viable_set.can_start(symbol, start)):
+            self._agenda.add(self._item_factory.get_item(node, start))
+        return True
+
+    def scan(self, item):
+        """Extends the prefix of an item by the terminals leaving its dot."""
+        advance = self._item_factory.advance
+        get_arcs = self._wfsa.get_arcs
+        for sym, child in item.rule.terminals.iteritems():
+            for sto, w in get_arcs(origin=item.dot, symbol=sym):
+                self._agenda.add(advance(item, sto, child))
+
+    def complete_itself(self, item):
+        """
+        Waits for the nonterminals which extend the prefix of an item (predicting them)
+        and merges it with those that have already been completed.
+        """
+        node, dot = item.rule, item.dot
+        advance = self._item_factory.advance
+        agenda = self._agenda
+        # the first symbol of a rule must be able to start a constituent (left-corner filter)
+        left_corners = None if item.inner else self._viable.get(dot, EMPTY_SET)
+        for sym, child in node.nonterminals.iteritems():
+            if left_corners is not None and sym not in left_corners:
+                continue
+            if not self._index.can_rewrite(sym):  # if the NT does not exist the prefix cannot be extended by it
+                continue
+            self._waiting[(sym, dot)].append(item)
+            self.prediction(sym, dot)
+            for sto in agenda.itercompletions(sym, dot):
+                agenda.add(advance(item, sto, child))
+
+    def complete_others(self, item, root):
+        """
+        Stores the complete items of the rules whose RHS is the prefix of an item
+        and advances the items waiting for their LHS (the first time the LHS is completed over the span).
+        """
+        node, start, end = item.rule, item.start, item.dot
+        lhs = node.lhs
+        if self._viable_set is not None and (lhs, start, end) not in self._viable_set:  # takes no part in any parse
+            return
+        rules = self.admit(node.rules, start, end)
+        if not rules:
+            return
+        agenda = self._agenda
+        waiting = self._waiting.get((lhs, start), None)
+        is_root = lhs == root and self._wfsa.is_initial(start) and self._wfsa.is_final(end)
+        if not waiting and not is_root:  # a complete item is only kept in case it could potentially complete others
+            return
+        first = not agenda.is_generating(lhs, start, end)
+        for rule in rules:
+            agenda.make_complete(CompleteItem(rule, item))
+        if first and waiting:
+            advance = self._item_factory.advance
+            agenda.extend(advance(incomplete, end, incomplete.rule.nonterminals[lhs]) for incomplete in waiting)
+
+    def do(self, root='[S]', goal='[GOAL]'):
+
+        wfsa = self._wfsa
+        wcfg = self._wcfg
+        agenda = self._agenda
+
+        # start items: the empty prefix of the root from an initial state
+        symbol, root = root, wcfg.encode(root)
+        if self._trie.root(root) is None:
+            raise ValueError('No rule for the start symbol %s' % symbol)
+        for start in wfsa.iterinitial():
+            self.prediction(root, start)
+
+        while agenda:
+            item = agenda.pop()  # always returns an active item
+            # a prefix may be the RHS of some rules and be extended by others
+            if item.rule.rules:
+                self.complete_others(item, root)
+            if item.rule.terminals:
+                self.scan(item)
+            if item.rule.nonterminals:
+                self.complete_itself(item)
+        # converts complete items into rules
+        return self.get_cfg(goal, root)
+
+    def get_cfg(self, goal, root):
+        """
+        Constructs the CFG by visiting complete items in a top-down fashion (see `agenda.get_cfg`).
+        """
+        return get_cfg(goal, root, self._wfsa, self._agenda, self._wcfg)
+
+
+class SlicedTrieEarley(TrieEarley):
+    """
+    TrieEarley which only keeps complete items whose rule's log probability is above the slice variable of their span.
+    """
+
+    def __init__(self, wcfg, wfsa, slice_vars, index=None, item_factory=None, viable=None, trie=None):
+        super(SlicedTrieEarley, self).__init__(wcfg, wfsa, index, item_factory, viable, trie)
+        self.slice_vars = slice_vars
+
+    def admit(self, rules, start, end):
+        u = self.slice_vars.get(rules[0].lhs, start, end)
+        return [rule for rule in rules if rule.log_prob > u]
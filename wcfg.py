@@ -2,10 +2,16 @@
 @author wilkeraziz
 """
 
-from collections import defaultdict, deque
-from symbol import is_terminal
+import itertools
+import heapq
+from operator import itemgetter
+from collections import defaultdict
+from symbol import is_terminal, node_label
 from rule import Rule
 from math import log
+from hypergraph import HypergraphBuilder
+from inference import inside
+from semiring import Counting
 
 
 class WCFG(object):
@@ -19,14 +25,16 @@ class WCFG(object):
             self.add(rule)
 
     def add(self, rule):
+        """Adds a rule and returns it."""
         self._rules.append(rule)
         self._rules_by_lhs[rule.lhs].append(rule)
         self._nonterminals.add(rule.lhs)
         for s in rule.rhs:
-            if is_terminal(s):
+            if self.is_terminal(s):
                 self._terminals.add(s)
             else:
                 self._nonterminals.add(s)
+        return rule
 
     def update(self, rules):
         for rule in rules:
@@ -59,7 +67,31 @@ class WCFG(object):
 
     def __iter__(self):
         return iter(self._rules)
-    
+
+    # The following methods make a WCFG interchangeable with a CompiledWCFG (whose symbols are integer ids).
+    # Here symbols are their own encoding.
+
+    def is_terminal(self, symbol):
+        return is_terminal(symbol)
+
+    def is_nonterminal(self, symbol):
+        return not is_terminal(symbol)
+
+    def encode(self, symbol):
+        return symbol
+
+    def decode(self, symbol):
+        return symbol
+
+    def encode_rule(self, rule):
+        return rule
+
+    def decode_rule(self, rule):
+        return rule
+
+    def encode_fsa(self, wfsa):
+        return wfsa
+
     def iteritems(self):
         return self._rules_by_lhs.iteritems()
     
@@ -71,31 +103,298 @@ class WCFG(object):
         return '\n'.join(lines)
 
 
+class Forest(WCFG):
+    """
+    An intersected grammar whose nonterminal nodes are structured: (symbol, start, end),
+    where the symbol is encoded as in the grammar that was intersected (see `wcfg.encode`).
+    Terminals are strings and so is the goal node.
+    Annotated strings such as [X,0-1] are only built on demand (see `label`).
+
+    >>> from rule import Rule
+    >>> F = Forest([Rule('[GOAL]', [('[S]', 0, 1)], 0.0), Rule(('[S]', 0, 1), ['a'], 0.0)])
+    >>> F.is_nonterminal('[GOAL]'), F.is_terminal('a'), sorted(F.terminals)
+    (True, True, ['a'])
+    >>> [F.label(node) for node in ('[GOAL]', ('[S]', 0, 1), 'a')]
+    ['[GOAL]', '[S,0-1]', 'a']
+    """
+
+    def __init__(self, rules=[], decode=lambda sym: sym):
+        """
+        :param decode: maps the symbols of the intersected grammar back to strings
+        """
+        self._decode = decode
+        WCFG.__init__(self, rules)
+
+    def is_terminal(self, symbol):
+        return not (type(symbol) is tuple or symbol in self._rules_by_lhs)
+
+    def is_nonterminal(self, symbol):
+        return type(symbol) is tuple or symbol in self._rules_by_lhs
+
+    def label(self, node):
+        """Returns the string of a node."""
+        return node_label(node, self._decode)
+
+    def __str__(self):
+        return '\n'.join('%s -> %s (%s)' % (self.label(rule.lhs), ' '.join(self.label(sym) for sym in rule.rhs),
+                                            rule.log_prob) for rule in self)
+
+
+class SubWCFG(object):
+    """
+    A subset of the rules of a grammar (either a WCFG or a CompiledWCFG).
+    Rules are not copied and symbols keep the encoding of the original grammar.
+    """
+
+    def __init__(self, wcfg, rules):
+        self._wcfg = wcfg
+        self._rules = list(rules)
+        self._rules_by_lhs = defaultdict(list)
+        for rule in self._rules:
+            self._rules_by_lhs[rule.lhs].append(rule)
+
+    @property
+    def base(self):
+        """The original grammar."""
+        return self._wcfg
+
+    @property
+    def nonterminals(self):
+        return frozenset(s for rule in self._rules for s in itertools.chain([rule.lhs], rule.rhs)
+                         if self._wcfg.is_nonterminal(s))
+
+    @property
+    def terminals(self):
+        """Set of terminals (decoded)."""
+        return frozenset(self._wcfg.decode(s) for rule in self._rules for s in rule.rhs if self._wcfg.is_terminal(s))
+
+    def __len__(self):
+        return len(self._rules)
+
+    def __getitem__(self, lhs):
+        return self._rules_by_lhs.get(lhs, frozenset())
+
+    def get(self, lhs, default=frozenset()):
+        return self._rules_by_lhs.get(lhs, frozenset())
+
+    def can_rewrite(self, lhs):
+        return lhs in self._rules_by_lhs
+
+    def __iter__(self):
+        return iter(self._rules)
+
+    def iteritems(self):
+        return self._rules_by_lhs.iteritems()
+
+    def is_terminal(self, symbol):
+        return self._wcfg.is_terminal(symbol)
+
+    def is_nonterminal(self, symbol):
+        return self._wcfg.is_nonterminal(symbol)
+
+    def encode(self, symbol):
+        return self._wcfg.encode(symbol)
+
+    def decode(self, symbol):
+        return self._wcfg.decode(symbol)
+
+    def encode_rule(self, rule):
+        return self._wcfg.encode_rule(rule)
+
+    def decode_rule(self, rule):
+        return self._wcfg.decode_rule(rule)
+
+    def encode_fsa(self, wfsa):
+        return self._wcfg.encode_fsa(wfsa)
+
+    def __str__(self):
+        return '\n'.join(str(self.decode_rule(rule)) for rule in self._rules)
+
+
+class OverlayWCFG(object):
+    """
+    A base grammar (either a WCFG or a CompiledWCFG) extended with a few local rules,
+    e.g. the rules a sentence introduces for its unknown words.
+    The base grammar is neither copied nor modified, thus it can be shared across sentences.
+
+    >>> from rule import Rule
+    >>> base = WCFG([Rule('[S]', ['[X]'], 0.0), Rule('[X]', ['a'], 0.0)])
+    >>> G = OverlayWCFG(base, [Rule('[X]', ['b'], 0.0)])
+    >>> G.get('[X]')
+    [[X] -> a (0.0), [X] -> b (0.0)]
+    >>> len(G), len(base), sorted(G.terminals), sorted(base.terminals)
+    (3, 2, ['a', 'b'], ['a'])
+    """
+
+    def __init__(self, wcfg, rules):
+        """
+        :param wcfg: the base grammar
+        :param rules: local rules whose symbols are strings
+        """
+        self._wcfg = wcfg
+        self._local = [wcfg.encode_rule(rule) for rule in rules]
+        self._local_by_lhs = defaultdict(list)
+        for rule in self._local:
+            self._local_by_lhs[rule.lhs].append(rule)
+        self._merged = {}  # LHS -> base rules followed by local rules
+        self._terminals = None
+
+    @property
+    def base(self):
+        """The base grammar."""
+        return self._wcfg
+
+    @property
+    def local(self):
+        """The local rules (encoded as in the base grammar)."""
+        return self._local
+
+    @property
+    def nonterminals(self):
+        return frozenset(self._wcfg.nonterminals).union(
+            s for rule in self._local for s in itertools.chain([rule.lhs], rule.rhs) if self._wcfg.is_nonterminal(s))
+
+    @property
+    def terminals(self):
+        """Set of terminals (decoded)."""
+        if self._terminals is None:
+            self._terminals = frozenset(self._wcfg.terminals).union(
+                self._wcfg.decode(s) for rule in self._local for s in rule.rhs if self._wcfg.is_terminal(s))
+        return self._terminals
+
+    def __len__(self):
+        return len(self._wcfg) + len(self._local)
+
+    def __getitem__(self, lhs):
+        return self.get(lhs)
+
+    def get(self, lhs, default=frozenset()):
+        local = self._local_by_lhs.get(lhs, None)
+        if local is None:
+            return self._wcfg.get(lhs, default)
+        rules = self._merged.get(lhs, None)
+        if rules is None:
+            rules = list(self._wcfg.get(lhs, [])) + local
+            self._merged[lhs] = rules
+        return rules
+
+    def can_rewrite(self, lhs):
+        return lhs in self._local_by_lhs or self._wcfg.can_rewrite(lhs)
+
+    def __iter__(self):
+        return itertools.chain(self._wcfg, self._local)
+
+    def iteritems(self):
+        for lhs, rules in self._wcfg.iteritems():
+            yield lhs, self.get(lhs, rules)
+        for lhs, rules in self._local_by_lhs.iteritems():
+            if not self._wcfg.can_rewrite(lhs):
+                yield lhs, rules
+
+    def is_terminal(self, symbol):
+        return self._wcfg.is_terminal(symbol)
+
+    def is_nonterminal(self, symbol):
+        return self._wcfg.is_nonterminal(symbol)
+
+    def encode(self, symbol):
+        return self._wcfg.encode(symbol)
+
+    def decode(self, symbol):
+        return self._wcfg.decode(symbol)
+
+    def encode_rule(self, rule):
+        return self._wcfg.encode_rule(rule)
+
+    def decode_rule(self, rule):
+        return self._wcfg.decode_rule(rule)
+
+    def encode_fsa(self, wfsa):
+        return self._wcfg.encode_fsa(wfsa)
+
+    def __str__(self):
+        return '\n'.join(str(self.decode_rule(rule)) for rule in self)
+
+
 def count_derivations(wcfg, root):
-    
-    def recursion(derivation, projection, Q, wcfg, counts):
-        #print 'd:', '|'.join(str(r) for r in derivation)
-        #print 'p:', projection
-        #print 'Q:', Q
-        if Q:
-            sym = Q.popleft()
-            #print ' pop:', sym
-            if is_terminal(sym):
-                recursion(derivation, [sym] + projection, Q, wcfg, counts)
-            else:
-                for rule in wcfg[sym]:
-                    #print '  rule:', rule
-                    QQ = deque(Q)
-                    QQ.extendleft(rule.rhs)
-                    recursion(derivation + [rule], projection, QQ, wcfg, counts)
-        else:
-            counts['d'][tuple(derivation)] += 1
-            counts['p'][tuple(projection)] += 1
+    """
+    Number of derivations of a node in an acyclic grammar (e.g. a Forest),
+    i.e. its inside weight in the counting semiring.
 
-    
-    counts = {'d': defaultdict(int), 'p': defaultdict(int)}
-    recursion([], [], deque([root]), wcfg, counts)
-    return counts
+    >>> F = Forest([Rule('[GOAL]', [('[S]', 0, 2)], 0.0), Rule(('[S]', 0, 2), [('[X]', 0, 1), ('[X]', 1, 2)], 0.0),
+    ...             Rule(('[S]', 0, 2), [('[X]', 1, 2), ('[X]', 0, 1)], 0.0), Rule(('[X]', 0, 1), ['a'], 0.0),
+    ...             Rule(('[X]', 1, 2), ['b'], 0.0), Rule(('[X]', 1, 2), ['c'], 0.0)])
+    >>> count_derivations(F, '[GOAL]')
+    4
+    """
+    H = HypergraphBuilder()
+    for rule in wcfg:
+        H.add_edge(H.node(rule.lhs), [H.node(sym) for sym in rule.rhs], rule.log_prob)
+    forest = H.build()
+    node = forest.fetch(root)
+    return 0 if node is None else inside(forest, semiring=Counting)[node]
+
+
+class _Stream(object):
+    """A generator whose values are cached as they are produced, thus it can be iterated more than once."""
+
+    def __init__(self, generator):
+        self._generator = generator
+        self._cache = []
+
+    def __iter__(self):
+        i = 0
+        while True:
+            if i == len(self._cache):
+                try:
+                    self._cache.append(next(self._generator))
+                except StopIteration:
+                    return
+            yield self._cache[i]
+            i += 1
+
+
+def iteryields(wcfg, root):
+    """
+    Generates the distinct yields of a node in an acyclic grammar (e.g. a Forest) and their number of derivations,
+    lazily and in lexicographic order.
+    The yields of each node are memoised as they are needed, the caller may stop at any point (e.g. with islice).
+
+    This requires all yields of a node to have the same length, which is the case of a forest intersected
+    with a linear FSA (a node spans a fixed number of words).
+
+    >>> F = Forest([Rule('[GOAL]', [('[S]', 0, 2)], 0.0), Rule(('[S]', 0, 2), [('[X]', 0, 1), ('[X]', 1, 2)], 0.0),
+    ...             Rule(('[S]', 0, 2), [('[X]', 1, 2), ('[X]', 0, 1)], 0.0), Rule(('[X]', 0, 1), ['a'], 0.0),
+    ...             Rule(('[X]', 1, 2), ['b'], 0.0), Rule(('[X]', 1, 2), ['c'], 0.0)])
+    >>> list(iteryields(F, '[GOAL]'))
+    [(('a', 'b'), 1), (('a', 'c'), 1), (('b', 'a'), 1), (('c', 'a'), 1)]
+
+    :returns: pairs (yield, number of derivations) where a yield is a tuple of terminals
+    """
+    streams = {}
+
+    def stream(sym):
+        s = streams.get(sym, None)
+        if s is None:
+            s = _Stream(node_yields(sym) if wcfg.is_nonterminal(sym) else iter([((sym,), 1)]))
+            streams[sym] = s
+        return s
+
+    def concatenate(rhs):
+        # yields of a node have a fixed length, thus concatenating sorted streams in nested loops is sorted
+        if not rhs:
+            yield (), 1
+            return
+        for prefix, n in stream(rhs[0]):
+            for suffix, m in concatenate(rhs[1:]):
+                yield prefix + suffix, n * m
+
+    def node_yields(sym):
+        merged = heapq.merge(*[concatenate(rule.rhs) for rule in wcfg.get(sym)])
+        for y, group in itertools.groupby(merged, key=itemgetter(0)):
+            yield y, sum(n for _, n in group)
+
+    return node_yields(root)
 
 
 def read_grammar_rules(istream, transform=log, strip_quotes=False):